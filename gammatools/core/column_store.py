@@ -0,0 +1,172 @@
+"""
+@file  column_store.py
+
+@brief Columnar on-disk storage for tables of one-dimensional arrays.
+
+@author Matthew Wood       <mdwood@slac.stanford.edu>
+"""
+
+import os
+import json
+import struct
+import numpy as np
+from numpy.lib import format as npy_format
+from gammatools.core.util import make_dir, atomic_write
+
+class ColumnStore(object):
+    """Columnar on-disk table.  A store is a directory containing one
+    .npy file per column and a JSON schema (schema.json) that records
+    the column names, data types, and the number of rows.  Each
+    column can be opened independently as a read-only memory map with
+    np.load(mmap_mode='r') so that only the columns and rows that are
+    accessed are read from disk.
+
+    Rows are appended in place at the end of each column file without
+    rewriting earlier data.  Column files are written with a
+    fixed-length header that is updated after each append.  The row
+    count in the schema is updated last and is authoritative: rows
+    beyond it (e.g. from an interrupted append) are ignored by
+    readers and overwritten by the next append.
+
+    Parameters
+    ----------
+    path : str
+        Path to the store directory.
+    """
+
+    schema_file = 'schema.json'
+    header_len = 128
+
+    def __init__(self,path):
+
+        self._path = path
+        with open(os.path.join(path,ColumnStore.schema_file),'r') as f:
+            self._schema = json.load(f)
+
+        self._dtypes = dict([(c['name'],np.dtype(str(c['dtype'])))
+                             for c in self._schema['columns']])
+
+    @staticmethod
+    def create(path,columns):
+        """Create an empty store.
+
+        Parameters
+        ----------
+        path : str
+            Path to the store directory.
+
+        columns : list
+            List of (name, dtype) pairs.
+        """
+
+        make_dir(path)
+
+        schema = { 'version' : 1, 'nrow' : 0, 'columns' : [] }
+        for name, dtype in columns:
+
+            dtype = np.dtype(dtype)
+            if dtype.hasobject:
+                raise ValueError('Column %s has an object data type.'%name)
+
+            schema['columns'].append({'name' : name,
+                                      'dtype' : dtype.str})
+            with open(os.path.join(path,name + '.npy'),'wb') as f:
+                ColumnStore._write_header(f,dtype,0)
+
+        ColumnStore._write_schema(path,schema)
+        return ColumnStore(path)
+
+    @staticmethod
+    def is_store(path):
+        return os.path.isfile(os.path.join(path,ColumnStore.schema_file))
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def nrow(self):
+        return self._schema['nrow']
+
+    def columns(self):
+        return [c['name'] for c in self._schema['columns']]
+
+    def dtype(self,col):
+        return self._dtypes[col]
+
+    def column_path(self,col):
+        return os.path.join(self._path,col + '.npy')
+
+    def read(self,col):
+        """Return a read-only memory map of a column."""
+
+        if not col in self._dtypes:
+            raise KeyError('Unknown column: %s'%col)
+
+        nrow = self.nrow
+        if nrow == 0: return np.zeros(0,dtype=self._dtypes[col])
+        return np.load(self.column_path(col),mmap_mode='r')[:nrow]
+
+    def load(self,columns=None):
+        """Return a dictionary of read-only memory maps for the given
+        list of columns (all columns by default)."""
+
+        if columns is None: columns = self.columns()
+        return dict([(c,self.read(c)) for c in columns])
+
+    def append(self,data):
+        """Append rows to the store.  data is a dictionary of
+        one-dimensional arrays with one entry for every column of the
+        store.  All arrays must have the same length."""
+
+        cols = self.columns()
+
+        missing = set(cols) - set(data.keys())
+        if missing:
+            raise ValueError('Missing columns: %s'%(', '.join(sorted(missing))))
+
+        arrs = {}
+        for c in cols:
+            arrs[c] = np.ascontiguousarray(np.ravel(data[c]),
+                                           dtype=self._dtypes[c])
+
+        nadd = set([len(v) for v in arrs.values()])
+        if len(nadd) > 1:
+            raise ValueError('Columns have different lengths.')
+        nadd = nadd.pop() if nadd else 0
+        if nadd == 0: return
+
+        nrow = self.nrow
+        for c in cols:
+
+            dtype = self._dtypes[c]
+            with open(self.column_path(c),'r+b') as f:
+                f.seek(ColumnStore.header_len + nrow*dtype.itemsize)
+                f.write(arrs[c].tostring())
+                f.truncate()
+                f.seek(0)
+                ColumnStore._write_header(f,dtype,nrow+nadd)
+
+        self._schema['nrow'] = nrow + nadd
+        ColumnStore._write_schema(self._path,self._schema)
+
+    @staticmethod
+    def _write_header(f,dtype,nrow):
+        """Write a version 1.0 npy header padded to header_len
+        bytes so that it can be rewritten in place as the column
+        grows."""
+
+        d = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }"%(
+            npy_format.dtype_to_descr(dtype),nrow)
+
+        hlen = ColumnStore.header_len - 10
+        f.write(npy_format.magic(1,0))
+        f.write(struct.pack('<H',hlen))
+        f.write(d.ljust(hlen-1) + '\n')
+
+    @staticmethod
+    def _write_schema(path,schema):
+
+        with atomic_write(os.path.join(path,ColumnStore.schema_file),
+                          'w') as f:
+            json.dump(schema,f,indent=2)
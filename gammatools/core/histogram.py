@@ -14,6 +14,7 @@ __date__     = "$Date: 2013/10/20 23:59:49 $"
 __revision__ = "$Revision: 1.30 $, $Author: mdwood $"
 
 import sys
+import types
 import numpy as np
 import copy
 import matplotlib.pyplot as plt
@@ -270,10 +271,10 @@ class HistogramND(object):
         @return:
         """
 
-        z = np.array(z,ndmin=2)
-        w = np.array(w,ndmin=1)
+        z = np.array(z,ndmin=2,copy=False)
+        w = np.array(w,ndmin=1,copy=False)
         if v is None: v = w
-        else: v = np.array(v,ndmin=1)
+        else: v = np.array(v,ndmin=1,copy=False)
 
         if z.shape[0] != self._ndim:
 
@@ -281,17 +282,138 @@ class HistogramND(object):
             raise Exception('Coordinate dimension of input array must be '
                             'equal to histogram dimension.')
 
-        if w.shape[0] < z.shape[1]: w = np.ones(z.shape[1])*w
-        if v.shape[0] < z.shape[1]: v = np.ones(z.shape[1])*v
+        index, msk = self._fill_index(z)
+        index = index[msk]
 
-        edges = []
-        for i in self._dims: edges.append(self._axes[i].edges)
+        # Scalar weights are applied to the unweighted bin occupation
+        # rather than being broadcast to the length of the input.
+        if w.shape[0] < z.shape[1]: 
+            c = np.bincount(index,minlength=self._counts.size)
+            counts = c*w[0]
+        else:
+            c = None
+            counts = np.bincount(index,weights=w[msk],
+                                 minlength=self._counts.size)
+
+        if v is w: var = counts
+        elif v.shape[0] < z.shape[1]:
+            if c is None: c = np.bincount(index,minlength=self._counts.size)
+            var = c*v[0]
+        else:
+            var = np.bincount(index,weights=v[msk],
+                              minlength=self._counts.size)
+
+        self._counts += counts.reshape(self._counts.shape)
+        self._var += var.reshape(self._var.shape)
+
+    def fill_from_iter(self,chunks):
+        """
+        Fill the histogram incrementally from an iterable of data
+        chunks (e.g. a generator over the row slices of a FITS
+        table).  Each chunk is passed to the fill method of this
+        histogram: tuples are expanded into positional arguments,
+        dictionaries into keyword arguments, and any other object is
+        passed as the first argument.  Only a single chunk is held in
+        memory at a time.
+
+        @param chunks: Iterable of fill arguments.
+        @return: Number of chunks processed.
+        """
+
+        nchunk = 0
+        for chunk in chunks:
+            self._fill_chunk(chunk)
+            nchunk += 1
+
+        return nchunk
+
+    def _fill_chunk(self,chunk):
+
+        if isinstance(chunk,tuple): self.fill(*chunk)
+        elif isinstance(chunk,dict): self.fill(**chunk)
+        elif isinstance(chunk,types.GeneratorType): self.fill_from_iter(chunk)
+        else: self.fill(chunk)
+
+    def parallel_fill(self,files,loader,workers=None,nslot=None):
+        """
+        Fill the histogram from a list of input files using a pool
+        of worker processes.  Each worker fills a private histogram
+        with the axes of this histogram from the data returned by
+        loader(file).  The partial counts and variance arrays are
+        written to a shared memory buffer and are accumulated into
+        this histogram in the order of the input file list.  The
+        result is therefore identical to calling _fill_chunk on the
+        output of loader for each file in sequence (for loaders that
+        yield multiple chunks per file this holds exactly only for
+        integer-valued weights).  Underflow and overflow counts of
+        one-dimensional histograms are not accumulated.
+
+        @param files: List of input files.
+        @param loader: Picklable function that takes a file name
+        and returns the arguments to fill (a tuple, dict, or
+        coordinate array) or a generator of such chunks.
+        @param workers: Number of worker processes.  Defaults to the
+        number of CPUs.  If workers is 1 the files are processed
+        serially in this process.
+        @param nslot: Number of partial histograms held in shared
+        memory at one time.  Defaults to twice the number of workers.
+        """
+
+        import multiprocessing
+
+        if workers is None: workers = multiprocessing.cpu_count()
+
+        if workers <= 1:
+            for f in files: self._fill_chunk(loader(f))
+            return
+
+        if nslot is None: nslot = 2*workers
+        nslot = min(nslot,len(files))
+        if nslot == 0: return
 
-        counts = np.histogramdd(z.T,bins=edges,weights=w)[0]
-        var = np.histogramdd(z.T,bins=edges,weights=v)[0]
+        size = self._counts.size
+        buf = multiprocessing.RawArray('d',nslot*2*size)
+        partial = np.frombuffer(buf).reshape(nslot,2,size)
+
+        pool = multiprocessing.Pool(workers,initializer=_parallel_fill_init,
+                                    initargs=(buf,nslot,self._axes,loader))
+
+        counts = self._counts.reshape(size)
+        var = self._var.reshape(size)
+
+        try:
+            for i in range(0,len(files),nslot):
+
+                args = [(j,f) for j, f in enumerate(files[i:i+nslot])]
+                
+                for islot in pool.imap(_parallel_fill_worker,args):
+                    counts += partial[islot,0]
+                    var += partial[islot,1]
+        finally:
+            pool.close()
+            pool.join()
 
-        self._counts += counts
-        self._var += var
+    def _fill_index(self,z):
+        """Compute the flattened bin index of each point in the NxM
+        coordinate array z.  Returns the index array and a mask that
+        is false for points that fall outside the histogram range."""
+
+        index = None
+        msk = None
+
+        for i in self._dims:
+
+            ibin = self._axes[i].fillIndex(z[i])
+
+            if index is None:
+                msk = ibin >= 0
+                index = ibin
+            else:
+                msk &= (ibin >= 0)
+                index *= self._axes[i].nbins
+                index += ibin
+
+        return index, msk
 
     def random(self,method='poisson',scale=1.0):
         """Generate a randomized histogram."""
@@ -495,18 +617,30 @@ class HistogramND(object):
     def interpolate(self,*x):
         """Note: All input arrays must have the same dimension."""
 
-        center = []
-        for i in range(self._ndim): center.append(self._axes[i].center)
-
         if len(x) == 1:
             xv = x[0]
             shape = x[0].shape[1]
         else:            
             xv, shape = expand_array(*x)
 
-        v = interpolatend(center,self._counts,xv)
+        v = self._get_interpolator()(xv,self._counts)
         return v.reshape(shape)
 
+    def _get_interpolator(self):
+        """Return a GridInterpolator bound to the bin centers of this
+        histogram.  The interpolator is cached and regenerated if the
+        axes of the histogram are replaced."""
+
+        interp = getattr(self,'_interpolator',None)
+
+        if (interp is None or len(interp[0]) != len(self._axes) or 
+            any([a is not b for a, b in zip(interp[0],self._axes)])):
+            center = [ax.center for ax in self._axes]
+            interp = (list(self._axes),GridInterpolator(center))
+            self._interpolator = interp
+
+        return interp[1]
+
     def interpolateSlice(self,sdims,dim_coord):
 
         sdims = np.array(sdims,ndmin=1,copy=True)
@@ -516,15 +650,14 @@ class HistogramND(object):
         h = self.sliceByValue(sdims,dim_coord)
 
         x = np.zeros(shape=(self._ndim,h._counts.size))
-        c = h.center
+        c = h.center()
 
         for i, idim in enumerate(dims): x[idim] = c[i]
         for i, idim in enumerate(sdims): x[idim,:] = dim_coord[i]
 
-        center = []
-        for i in range(self._ndim): center.append(self._axes[i].center)
-        h._counts = interpolatend(center,self._counts,x).reshape(h._counts.shape)
-        h._var = interpolatend(center,self._var,x).reshape(h._counts.shape)
+        interp = self._get_interpolator()
+        h._counts = interp(x,self._counts).reshape(h._counts.shape)
+        h._var = interp(x,self._var).reshape(h._counts.shape)
 
         return h
 
@@ -663,6 +796,32 @@ class HistogramND(object):
 
         return HistogramND.create(h.axes(),h.counts,h.var,h.style())
 
+_parallel_fill_state = {}
+
+def _parallel_fill_init(buf,nslot,axes,loader):
+    """Initialize the state of a HistogramND.parallel_fill worker
+    process."""
+    _parallel_fill_state['buf'] = buf
+    _parallel_fill_state['nslot'] = nslot
+    _parallel_fill_state['axes'] = axes
+    _parallel_fill_state['loader'] = loader
+
+def _parallel_fill_worker(args):
+    """Fill a private histogram from a single file and write its
+    contents to a slot in the shared memory buffer."""
+    
+    islot, f = args
+    state = _parallel_fill_state
+
+    h = HistogramND.create(state['axes'])
+    h._fill_chunk(state['loader'](f))
+
+    partial = np.frombuffer(state['buf']).reshape(state['nslot'],2,-1)
+    partial[islot,0] = h._counts.ravel()
+    partial[islot,1] = h._var.ravel()
+
+    return islot
+
 class HistogramIterator(object):
     """Iterator class that can be used to loop over the bins of a
     one-dimensional histogram."""
@@ -693,7 +852,7 @@ class HistogramIterator(object):
 
         self._ibin += 1
 
-        if self._ibin == self._h.nbins:
+        if self._ibin == self._h.axis().nbins:
             raise StopIteration
         else:
             return self
@@ -730,6 +889,35 @@ class Axis(object):
         self._center = 0.5*(self._edges[1:] + self._edges[:-1])
         self._err = 0.5*(self._edges[1:] - self._edges[:-1])
         self._width = 2*self._err
+        self._init_binning()
+
+    def _init_binning(self):
+        """Classify the bin edges as uniform, log-uniform, or
+        irregular.  Uniform and log-uniform axes are binned with an
+        arithmetic index calculation in fillIndex."""
+
+        self._binning = None
+        self._bin_offset = 0.0
+        self._bin_scale = 1.0
+
+        delta = np.diff(self._edges)
+
+        if np.all(delta > 0) and np.allclose(delta,delta[0],rtol=1E-8,atol=0):
+            self._binning = 'lin'
+            self._bin_offset = self._edges[0]
+            self._bin_scale = 1./delta[0]
+        elif np.all(self._edges > 0) and np.all(delta > 0):
+            dlog = np.diff(np.log(self._edges))
+            if np.allclose(dlog,dlog[0],rtol=1E-8,atol=0):
+                self._binning = 'log'
+                self._bin_offset = np.log(self._edges[0])
+                self._bin_scale = 1./dlog[0]
+
+    def __setstate__(self,state):
+        """Restore an axis from a pickle.  Axes pickled before the
+        binning attributes were introduced are classified here."""
+        self.__dict__.update(state)
+        if not '_binning' in state: self._init_binning()
 
     @staticmethod
     def createFromDict(d):
@@ -812,6 +1000,38 @@ class Axis(object):
         ibin = np.digitize(np.array(x,ndmin=1),self._edges)-1
         return ibin
         
+    def fillIndex(self,x):
+        """Convert axis coordinate to bin index using the same
+        convention as np.histogram: bins are closed on the lower edge
+        and the last bin is also closed on the upper edge.  Values
+        outside the axis range are assigned an index of -1."""
+
+        x = np.asarray(x,dtype=float)
+        msk = (x >= self._xmin) & (x <= self._xmax)
+
+        if self._binning is None:
+            ibin = np.searchsorted(self._edges,x,side='right')-1
+            ibin[x == self._xmax] = self._nbins-1
+            ibin[~msk] = -1
+            return ibin
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if self._binning == 'log': t = np.log(x)
+            else: t = x.copy()
+
+            t -= self._bin_offset
+            t *= self._bin_scale
+
+        t[~msk] = 0
+        ibin = t.astype(int)
+        np.clip(ibin,0,self._nbins-1,out=ibin)
+
+        # Correct bin assignments affected by rounding at the bin edges
+        ibin -= (x < self._edges[ibin])
+        ibin += (x >= self._edges[ibin+1]) & (ibin < self._nbins-1)
+        ibin[~msk] = -1
+        return ibin
+
     def valToBinBounded(self,x):
         ibin = self.valToBin(x)
         ibin[ibin < 0] = 0
@@ -1373,7 +1593,7 @@ class Histogram(HistogramND):
         bins = [0]
         c = np.concatenate(([0],np.cumsum(self._counts)))
 
-        for ibin in range(self._axes[0].nbins+1):
+        for ibin in range(1,self._axes[0].nbins+1):
 
             nbin = ibin-bins[-1]            
             if not max_bins is None and nbin > max_bins:
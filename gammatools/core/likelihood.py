@@ -19,7 +19,7 @@ from util import expand_aliases, get_parameters
 from minuit import Minuit
 from parameter_set import Parameter, ParameterSet
 import matplotlib.pyplot as plt
-from model_fn import ParamFnBase, PDF
+from model_fn import ParamFnBase, PDF, param_rows
 
 class CompProdModel(PDF):
 
@@ -63,8 +63,7 @@ class CompositeParameter(ParamFnBase):
         self._expr = expr
 
     def eval(self,x,p=None):
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
         return eval(self._expr)
 
 class JointLnL(ParamFnBase):
@@ -81,8 +80,7 @@ class JointLnL(ParamFnBase):
 
     def eval(self,p=None):
 
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
 
         s = None
         for i, m in enumerate(self._lnlfn):
@@ -91,6 +89,19 @@ class JointLnL(ParamFnBase):
 
         return s
 
+    def has_grad(self):
+        return all([m.has_grad() for m in self._lnlfn])
+
+    def grad(self,p=None):
+
+        pset = self._param.overlay(p)
+
+        g = np.zeros(self.npar())
+        for m in self._lnlfn:
+            g[param_rows(self._param,m.param())] += m.grad(pset)
+
+        return g
+
 
 
 def chi2(y,var,fy,fvar=None):
@@ -114,8 +125,7 @@ class BinnedChi2Fn(ParamFnBase):
             
     def eval(self,p):
 
-        pset = self._model.param(True)
-        pset.update(p)
+        pset = self._model.param().overlay(p)
 
         fv = self._model.histogram(self._h.axis().edges,pset)
         v = chi2(self._h.counts,self._h.var,fv)
@@ -127,6 +137,23 @@ class BinnedChi2Fn(ParamFnBase):
 
         return s
 
+    def has_grad(self):
+        return self._model.has_grad()
+
+    def grad(self,p=None):
+
+        pset = self._model.param().overlay(p)
+
+        edges = self._h.axis().edges
+        fv = self._model.histogram(edges,pset)
+        dfv = self._model.histogram_grad(edges,pset)
+
+        var = self._h.var
+        ivar = np.zeros(shape=var.shape)
+        ivar[var>0] = 1./var[var>0]
+
+        return np.sum(-2*(self._h.counts-fv)*ivar*dfv,axis=-1)
+
 class Chi2Fn(ParamFnBase):
 
     def __init__(self,x,y,yerr,model):
@@ -141,8 +168,7 @@ class Chi2Fn(ParamFnBase):
             
     def eval(self,p):
 
-        pset = self._model.param(True)
-        pset.update(p)
+        pset = self._model.param().overlay(p)
 
         fv = self._model(self._x,pset)
 
@@ -157,6 +183,19 @@ class Chi2Fn(ParamFnBase):
 
         return s
 
+    def has_grad(self):
+        return self._model.has_grad()
+
+    def grad(self,p=None):
+
+        pset = self._model.param().overlay(p)
+
+        fv = self._model(self._x,pset)
+        dfv = self._model.grad(self._x,pset)
+
+        var = self._yerr**2
+        return np.sum(-2*(self._y-fv)/var*dfv,axis=-1)
+
 
 class Chi2HistFn(ParamFnBase):
 
@@ -171,8 +210,7 @@ class Chi2HistFn(ParamFnBase):
         
     def eval(self,p):
 
-        pset = self._model.param(True)
-        pset.update(p)
+        pset = self._model.param().overlay(p)
 
         fv = self._model.counts(pset)
         fvar = self._model.var(pset)
@@ -189,6 +227,26 @@ class Chi2HistFn(ParamFnBase):
         else:
             return np.sum(v)
 
+    def has_grad(self):
+        return self._model.has_grad()
+
+    def grad(self,p=None):
+
+        pset = self._model.param().overlay(p)
+
+        fv = self._model.counts(pset)
+        fvar = self._model.var(pset)
+        dfv = self._model.counts_grad(pset)
+        dfvar = self._model.var_grad(pset)
+
+        var = self._h.var + fvar
+        ivar = np.zeros(shape=var.shape)
+        ivar[var>0] = 1./var[var>0]
+
+        r = (self._h.counts-fv)*ivar
+        g = -2*r*dfv - r**2*dfvar
+        return np.sum(g.reshape(g.shape[:1] + (-1,)),axis=1)
+
 
 
         
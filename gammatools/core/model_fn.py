@@ -20,6 +20,22 @@ from minuit import Minuit
 from parameter_set import Parameter, ParameterSet
 import matplotlib.pyplot as plt
 
+def param_array(pset):
+    """Return the parameter values of a parameter set as an array
+    with shape (npar,) if the set has a single value per parameter
+    and (npar,nval,1) otherwise.  Indexing the result with a
+    parameter index gives an array that broadcasts against a 1D
+    array of evaluation points."""
+    a = pset.array()
+    if a.shape[1] > 1: return a[...,np.newaxis]
+    else: return a[:,0]
+
+def param_rows(pset,sub):
+    """Return the row indices in the parameter set pset of the
+    parameters in the set sub."""
+    pids = pset.pids()
+    return [pids.index(pid) for pid in sub.pids()]
+
 class ParamFnBase(object):
     """Base class for a parameterized function."""
 
@@ -52,13 +68,42 @@ class ParamFnBase(object):
         argument set is defined then return a copy of the model
         parameter set with values updated from this set."""
 
-        if make_copy: return copy.deepcopy(self._param)
+        if make_copy: return self._param.copy()
         else: return self._param
 
     def update(self,pset):
         """Update the parameters of this function."""
         self._param.update(pset)
 
+    def has_grad(self):
+        """Return True if this function implements an analytic
+        gradient."""
+        return False
+
+    def grad(self,p=None):
+        """Evaluate the gradient of this function with respect to
+        its parameters.  Returns an array with shape (npar,)."""
+        raise NotImplementedError('Analytic gradient not implemented '
+                                  'for %s.'%self.__class__.__name__)
+
+    def eval_batch(self,P):
+        """Evaluate this function for a set of parameter vectors.
+
+        Parameters
+        ----------
+        P : array_like
+            Array with shape (nsample,npar) where each row is a
+            vector of parameter values.
+
+        Returns
+        -------
+        v : `~numpy.ndarray`
+            Array with shape (nsample,).
+        """
+        P = np.array(P,ndmin=2,dtype=float)
+        pset = self._param.overlay(P.T)
+        return np.reshape(self.eval(pset),(P.shape[0],))
+
 class ParamFn(ParamFnBase):
 
     def __init__(self,fn,pset,name=None):
@@ -76,11 +121,13 @@ class ParamFn(ParamFnBase):
 
     def __call__(self,*args):
 
-        pset = self.param(True)
-        pset.update(*args)
+        pset = self._param.overlay(*args)
 
         return self._fn(*pset.list())
 
+    def eval(self,p=None):
+        return self.__call__(p)
+
 class PDF(ParamFnBase):    
     """Abstract base class for a probability distribution function.
     All derived classes must implement an _eval_pdf method which returns
@@ -97,17 +144,80 @@ class PDF(ParamFnBase):
 
     def eval(self,x,p=None):
         
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
 
         x = np.array(x,ndmin=1)
 
         return self._eval_pdf(x,pset)
+
+    def eval_batch(self,P,x):
+        """Evaluate this PDF for a set of parameter vectors.  Derived
+        classes broadcast the parameter values along a leading axis
+        (see param_array).
+
+        Parameters
+        ----------
+        P : array_like
+            Array with shape (nsample,npar) where each row is a
+            vector of parameter values.
+
+        x : array_like
+            Points at which the PDF is evaluated.
+
+        Returns
+        -------
+        v : `~numpy.ndarray`
+            Array with shape (nsample,) + the shape of the PDF
+            evaluated at x.
+        """
+
+        P = np.array(P,ndmin=2,dtype=float)
+        v = np.asarray(self.eval(x,self._param.overlay(P.T)))
+        if P.shape[0] == 1: v = v[np.newaxis,...]
+        return v
     
     @abc.abstractmethod
     def _eval_pdf(self,x,p):
         pass
 
+    def grad(self,x,p=None):
+        """Evaluate the derivatives of the PDF with respect to each
+        of its parameters.  Returns an array with shape (npar,) +
+        the shape of the PDF evaluated at x.  Derived classes that
+        implement _grad should also override has_grad."""
+
+        pset = self._param.overlay(p)
+        x = np.array(x,ndmin=1)
+        return self._grad(x,pset)
+
+    def _grad(self,x,pset):
+        raise NotImplementedError('Analytic gradient not implemented '
+                                  'for %s.'%self.__class__.__name__)
+
+    def integrate_grad(self,xlo,xhi,p=None):
+        """Evaluate the derivatives of the PDF integral with respect
+        to each of its parameters."""
+        
+        pset = self._param.overlay(p)
+
+        xlo = np.array(xlo,ndmin=1)
+        xhi = np.array(xhi,ndmin=1)
+
+        return self._integrate_grad(xlo,xhi,pset)
+
+    def _integrate_grad(self,xlo,xhi,pset):
+
+        w = xhi-xlo
+        xc = 0.5*(xhi+xlo)
+        return w*self._grad(xc,pset)
+
+    def histogram_grad(self,edges,p=None):
+        
+        pset = self._param.overlay(p)
+        edges = np.array(edges,ndmin=1)
+
+        return self._integrate_grad(edges[:-1],edges[1:],pset)
+
     def set_norm(self,norm,xlo,xhi):
 
         n = self.integrate(xlo,xhi)
@@ -117,8 +227,7 @@ class PDF(ParamFnBase):
 
     def integrate(self,xlo,xhi,p=None):
         
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
 
         xlo = np.array(xlo,ndmin=1)
         xhi = np.array(xhi,ndmin=1)
@@ -133,8 +242,7 @@ class PDF(ParamFnBase):
 
     def histogram(self,edges,p=None):
         
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
         edges = np.array(edges,ndmin=1)
 
         return self._integrate(edges[:-1],edges[1:],pset)
@@ -174,33 +282,46 @@ class ScaledHistogramModel(PDF):
 
     def var(self,p):
 
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
         
-        a = pset.array()
-        if a.shape[1] > 1: a = a[...,np.newaxis]        
+        a = param_array(pset)
         return a[0]**2*self._h.var
 
     def counts(self,p):
 
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
         
-        a = pset.array()
-        if a.shape[1] > 1: a = a[...,np.newaxis]        
+        a = param_array(pset)
         return a[0]*self._h.counts
     
+    def var_grad(self,p):
+
+        pset = self._param.overlay(p)
+        
+        a = param_array(pset)
+        return np.array([2*a[0]*self._h.var])
+
+    def counts_grad(self,p):
+        return np.array([self._h.counts])
+    
     def _eval_pdf(self,x,pset):
         
-        a = pset.array()
-        if a.shape[1] > 1: a = a[...,np.newaxis]        
+        a = param_array(pset)
         return a[0]*self._h.interpolate(x)
 
     def _integrate(self,xlo,xhi,pset):
         
-        a = pset.array()
-        if a.shape[1] > 1: a = a[...,np.newaxis]        
+        a = param_array(pset)
         return a[0]*self._h.counts
+
+    def has_grad(self):
+        return True
+
+    def _grad(self,x,pset):
+        return np.array([self._h.interpolate(x)])
+
+    def _integrate_grad(self,xlo,xhi,pset):
+        return np.array([self._h.counts])
     
 class ScaledModel(PDF):
     def __init__(self,model,pset,expr,name=None):
@@ -220,15 +341,13 @@ class ScaledModel(PDF):
         self._expr = expr
 
     def eval(self,x,p=None):
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
 
         if self._expr is None: return self._model.eval(x,pset)
         else: return self._model.eval(x,pset)*eval(self._expr)
 
     def integrate(self,xlo,xhi,p=None):        
-        pset = self.param(True)
-        pset.update(p)
+        pset = self._param.overlay(p)
 
         if self._expr is None: return self._model.integrate(xlo,xhi,pset)
         else: return self._model.integrate(xlo,xhi,pset)*eval(self._expr)
@@ -290,6 +409,35 @@ class CompositeSumModel(PDF):
             else: s += v
         return s
 
+    def has_grad(self):
+        return all([m.has_grad() for m in self._models])
+
+    def _sum_grad(self,fn):
+        """Sum the gradients of the component models.  fn is called
+        with each model and returns the gradient of that model."""
+
+        g = None
+        for m in self._models:
+
+            v = fn(m)
+            if g is None:
+                g = np.zeros((self.npar(),) + v.shape[1:])
+
+            g[param_rows(self._param,m.param())] += v
+        return g
+
+    def counts_grad(self,pset=None):
+        return self._sum_grad(lambda m: m.counts_grad(pset))
+
+    def var_grad(self,pset=None):
+        return self._sum_grad(lambda m: m.var_grad(pset))
+
+    def _grad(self,x,pset):
+        return self._sum_grad(lambda m: m.grad(x,pset))
+
+    def _integrate_grad(self,xlo,xhi,pset):
+        return self._sum_grad(lambda m: m.integrate_grad(xlo,xhi,pset))
+
     def histogramComponents(self,edges,p=None):
 
         hists = []
@@ -336,13 +484,25 @@ class GaussFn(PDF):
         return GaussFn(ParameterSet([p0,p1,p2]))
 
     def _eval_pdf(self,x,pset):
-        return self.evals(x,pset.array())
+        return self.evals(x,param_array(pset))
 
     @staticmethod
     def evals(x,a):
         sig2 = a[2]**2        
         return a[0]/np.sqrt(2.*np.pi*sig2)*np.exp(-(x-a[1])**2/(2.0*sig2))
 
+    def has_grad(self):
+        return True
+
+    def _grad(self,x,pset):
+
+        a = param_array(pset)
+        sig2 = a[2]**2
+        dx = x-a[1]
+        g = np.exp(-dx**2/(2.0*sig2))/np.sqrt(2.*np.pi*sig2)
+        f = a[0]*g
+        return np.array([g,f*dx/sig2,f*(dx**2/sig2-1.0)/a[2]])
+
 class Gauss2DProjFn(PDF):
 
     @staticmethod
@@ -354,13 +514,24 @@ class Gauss2DProjFn(PDF):
         return Gauss2DProjFn(ParameterSet([p0,p1]))
 
     def _eval_pdf(self,x,pset):
-        return self.evals(x,pset.array())
+        return self.evals(x,param_array(pset))
 
     @staticmethod
     def evals(x,a):
         sig2 = a[1]**2        
         return a[0]/(2.*np.pi*sig2)*np.exp(-x**2/(2.0*sig2))
 
+    def has_grad(self):
+        return True
+
+    def _grad(self,x,pset):
+
+        a = param_array(pset)
+        sig2 = a[1]**2
+        g = np.exp(-x**2/(2.0*sig2))/(2.*np.pi*sig2)
+        f = a[0]*g
+        return np.array([g,f*(x**2/sig2-2.0)/a[1]])
+
 class Gauss2DFn(PDF):
 
     @staticmethod
@@ -374,7 +545,7 @@ class Gauss2DFn(PDF):
         return Gauss2DFn(ParameterSet([p0,p1,p2,p3]))
 
     def _eval_pdf(self,x,pset):
-        return self.evals(x,pset.array())
+        return self.evals(x,param_array(pset))
 
     @staticmethod
     def evals(x,a):
@@ -383,6 +554,20 @@ class Gauss2DFn(PDF):
         dy = (x[1]-a[2])**2
         return a[0]/(2.*np.pi*sig2)*np.exp(-(dx+dy)/(2.0*sig2))
 
+    def has_grad(self):
+        return True
+
+    def _grad(self,x,pset):
+
+        a = param_array(pset)
+        sig2 = a[3]**2
+        dx = x[0]-a[1]
+        dy = x[1]-a[2]
+        r2 = dx**2+dy**2
+        g = np.exp(-r2/(2.0*sig2))/(2.*np.pi*sig2)
+        f = a[0]*g
+        return np.array([g,f*dx/sig2,f*dy/sig2,f*(r2/sig2-2.0)/a[3]])
+
     
 class SpectralModel(PDF):
 
@@ -402,7 +587,7 @@ class LogParabola(PDF):
         
     def _eval_pdf(self,x,pset):
 
-        a = pset.array()
+        a = param_array(pset)
         es = 10**(x-a[3])
         return 10**a[0]*np.power(es,-(a[1]+a[2]*np.log(es)))
 
@@ -423,7 +608,7 @@ class PowerLawExp(PDF):
         
     def _eval_pdf(self,x,pset):
 
-        a = pset.array()
+        a = param_array(pset)
         es = 10**(x-a[3])
         return 10**a[0]*np.power(es,-a[1])*np.exp(-10**(x-a[2]))
 
@@ -444,16 +629,22 @@ class PowerLaw(PDF):
 
     def _eval_pdf(self,x,pset):
 
-        a = pset.array()
+        a = param_array(pset)
         es = 10**(x-a[2])
         return 10**a[0]*np.power(es,-a[1])
 
-    def _integrate(self,xlo,xhi,p):
+    def has_grad(self):
+        return True
 
-        x = 0.5*(xhi+xlo)
-        dx = xhi-xlo
+    def _grad(self,x,pset):
 
-        a = pset.array()
+        a = param_array(pset)
+        f = self._eval_pdf(x,pset)*np.log(10.)
+        return np.array([f,-(x-a[2])*f,a[1]*f])
+
+    def _integrate(self,xlo,xhi,pset):
+
+        a = param_array(pset)
         
         norm = 10**a[0]
         gamma = a[1]
@@ -462,6 +653,23 @@ class PowerLaw(PDF):
         g1 = -gamma+1
         return norm/g1*10**(gamma*enorm)*(10**(xhi*g1) - 10**(xlo*g1))
 
+    def _integrate_grad(self,xlo,xhi,pset):
+
+        a = param_array(pset)
+        
+        norm = 10**a[0]
+        gamma = a[1]
+        enorm = a[2]
+
+        g1 = -gamma+1
+        c = norm/g1*10**(gamma*enorm)
+        v = c*(10**(xhi*g1) - 10**(xlo*g1))
+        dv = c*(xhi*10**(xhi*g1) - xlo*10**(xlo*g1))
+        ln10 = np.log(10.)
+        return np.array([ln10*v,
+                         (enorm*ln10 + 1./g1)*v - ln10*dv,
+                         gamma*ln10*v])
+
     @staticmethod
     def create(norm,gamma,eb,pset=None,name=None,prefix=''):
 
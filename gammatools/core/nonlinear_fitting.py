@@ -38,26 +38,26 @@ class MinuitFitter(object):
         self._maxcalls = 1000
 
     def rnd_scan(self,par_index=None,nscan=100,scale=1.3):
+        """Evaluate the objective function at nscan random parameter
+        vectors and return the parameter set with the lowest
+        objective value."""
 
-        pset = copy.copy(self._objfn.param())
-        p = pset.array()
+        pset = self._objfn.param(True)
+        p = pset.array()[:,0]
 
         if par_index is None: par_index = range(pset.npar())
 
-        prnd = np.ones((p.shape[0],nscan,1))
-        prnd *= p
+        prnd = np.ones((nscan,p.shape[0]))*p
 
         for i in par_index:
-            rnd = np.random.uniform(0.0,1.0,(nscan,1))
-            prnd[i] = p[i] - p[i]/scale + rnd*(scale*p[i] - (p[i] - p[i]/scale))
+            rnd = np.random.uniform(0.0,1.0,nscan)
+            prnd[:,i] = p[i] - p[i]/scale + rnd*(scale*p[i] - (p[i] - p[i]/scale))
 
-        lnl = self._objfn.eval(prnd)
+        lnl = self._objfn.eval_batch(prnd)
 
         imin = np.argmin(lnl)
 
-        pset.update(prnd[:,imin])
-
-        print self._objfn.eval(pset)
+        pset.update(prnd[imin])
 
         return pset
 
@@ -77,14 +77,11 @@ class MinuitFitter(object):
                 pset_fit = self.fit(pset)
                 fval.append(pset_fit.fval())
         else:
-            for p in pval:           
-                pset.setParByName(pname,p)
-
-                v = self._objfn.eval(pset)
 
-#                print p, v, pset.getParByName('agn_norm').value()
-
-                fval.append(v)
+            ipar = pset.pids().index(pset.getParByName(pname).pid)
+            P = np.ones((len(pval),pset.npar()))*pset.array()[:,0]
+            P[:,ipar] = pval
+            fval = self._objfn.eval_batch(P)
             
         return np.array(fval)
 
@@ -105,11 +102,15 @@ class MinuitFitter(object):
                             
         print pset.array()
 
+        kwargs = {}
+        if self._objfn.has_grad():
+            kwargs['gradient'] = lambda x: self._objfn.grad(x)
+
         minuit = Minuit(lambda x: self._objfn.eval(x),
                         pset.array(),fixed=fixed,limits=lims,
                         tolerance=self._tol,strategy=1,
                         printMode=-1,
-                        maxcalls=self._maxcalls)
+                        maxcalls=self._maxcalls,**kwargs)
         (pars,fval) = minuit.minimize()
 
         cov = minuit.errors()
@@ -182,8 +183,12 @@ class BFGSFitter(Configurable):
         bfgs_kwargs['bounds'] = bounds
         update_dict(bfgs_kwargs,kwargs)
 
-        res = fmin_bfgs(self._objfn,pset.array(),None,
-                        approx_grad=1,**bfgs_kwargs)#,factr=1./self._tol)
+        if self._objfn.has_grad():
+            res = fmin_bfgs(self._objfn,pset.array(),self._objfn.grad,
+                            approx_grad=0,**bfgs_kwargs)
+        else:
+            res = fmin_bfgs(self._objfn,pset.array(),None,
+                            approx_grad=1,**bfgs_kwargs)#,factr=1./self._tol)
 
         pset.update(res[0])        
         self._fit_results = FitResults(pset,res[1])
@@ -20,25 +20,45 @@ from util import expand_aliases, get_parameters
 class Parameter(object):
     """This class encapsulates a single function parameter that can
     take a single value or an array of values.  The parameter is
-    identified by a unique ID number and a name string."""
+    identified by a unique ID number and a name string.
+
+    A parameter is a view into the storage arrays of the
+    ParameterSet that contains it.  A parameter created directly
+    with this constructor is backed by its own single-parameter
+    set."""
+
+    __slots__ = ['_pset','_pid']
 
     def __init__(self,pid,value,name,fixed=False,lims=None):
+        self._pset = ParameterSet()
+        self._pset._add(pid,name,value,fixed,lims)
         self._pid = pid
-        self._name = name
-        self._value = np.array(value,ndmin=1)
-        self._err = 0
 
-        if lims is None: self._lims = [None,None]
-        else: self._lims = lims
-        self._fixed = fixed
+    @staticmethod
+    def _view(pset,pid):
+        p = Parameter.__new__(Parameter)
+        p._pset = pset
+        p._pid = pid
+        return p
+
+    def __getstate__(self):
+        return (self._pset,self._pid)
+
+    def __setstate__(self,state):
+        self._pset, self._pid = state
+
+    @property
+    def _row(self):
+        return self._pset._index[self._pid]
 
     @property
     def lims(self):
-        return self._lims
+        return [None if np.isnan(t) else t 
+                for t in self._pset._lims[self._row]]
         
     @property
     def name(self):
-        return self._name
+        return self._pset._pid_names[self._pid]
 
     @property
     def pid(self):
@@ -46,58 +66,129 @@ class Parameter(object):
 
     @property
     def value(self):
-        return self._value
+        return self._pset._values[self._row]
     
     @property
     def error(self):
-        return self._err
+        return self._pset._errors[self._row]
 
     def fix(self,fix=True):
-        self._fixed = fix
+        self._pset._fixed[self._row] = fix
 
     @property
     def fixed(self):
-        return self._fixed
+        return bool(self._pset._fixed[self._row])
 
     @property
     def size(self):
-        return self._value.shape[0]
+        return self._pset._values.shape[1]
 
     def set(self,v):
-        self._value = np.array(v,ndmin=1)
-#        if isinstance(v,np.array): self._value = v
-#        else: self._value[...] = v
+        self._pset._set_row(self._row,v)
 
     def setLoBound(self,v):
-        self._lims[0] = v
+        self._pset._lims[self._row,0] = np.nan if v is None else v
 
     def setHiBound(self,v):
-        self._lims[1] = v
+        self._pset._lims[self._row,1] = np.nan if v is None else v
 
     def __str__(self):
-        return '%5i %5i %25s %s'%(self._pid,self._fixed,self._name,
-                                  str(self._value.T))
+        return '%5i %5i %25s %s'%(self.pid,self.fixed,self.name,
+                                  str(self.value.T))
 
 class ParameterSet(object):
     """Class that stores a set of function parameters.  Each parameter
-    is identified by a unique integer parameter id."""
+    is identified by a unique integer parameter id.
+
+    The parameter values are stored in a single (npar,nval) array
+    ordered by parameter ID together with arrays of parameter
+    bounds, fix flags, and errors.  Parameters in the set are views
+    into this storage.  An overlay (see ParameterSet.overlay) is a
+    set that shares the parameter layout, bounds, and fix flags of
+    its parent but has its own array of values.  Overlays are used
+    to evaluate functions at a set of parameter values without
+    copying the parent set."""
 
     def __init__(self,pars=None):
 
-        self._pars_dict = {}
-        self._pars = []
+        self._pids = []
+        self._index = {}
+        self._pid_names = {}
         self._par_names = {}
+        self._values = np.zeros((0,1))
+        self._lims = np.zeros((0,2))
+        self._fixed = np.zeros(0,dtype=bool)
+        self._errors = np.zeros(0)
+        self._views = None
 
         if isinstance(pars,ParameterSet):
-            for p in pars: self.addParameter(p)
+            self._copy_from(pars)
         elif not pars is None:
             for p in pars: self.addParameter(p)
 
+    def _copy_from(self,pset):
+
+        # The layout objects are never modified in place and can be
+        # shared between sets
+        self._pids = pset._pids
+        self._index = pset._index
+        self._pid_names = pset._pid_names
+        self._par_names = pset._par_names
+        self._values = np.array(pset._values)
+        self._lims = np.array(pset._lims)
+        self._fixed = np.array(pset._fixed)
+        self._errors = np.array(pset._errors)
+        self._views = None
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        d['_views'] = None
+        return d
+
+    @property
+    def _pars(self):
+        """List of parameter views ordered by parameter ID."""
+        if self._views is None:
+            self._views = [Parameter._view(self,pid) for pid in self._pids]
+        return self._views
+
+    @property
+    def _pars_dict(self):
+        return dict(zip(self._pids,self._pars))
+
+    def copy(self):
+        """Return a copy of this parameter set."""
+        pset = ParameterSet.__new__(ParameterSet)
+        pset._copy_from(self)
+        return pset
+
+    def overlay(self,*args):
+        """Return a parameter set that shares the layout, bounds, and
+        fix flags of this set with values updated from the input
+        arguments.  The arguments are interpreted as in
+        ParameterSet.update."""
+
+        pset = ParameterSet.__new__(ParameterSet)
+        pset._pids = self._pids
+        pset._index = self._index
+        pset._pid_names = self._pid_names
+        pset._par_names = self._par_names
+        pset._values = self._values
+        pset._lims = self._lims
+        pset._fixed = self._fixed
+        pset._errors = self._errors
+        pset._views = None
+
+        pset._update(args,copy=True)
+        if pset._values is self._values: 
+            pset._values = np.array(self._values)
+        return pset
+
     def __iter__(self):
         return iter(self._pars)
 
     def pids(self):
-        return sorted(self._pars_dict.keys())
+        return list(self._pids)
     
     def names(self):
         """Return the names of the parameters in this set."""
@@ -105,71 +196,71 @@ class ParameterSet(object):
 
     def pid(self):
         """Return the sorted list of parameter IDs in this set."""
-        return sorted(self._pars_dict.keys())
+        return list(self._pids)
 
     def fixed(self):
-
-        fixed = []
-        for i, p in enumerate(self._pars):
-            fixed.append(p.fixed())
-        return fixed
+        """Return a list of the fix flags of all parameters."""
+        return [bool(t) for t in self._fixed]
 
     def array(self):
         """Return parameter set contents as NxM numpy array where N is
         the number of parameters and M is the number of parameter
         values."""
-
-#        if self._pars[pkeys[0]].size() > 1:
-        x = np.zeros((len(self._pars),self._pars[0].size))
-        for i, p in enumerate(self._pars):
-            x[i] = p.value
-
-        return x
+        return np.array(self._values)
 
     def list(self):
         """Return parameter set contents as list of arrays."""
-        v = []
-        for i, p in enumerate(self._pars):
-            v.append(p.value)
-        return v
+        return [v for v in self._values]
 
     def makeParameterArray(self,ipar,x):
 
-        pset = copy.deepcopy(self)
-
-        for i, p in enumerate(self._pars):
-            if i != ipar: 
-                pset[i].set(np.ones(len(x))*self._pars[i].value)
-            else:
-                pset[i].set(x)
-
+        x = np.array(x,ndmin=1)
+        pset = self.copy()
+        pset._values = np.ones((self.npar(),len(x)))*self._values[:,:1]
+        pset._values[ipar] = x
         return pset
 
     def clear(self):
 
-        self._pars.clear()
-        self._pars_dict.clear()
-        self._par_names.clear()
+        self._pids = []
+        self._index = {}
+        self._pid_names = {}
+        self._par_names = {}
+        self._values = np.zeros((0,1))
+        self._lims = np.zeros((0,2))
+        self._fixed = np.zeros(0,dtype=bool)
+        self._errors = np.zeros(0)
+        self._views = None
 
     def fix(self,ipar,fix=True):
-        self._pars[ipar].fix(fix)
+        self._fixed[ipar] = fix
 
     def fixAll(self,fix=True,regex=None):
         """Fix or free all parameters in the set."""
 
-        keys = []
-
         if not regex is None:            
             for k, v in self._par_names.iteritems():                
-                if re.search(regex,k): keys.append(v)
+                if re.search(regex,k): self._fixed[self._index[v]] = fix
         else:
-            keys = self._pars_dict.keys()
+            self._fixed[:] = fix
 
-        for k in keys: self._pars_dict[k].fix(fix)
+    def _resize(self,nval):
+        """Broadcast the parameter values to nval values per
+        parameter."""
+        if nval == self._values.shape[1]: return
+        elif self._values.shape[1] != 1:
+            raise Exception('Cannot broadcast parameter values with '
+                            'size %i to size %i.'%(self._values.shape[1],
+                                                   nval))
+        self._values = np.ones((len(self._pids),nval))*self._values
 
-    def update(self,*args):
-        """Update parameter values from an existing parameter set or from
-        a numpy array."""
+    def _set_row(self,i,v):
+
+        v = np.ravel(v)
+        if v.size > 1: self._resize(v.size)
+        self._values[i] = v
+
+    def _update(self,args,copy=False):
 
         if len(args) == 0: return
         elif len(args) == 1:
@@ -177,107 +268,141 @@ class ParameterSet(object):
             pset = args[0]
             if pset is None: return
             elif isinstance(pset,ParameterSet):
-                for p in pset:
-                    if p.pid in self._pars_dict:
-                        self._pars_dict[p.pid].set(p.value)
+
+                if pset._index is self._index:
+                    self._values = np.array(pset._values)
+                    return
+
+                rows = []
+                prows = []
+                for pid, j in pset._index.iteritems():
+                    if pid in self._index:
+                        rows.append(self._index[pid])
+                        prows.append(j)
+
+                if len(rows) == 0: return
+                v = pset._values[prows]
             else:
-                for i, p in enumerate(self._pars):
-                    self._pars[i].set(np.array(pset[i],ndmin=1))
+                rows = range(len(self._pids))
+                v = pset
         else:
 
-            if len(args) != len(self._pars):
+            if len(args) != len(self._pids):
                 raise Exception('Wrong number of arguments for parameter set.')
 
-            for i, p in enumerate(args):
-                self._pars[i].set(np.array(p,ndmin=1))
+            rows = range(len(self._pids))
+            v = args
+
+        if isinstance(v,np.ndarray) and v.ndim <= 2:
+            if v.shape[0] != len(rows):
+                raise Exception('Wrong number of values for parameter set.')
+            v = v.reshape((len(rows),-1))
+        else:
+            v = [np.ravel(t) for t in v]
+            nval = max([t.size for t in v])
+            v = np.vstack([np.ones(nval)*t for t in v])
 
+        if copy: self._values = np.array(self._values)
+        if v.shape[1] > 1: self._resize(v.shape[1])
+        self._values[rows] = v
+            
+    def update(self,*args):
+        """Update parameter values from an existing parameter set, from
+        a numpy array, or from a list of values for each parameter.
+        Returns this parameter set."""
+        self._update(args)
+        return self
+
+    def _add(self,pid,name,value,fixed=False,lims=None,error=0):
+        """Add a parameter to the storage arrays."""
+
+        if pid in self._index:
+            raise Exception('Parameter with ID %i already exists.'%pid)
+
+        value = np.ravel(np.array(value,dtype=float))
+        if lims is None: lims = [None,None]
+        lims = [np.nan if t is None else t for t in lims]
+
+        pids = sorted(self._pids + [pid])
+        i = pids.index(pid)
+
+        nval = self._values.shape[1]
+        if value.size > 1 and nval == 1: nval = value.size
+        elif value.size > 1 and value.size != nval and len(self._pids):
+            raise Exception('Cannot add parameter with %i values to a '
+                            'set with %i values.'%(value.size,nval))
+
+        values = np.ones((len(pids),nval))
+        values[:i] *= self._values[:i]
+        values[i] *= value
+        values[i+1:] *= self._values[i:]
+
+        self._values = values
+        self._lims = np.insert(self._lims,i,lims,axis=0)
+        self._fixed = np.insert(self._fixed,i,fixed)
+        self._errors = np.insert(self._errors,i,error)
+
+        self._pids = pids
+        self._index = dict([(k,j) for j, k in enumerate(pids)])
+        self._pid_names = dict(self._pid_names)
+        self._pid_names[pid] = name
+        self._par_names = dict(self._par_names)
+        self._par_names[name] = pid
+        self._views = None
 
     def createParameter(self,value,name=None,fixed=False,lims=None,pid=None):
         """Create a new parameter and add it to the set.  Returns a
         reference to the new parameter."""
 
         if pid is None:
-
-            if len(self._pars_dict.keys()) > 0:
-                pid = sorted(self._pars_dict.keys())[-1]+1
-            else:
-                pid = 0
+            if len(self._pids) > 0: pid = self._pids[-1]+1
+            else: pid = 0
 
         if name is None: name = 'p%i'%pid
 
-        p = Parameter(pid,value,name,fixed,lims)
-        self.addParameter(p)
-        return p
+        self._add(pid,name,value,fixed,lims)
+        return self.getParByID(pid)
 
     def addParameter(self,p):        
-
-        if p.pid in self._pars_dict.keys():
-            raise Exception('Parameter with ID %i already exists.'%p.pid)
-        elif p.pid in self._pars and p.name != self._pars[p.pid].name:
-            raise Exception('Parameter with name %s already exists.'%p.name)
-#            print "Error : Parameter already exists: ", p.pid
-#            print "Error : Mismatch in parameter name: ", p.pid
-#            sys.exit(1)
-#        if p.name in self._par_names.keys():
-#            print "Error : Parameter with name already exists: ", p.name
-#            sys.exit(1)
-
-        par = copy.deepcopy(p)
-
-        self._pars_dict[p.pid] = par
-#        self._pars.append(par)
-        self._pars = []
-        for k in sorted(self._pars_dict.keys()):
-            self._pars.append(self._pars_dict[k])
-
-        self._par_names[p.name] = p.pid
+        self._add(p.pid,p.name,p.value,p.fixed,p.lims,p.error)
 
     def addSet(self,pset): 
 
         for p in pset:
-            if not p.pid in self._pars_dict.keys():
+            if not p.pid in self._index:
                 self.addParameter(p)
 
     def __getitem__(self,ipar):
 
         if isinstance(ipar,str): 
-            return self._pars_dict[self._par_names[ipar]]
+            return Parameter._view(self,self._par_names[ipar])
         else: return self._pars[ipar]
 
-#    def __setitem__(self,pid,val):
-#        self._pars[pid] = val
-
     def getParByID(self,ipar):
-        return self._pars_dict[ipar]
+        if not ipar in self._index: raise KeyError(ipar)
+        return Parameter._view(self,ipar)
 
     def getParByIndex(self,ipar):
         return self._pars[ipar]
 
     def getParByName(self,name):
-        pid = self._par_names[name]
-        return self._pars_dict[pid]
+        return Parameter._view(self,self._par_names[name])
 
     def setParByName(self,name,val):
-        pid = self._par_names[name]
-        self._pars_dict[pid]._value = np.array(val,ndmin=2)
+        self._set_row(self._index[self._par_names[name]],val)
 
     def set(self,*args):
 
         for i, v in enumerate(args):
-            self._pars[i].set(v)
+            self._set_row(i,v)
 
     def npar(self):
-        return len(self._pars)
+        return len(self._pids)
 
     def size(self):
 
-        if len(self._pars) == 0: return 0
-        else: return self._pars[0].size()
-
-#    def set(self,p):
-#        """Set the parameter list from an array."""
-#        for i in range(len(p)):
-#            self._pars[i]._value = np.array(p[i])*np.ones(1)
+        if len(self._pids) == 0: return 0
+        else: return self._values.shape[1]
             
     def __str__(self):
 
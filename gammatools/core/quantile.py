@@ -10,30 +10,106 @@ import matplotlib.pyplot as plt
 from gammatools.core.histogram import Histogram
 from scipy.stats import norm
 
+def cumsum_quantile(edges,ncum,fraction=0.68,ntot=None):
+    """Find the value of x at which a set of cumulative distributions
+    first crosses a given fraction of their total.  Cumulative
+    distributions are linearly interpolated between the bin edges.
+
+    Parameters
+    ----------
+    edges : `~numpy.ndarray`
+       Array of bin edges with shape (nedge,).
+
+    ncum : `~numpy.ndarray`
+       Cumulative distributions evaluated at each edge with shape
+       (..., nedge).
+
+    fraction : float or `~numpy.ndarray`
+       Fraction or array of fractions of the total.
+
+    ntot : `~numpy.ndarray`
+       Normalization of each distribution.  Defaults to the value of
+       the cumulative distribution at the last edge.
+
+    Returns
+    -------
+    xq : `~numpy.ndarray`
+       Quantiles with shape fraction.shape + ncum.shape[:-1].
+       Distributions which do not cross the given fraction are set to
+       NaN.
+    """
+
+    edges = np.asarray(edges,dtype=float)
+    ncum = np.asarray(ncum,dtype=float)
+    fraction = np.asarray(fraction,dtype=float)
+    if ntot is None: ntot = ncum[...,-1]
+
+    target = fraction.reshape(fraction.shape + (1,)*(ncum.ndim-1))*ntot
+    shape = target.shape
+    
+    ncum = (ncum*np.ones(shape + (1,))).reshape((-1,ncum.shape[-1]))
+    target = np.ravel(target)
+    irow = np.arange(len(target))
+
+    above = ncum >= target[:,np.newaxis]
+    idx = np.argmax(above,axis=1)
+    found = above[irow,idx]
+
+    i1 = np.maximum(idx,1)
+    i0 = i1-1
+    c0 = ncum[irow,i0]
+    dc = ncum[irow,i1]-c0
+
+    w = (target-c0)/np.where(dc > 0,dc,1.0)
+    xq = edges[i0] + np.clip(w,0.0,1.0)*(edges[i1]-edges[i0])
+    xq[idx == 0] = edges[0]
+    xq[~found] = np.nan
+    return xq.reshape(shape)
+
+def _bootstrap_stats(xq):
+    """Return the mean and RMS of a set of bootstrap quantiles along
+    the last axis ignoring replicas with no solution."""
+    
+    msk = np.isfinite(xq)
+    n = np.sum(msk,axis=-1)
+    x = np.where(msk,xq,0.0)
+    xq_mean = np.sum(x,axis=-1)/n
+    xq_rms = np.sqrt(np.sum(np.where(msk,(xq-xq_mean[...,np.newaxis])**2,0.0),
+                            axis=-1)/n)
+    
+    if xq_mean.ndim == 0: return float(xq_mean), float(xq_rms)
+    return xq_mean, xq_rms
+
+def _random_state(seed=None):
+    """Return the np.random module, which draws from the global RNG,
+    or a new RandomState if seed is given."""
+    if seed is None: return np.random
+    return np.random.RandomState(seed)
+
 class HistBootstrap(object):
     def __init__(self,hist,fn):
 
         self._fn = fn
         self._hist = hist
-        self._x = np.array(hist.edges,copy=True)
+        self._x = np.array(hist.axis().edges,copy=True)
         self._ncounts = copy.copy(hist.counts)
 
-    def bootstrap(self,niter=1000,**kwargs):
+    def bootstrap(self,niter=1000,seed=None,**kwargs):
+        """Evaluate the mean and RMS of the user function over niter
+        Poisson replicas of the histogram.  Replicas are drawn in a
+        single pass but the function is evaluated for each replica in
+        turn since it takes a histogram argument."""
 
-        nbin = len(self._ncounts)
-        ncounts_tmp = np.zeros((nbin,niter))
-
-        for i in range(nbin):
-
-            if self._ncounts[i] > 0:
-                ncounts_tmp[i,:] += np.random.poisson(self._ncounts[i],niter)
+        rnd = _random_state(seed)
+        ncounts_tmp = rnd.poisson(np.maximum(self._ncounts,0),
+                                  (niter,) + self._ncounts.shape)
 
         fval = []
         for i in range(niter):
-            self._hist.counts = ncounts_tmp[:,i]
-            #fn = self._fn(self._hist)            
+            self._hist._counts = ncounts_tmp[i]
             fval.append(self._fn(self._hist,**kwargs))
 
+        self._hist._counts = copy.copy(self._ncounts)
             
         fval_mean = np.mean(np.array(fval))
         fval_rms = np.std(np.array(fval))
@@ -98,26 +174,28 @@ class HistQuantileBkgFn(object):
         return q
         
         
-    def bootstrap(self,fraction=0.68,niter=100,xmax=None):
-
-        nedge = len(self._ncounts[self._xedge<=xmax])
+    def bootstrap(self,fraction=0.68,niter=100,xmax=None,seed=None):
+        """Compute the mean and RMS of the quantile over niter Poisson
+        replicas of the counts and background normalization.  All
+        replicas are evaluated in a single array operation.  fraction
+        may be an array in which case arrays of mean and RMS with one
+        element per fraction are returned."""
+
+        if xmax is None: nedge = len(self._xedge)
+        else: nedge = len(self._ncounts[self._xedge<=xmax])
         xedge = self._xedge[:nedge]
         
+        rnd = _random_state(seed)
         h = Histogram.createHistModel(xedge,self._ncounts[1:nedge])
-        nbkg = np.random.poisson(self._nbkg,niter)
-        ncounts = np.random.poisson(np.concatenate(([0],h.counts)),
-                                    (niter,nedge))
-        
-        xq = []
-
-        for i in range(niter):
-            xq.append(self._quantile(nbkg[i],self._xedge[:nedge],
-                                     ncounts[i],fraction))
+        nbkg = rnd.poisson(self._nbkg,niter)
+        ncounts = rnd.poisson(np.concatenate(([0],h.counts)),
+                              (niter,nedge))
 
-        xq_mean = np.mean(np.array(xq))
-        xq_rms = np.std(np.array(xq))
+        nex_cum = np.cumsum(ncounts,axis=1)
+        nex_cum = nex_cum - self._bkg_fn(xedge)*nbkg[:,np.newaxis]
         
-        return xq_mean, xq_rms
+        xq = cumsum_quantile(xedge,nex_cum,fraction)
+        return _bootstrap_stats(xq)
 
 
 class HistGOF(object):
@@ -172,29 +250,25 @@ class HistQuantileOnOff(object):
         return self.binomial(self._non,self._noff,fraction)
 
 
-    def bootstrap(self,fraction=0.68,niter=1000,xmax=None):
+    def bootstrap(self,fraction=0.68,niter=1000,xmax=None,seed=None):
+        """Compute the mean and RMS of the quantile over niter Poisson
+        replicas of the on and off histograms.  All replicas are
+        evaluated in a single array operation.  fraction may be an
+        array in which case arrays of mean and RMS with one element
+        per fraction are returned."""
 
         nedge = len(self._non)
         hon = Histogram.createHistModel(self._axis.edges,self._non[1:])
         hoff = Histogram.createHistModel(self._axis.edges,self._noff[1:])
 
-        non = np.random.poisson(np.concatenate(([0],hon.counts)),
-                                (niter,nedge))
-        noff = np.random.poisson(np.concatenate(([0],hoff.counts)),
-                                 (niter,nedge))
-
-        xq = []
-
-        for i in range(niter):
-
-            xq.append(self._quantile(non[i],noff[i],fraction))
-
-            
-
-        xq_mean = np.mean(np.array(xq))
-        xq_rms = np.std(np.array(xq))
+        rnd = _random_state(seed)
+        non = rnd.poisson(np.concatenate(([0],hon.counts)),(niter,nedge))
+        noff = rnd.poisson(np.concatenate(([0],hoff.counts)),(niter,nedge))
 
-        return xq_mean, xq_rms
+        nex_cum = np.cumsum(non,axis=1) - self._alpha*np.cumsum(noff,axis=1)
+        
+        xq = cumsum_quantile(self._axis.edges,nex_cum,fraction)
+        return _bootstrap_stats(xq)
 
     def quantile(self,fraction=0.68):
         return self._quantile(self._non,self._noff,fraction)
@@ -268,7 +342,7 @@ class HistQuantile(object):
     def __init__(self,hist):
 
         self._h = copy.deepcopy(hist)
-        self._x = np.array(hist.edges,copy=True)
+        self._x = np.array(hist.axis().edges,copy=True)
         self._ncounts = copy.copy(hist.counts)
         self._ncounts = np.concatenate(([0],self._ncounts))
 
@@ -286,20 +360,14 @@ class HistQuantile(object):
             sys.exit(1)
 
 
-    def bootstrap(self,fraction=0.68,niter=1000):
+    def bootstrap(self,fraction=0.68,niter=1000,seed=None):
 
         nbin = len(self._ncounts)
-        ncounts_tmp = np.random.poisson(self._ncounts,(niter,nbin))
-       
-        xq = []
-        for i in range(niter):
-            xq.append(HistQuantile.array_quantile(self._x,
-                                                  ncounts_tmp[i],fraction))
-
-        xq_mean = np.mean(np.array(xq))
-        xq_rms = np.std(np.array(xq))
+        rnd = _random_state(seed)
+        ncounts_tmp = rnd.poisson(self._ncounts,(niter,nbin))
 
-        return xq_mean, xq_rms
+        xq = cumsum_quantile(self._x,np.cumsum(ncounts_tmp,axis=1),fraction)
+        return _bootstrap_stats(xq)
 
     @staticmethod
     def quantile(h,fraction=0.68):
@@ -68,45 +68,206 @@ class OnOffExperiment(object):
         else: self._alpha = None
         self._data_axes = [0]
 
-    def mc_ts(self,mu,ntrial):
-        """Simulate a set of TS values."""
+    def mc_ts(self,mu,ntrial,chunk_size=100000,**kwargs):
+        """Simulate a set of TS values.  Trials are generated and
+        fit in chunks of chunk_size (see mc_ts_iter).
 
-        shape = (ntrial,len(self._mus))
+        Parameters
+        ----------
+        mu : float
+           Signal strength parameter used to generate the trials.
+
+        ntrial : int
+           Number of trials.
+
+        Returns
+        -------
+        ts : `~numpy.ndarray`
+           Array of TS values with shape (ntrial,).
+        """
+
+        return np.concatenate([ts for ts in 
+                               self.mc_ts_iter(mu,ntrial,chunk_size,
+                                               **kwargs)])
+
+    def mc_ts_iter(self,mu,ntrial,chunk_size=100000,**kwargs):
+        """Generator that simulates TS values in chunks of at most
+        chunk_size trials.  This can be used to accumulate the TS
+        distribution of a large number of trials without holding
+        all of the simulated counts in memory.
+
+        Each chunk is fit in a single pass: the null hypothesis has a
+        closed-form solution and the signal hypothesis is fit with
+        vectorized Newton iterations.  Keyword arguments are passed
+        to fit_signal.
+        """
+
+        nsim = 0
+        while nsim < ntrial:
+            n = min(chunk_size,ntrial-nsim)
+            yield self._mc_ts_chunk(mu,n,**kwargs)
+            nsim += n
+
+    def _mc_ts_chunk(self,mu,ntrial,**kwargs):
+
+        nbin = len(self._mus)
+
+        # Expected counts in signal region followed by the control
+        # region.  The counts of each trial are drawn together so that
+        # the simulated trials do not depend on the chunk size.
+        lam = self._mus*mu+self._mub
+        if self._alpha is not None:
+            lam = np.append(lam,np.sum(self._mub)/self._alpha)
+
+        n = np.random.poisson(lam,(ntrial,len(lam))).T
+        n = np.array(n,dtype='float')
+        ns = n[:nbin]
+
+        if self._alpha is None: nc = np.zeros((1,ntrial))
+        else: nc = n[nbin:]
+
+        xs, ys = self.fit_signal(ns,nc,**kwargs)
+        y0 = self.fit_null(ns,nc)
+
+        ts = OnOffExperiment.ts(ns,nc,
+                                xs*self._mus[:,np.newaxis],
+                                ys*self._mub[:,np.newaxis],
+                                y0*self._mub[:,np.newaxis],
+                                self._alpha)
+        
+        return np.maximum(ts,0)
 
-        ns = np.random.poisson(self._mus*mu,shape).T
-        nb = np.random.poisson(self._mub,shape).T
-        nc = np.random.poisson(np.sum(self._mub)/self._alpha,(ntrial,1)).T
+    def fit_null(self,ns,nc,ymin=0.01):
+        """Compute the MLE of the background normalization under the
+        null hypothesis for a set of trials.
 
-        ns = np.array(ns,dtype='float')
-        nb = np.array(nb,dtype='float')
-        nc = np.array(nc,dtype='float')
+        Parameters
+        ----------
+        ns : `~numpy.ndarray`
+           Counts in the signal region with shape (nbin,ntrial).
 
-        tsv = []
+        nc : `~numpy.ndarray`
+           Counts in the control region with shape (1,ntrial).
+        """
 
-        for i in range(ntrial):
+        if self._alpha is None: return np.ones(ns.shape[1])
 
-            # Fit for signal lnl
-            fn0 = lambda x,y: -OnOffExperiment.lnl_signal(ns[:,i]+nb[:,i],nc[:,i],
-                                                         x*self._mus,y*self._mub,
-                                                         self._alpha)
+        alpha = self._alpha[0]
+        y = (np.sum(ns,axis=0)+nc[0])*alpha/((1+alpha)*np.sum(self._mub))
+        return np.maximum(y,ymin)
 
-            # Fit for signal null lnl
-            fn1 = lambda x: -OnOffExperiment.lnl_null(ns[:,i]+nb[:,i],nc[:,i],
-                                                      x*self._mub,self._alpha)
+    def fit_signal(self,ns,nc,xmin=0.01,ymin=0.01,niter=50,tol=1E-8):
+        """Compute the MLE of the signal and background
+        normalizations under the signal hypothesis for a set of
+        trials with vectorized Newton iterations.  Each step is
+        halved until the likelihood increases and parameters at a
+        lower bound with a gradient pointing out of the allowed
+        region are held fixed.
 
-            p0 = BFGSFitter.fit(fn0,[1.0,1.0],bounds=[[0.01,None],[0.01,None]])
-            p1 = BFGSFitter.fit(fn1,[1.0],bounds=[[0.01,None]])
+        Parameters
+        ----------
+        ns : `~numpy.ndarray`
+           Counts in the signal region with shape (nbin,ntrial).
 
-            ts = OnOffExperiment.ts(ns[:,i]+nb[:,i],nc[:,i],
-                                    p0[0].value*self._mus,
-                                    p0[1].value*self._mub,
-                                    p1[0].value*self._mub,
-                                    self._alpha)
-                                 
-            ts = max(ts,0)
-            tsv.append(ts)
+        nc : `~numpy.ndarray`
+           Counts in the control region with shape (1,ntrial).
 
-        return np.array(tsv)
+        Returns
+        -------
+        x, y : `~numpy.ndarray`
+           Signal and background normalizations.
+        """
+        
+        s = self._mus[:,np.newaxis]
+        b = self._mub[:,np.newaxis]
+        S = np.sum(self._mus)
+        B = np.sum(self._mub)
+        N = np.sum(ns,axis=0)
+        nc = nc[0]
+
+        if self._alpha is None:
+            fit_bkg = False
+            alpha = 1.0
+        else:
+            fit_bkg = True
+            alpha = self._alpha[0]
+
+        def lnl(x,y,ns,nc):
+            m = x*s+y*b
+            v = np.sum(ns*np.log(np.where(ns>0,m,1.0)),axis=0) - x*S
+            if fit_bkg: v += nc*np.log(y) - y*B*(1.+1./alpha)
+            return v
+
+        # Initialize from the null fit
+        y = self.fit_null(ns,nc[np.newaxis,:],ymin)
+        x = np.maximum((N-B*y)/S,xmin)
+        f = lnl(x,y,ns,nc)
+
+        # Indices of trials that have not converged
+        act = np.arange(len(x))
+        
+        for i in range(niter):
+
+            xa, ya, fa = x[act], y[act], f[act]
+            nsa, nca = ns[:,act], nc[act]
+
+            m = xa*s+ya*b
+            w = nsa/(m*m)
+
+            gx = np.sum(nsa*s/m,axis=0) - S
+            hxx = -np.sum(w*s*s,axis=0)
+
+            if fit_bkg:
+                gy = np.sum(nsa*b/m,axis=0) + nca/ya - B*(1.+1./alpha)
+                hxy = -np.sum(w*s*b,axis=0)
+                hyy = -np.sum(w*b*b,axis=0) - nca/(ya*ya)
+            else:
+                gy = hxy = np.zeros_like(xa)
+                hyy = -np.ones_like(xa)
+
+            hxx = np.minimum(hxx,-1E-12)
+            hyy = np.minimum(hyy,-1E-12)
+
+            det = hxx*hyy-hxy*hxy
+            dx = -(hyy*gx-hxy*gy)/det
+            dy = -(hxx*gy-hxy*gx)/det
+                
+            # Hold parameters at their lower bound fixed
+            xfix = (xa <= xmin) & (gx < 0)
+            yfix = (ya <= ymin) & (gy < 0)
+            dx[xfix] = 0
+            dy[xfix] = -gy[xfix]/hyy[xfix]
+            dy[yfix] = 0
+            dx[yfix] = -gx[yfix]/hxx[yfix]
+            dx[xfix & yfix] = 0
+            
+            # Halve the step until the likelihood does not decrease
+            t = np.ones_like(xa)
+            xt = np.maximum(xa+dx,xmin)
+            yt = np.maximum(ya+dy,ymin)
+            ft = lnl(xt,yt,nsa,nca)
+            bad = ft < fa
+
+            for j in range(30):
+                if not np.any(bad): break
+                t[bad] *= 0.5
+                xt[bad] = np.maximum(xa[bad]+t[bad]*dx[bad],xmin)
+                yt[bad] = np.maximum(ya[bad]+t[bad]*dy[bad],ymin)
+                ft[bad] = lnl(xt[bad],yt[bad],nsa[:,bad],nca[bad])
+                bad[bad] = ft[bad] < fa[bad]
+
+            xt[bad] = xa[bad]
+            yt[bad] = ya[bad]
+            ft[bad] = fa[bad]
+
+            x[act], y[act], f[act] = xt, yt, ft
+
+            conv = ((np.abs(xt-xa) <= tol*np.maximum(xt,1.0)) &
+                    (np.abs(yt-ya) <= tol*np.maximum(yt,1.0)))
+            act = act[~conv]
+            if len(act) == 0: break
+
+        return x, y
 
     def asimov_mu_ts0(self,ts):
         """Return the value of the signal strength parameter for which
@@ -0,0 +1,11 @@
+import numpy as np
+
+def num_grad(fn,p,eps=1E-6):
+    """Evaluate the gradient of fn at p with central differences."""
+    p = np.array(p,dtype=float)
+    g = []
+    for i in range(len(p)):
+        dp = np.zeros(len(p))
+        dp[i] = eps*max(abs(p[i]),1.0)
+        g.append((fn(p+dp)-fn(p-dp))/(2*dp[i]))
+    return np.array(g)
@@ -0,0 +1,55 @@
+import os
+import unittest
+import tempfile
+import shutil
+import numpy as np
+from numpy.testing import assert_array_equal
+from gammatools.core.column_store import ColumnStore
+
+class TestColumnStore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def test_column_store(self):
+
+        path = os.path.join(self._tmpdir,'data')
+        store = ColumnStore.create(path,[('energy','f8'),('event_class','i4')])
+
+        self.assertTrue(ColumnStore.is_store(path))
+        self.assertEqual(store.nrow,0)
+        self.assertEqual(len(store.read('energy')),0)
+        
+        energy = []
+        event_class = []
+        for i in range(5):
+
+            e = np.random.uniform(0,1,100*(i+1))
+            c = np.arange(len(e))
+            energy.append(e)
+            event_class.append(c)
+            store.append({'energy' : e, 'event_class' : c})
+
+            # Columns are valid npy files after every append
+            v = np.load(store.column_path('energy'))
+            assert_array_equal(v,np.concatenate(energy))
+            
+        store = ColumnStore(path)
+        self.assertEqual(store.nrow,1500)
+        self.assertEqual(sorted(store.columns()),['energy','event_class'])
+
+        d = store.load(['event_class'])
+        self.assertEqual(d.keys(),['event_class'])
+        self.assertTrue(isinstance(d['event_class'],np.memmap))
+        self.assertEqual(d['event_class'].dtype,np.dtype('i4'))
+        assert_array_equal(d['event_class'],np.concatenate(event_class))
+        assert_array_equal(store.read('energy'),np.concatenate(energy))
+
+        self.assertRaises(ValueError,store.append,{'energy' : [1.0]})
+        self.assertRaises(ValueError,store.append,{'energy' : [1.0],
+                                                   'event_class' : [1,2]})
+        self.assertRaises(KeyError,store.read,'time')
+        self.assertEqual(ColumnStore(path).nrow,1500)
@@ -1,8 +1,16 @@
 import unittest
+import copy
 import numpy as np
 from numpy.testing import assert_array_equal, assert_almost_equal
 from gammatools.core.histogram import *
 
+def load_test_data(seed):
+    """Generate a block of random 2D coordinates and weights."""
+    rnd = np.random.RandomState(seed)
+    x = rnd.uniform(-0.1,1.1,1000)
+    y = np.power(10,rnd.uniform(-0.1,1.1,1000))
+    w = rnd.uniform(0,1,1000)
+    return x, y, w, w**2
 
 class TestHistogram(unittest.TestCase):
 
@@ -252,6 +260,124 @@ class TestHistogram(unittest.TestCase):
         assert (h.overflow()==np.sum(xv_shift>=1.0))
         assert (h.underflow()==np.sum(xv_shift<0.0))
 
+    def test_histogramnd_fill(self):
+
+        axes = [Axis(np.linspace(-1,1,11)),
+                Axis(np.logspace(0,2,9)),
+                Axis(np.array([0.0,0.1,0.5,0.7,1.0]))]
+
+        edges = [ax.edges for ax in axes]
+
+        np.random.seed(1)
+        npts = 1000
+        z = np.vstack((np.random.uniform(-1.2,1.2,npts),
+                       np.power(10,np.random.uniform(-0.2,2.2,npts)),
+                       np.random.uniform(-0.1,1.1,npts)))
+
+        # Include points on the bin edges
+        z = np.hstack((z,np.vstack((axes[0].edges[:5],
+                                    axes[1].edges[:5],
+                                    axes[2].edges))))
+
+        w = np.random.uniform(0,1,z.shape[1])
+        v = w**2
+
+        h = HistogramND(axes)
+        h.fill(z)
+
+        c = np.histogramdd(z.T,bins=edges)[0]
+        assert_array_equal(h.counts,c)
+        assert_array_equal(h.var,c)
+
+        h.clear()
+        h.fill(z,2.0,3.0)
+        assert_array_equal(h.counts,2.0*c)
+        assert_array_equal(h.var,3.0*c)
+
+        h.clear()
+        h.fill(z,w,v)
+        assert_array_equal(h.counts,np.histogramdd(z.T,bins=edges,
+                                                   weights=w)[0])
+        assert_array_equal(h.var,np.histogramdd(z.T,bins=edges,
+                                                weights=v)[0])
+
+    def test_histogram_fill_unpickled(self):
+
+        import pickle
+
+        axes = [Axis(np.linspace(-1,1,11)),
+                Axis(np.logspace(0,2,9)),
+                Axis(np.array([0.0,0.1,0.5,0.7,1.0]))]
+
+        np.random.seed(1)
+        z = np.vstack((np.random.uniform(-1.2,1.2,100),
+                       np.power(10,np.random.uniform(-0.2,2.2,100)),
+                       np.random.uniform(-0.1,1.1,100)))
+
+        h0 = HistogramND(axes)
+        h0.fill(z)
+
+        # Axes pickled without the binning attributes
+        h = HistogramND(axes)
+        h._axes = [copy.copy(ax) for ax in axes]
+        for ax in h._axes:
+            del ax._binning, ax._bin_offset, ax._bin_scale
+
+        for protocol in [0,2]:
+            h1 = pickle.loads(pickle.dumps(h,protocol))
+            for ax0, ax1 in zip(axes,h1._axes):
+                self.assertEqual(ax1._binning,ax0._binning)
+            h1.fill(z)
+            assert_array_equal(h1.counts,h0.counts)
+
+    def test_histogram_fill_from_iter(self):
+
+        np.random.seed(1)
+        x = np.random.uniform(-0.1,1.1,1000)
+        y = np.random.uniform(-0.1,1.1,1000)
+        w = np.random.uniform(0,1,1000)
+        data = { 'x' : x, 'y' : y, 'w' : w }
+
+        h0 = Histogram(np.linspace(0,1,11))
+        h0.fill(x,w)
+
+        h1 = Histogram(np.linspace(0,1,11))
+        nchunk = h1.fill_from_iter(iter_chunks(data,['x','w'],chunk_size=300))
+
+        self.assertEqual(nchunk,4)
+        assert_almost_equal(h1.counts,h0.counts)
+        assert_almost_equal(h1.var,h0.var)
+
+        h0 = Histogram2D(np.linspace(0,1,6),np.linspace(0,1,11))
+        h0.fill(x,y,w)
+
+        h1 = Histogram2D(np.linspace(0,1,6),np.linspace(0,1,11))
+        h1.fill_from_iter(iter_chunks(data,['x','y','w'],chunk_size=300))
+
+        assert_almost_equal(h1.counts,h0.counts)
+        assert_almost_equal(h1.var,h0.var)
+
+        h2 = HistogramND(h0.axes())
+        h2.fill_from_iter(np.vstack((x[i:i+100],y[i:i+100]))
+                          for i in range(0,1000,100))
+        c = np.histogram2d(x,y,bins=[h0.xaxis().edges,h0.yaxis().edges])[0]
+        assert_almost_equal(h2.counts,c)
+
+    def test_histogram_parallel_fill(self):
+
+        axes = [Axis(np.linspace(0,1,11)),Axis(np.logspace(0,1,6))]
+        files = range(7)
+
+        h0 = HistogramND.create(axes)
+        for f in files: h0.fill(*load_test_data(f))
+
+        for workers in [1,3]:
+            h1 = HistogramND.create(axes)
+            h1.parallel_fill(files,load_test_data,workers=workers,nslot=4)
+
+            assert_array_equal(h1.counts,h0.counts)
+            assert_array_equal(h1.var,h0.var)
+
     def test_histogram_rebin(self):
 
         h = Histogram(np.linspace(0,1,6))
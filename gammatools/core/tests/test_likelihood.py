@@ -6,6 +6,7 @@ from gammatools.core.likelihood import *
 from gammatools.core.nonlinear_fitting import *
 from gammatools.core.model_fn import *
 from gammatools.core.histogram import *
+from gammatools.core.tests.grad_util import num_grad
 
 
 def setup_gauss_test():
@@ -60,6 +61,45 @@ class TestLikelihood(unittest.TestCase):
         self.assertEqual(pset[1].value,2.0)
 
 
+    def test_parameter_set_overlay(self):
+
+        import cPickle as pickle
+
+        pset = ParameterSet()
+        p0 = pset.createParameter(3.0,'p0')
+        p1 = pset.createParameter(2.0,'p1',lims=[0.0,None])
+        pset.createParameter(1.0,'p2',pid=5)
+
+        # Parameters are views into the set storage
+        p0.set(4.0)
+        self.assertEqual(pset['p0'].value,4.0)
+        pset.update([1.0,2.5,0.5])
+        self.assertEqual(p1.value,2.5)
+        self.assertEqual(p1.lims,[0.0,None])
+
+        # Overlay values do not modify the parent set
+        po = pset.overlay(np.array([[1.0,2.0],[3.0,4.0],[5.0,6.0]]))
+        assert_array_equal(po.array(),[[1.0,2.0],[3.0,4.0],[5.0,6.0]])
+        assert_array_equal(pset.array(),[[1.0],[2.5],[0.5]])
+        self.assertEqual(po.size(),2)
+        self.assertEqual(pset.size(),1)
+
+        # Overlay from a set with a different layout
+        pset2 = ParameterSet()
+        pset2.createParameter(7.0,'q0',pid=5)
+        pset2.createParameter(8.0,'q1',pid=6)
+        assert_array_equal(pset.overlay(pset2).array(),
+                           [[1.0],[2.5],[7.0]])
+
+        # Overlay shares fix flags with the parent set
+        pset.fix(1)
+        self.assertEqual(po.fixed(),[False,True,False])
+        self.assertEqual(pset.copy().fixed(),[False,True,False])
+
+        p = pickle.loads(pickle.dumps(pset,0))
+        assert_array_equal(p.array(),pset.array())
+        self.assertEqual(p['p1'].name,'p1')
+
     def test_parameter_set_merge(self):
 
         par0 = Parameter(0,3.0,'par0')
@@ -88,6 +128,85 @@ class TestLikelihood(unittest.TestCase):
                             fni(2.0,a2)-fni(0.0,a2))
 
 
+    def test_eval_batch(self):
+
+        np.random.seed(1)
+        x = np.linspace(-1.0,1.0,20)
+
+        pset = ParameterSet()
+        fn0 = GaussFn.create(100.0,0.0,0.1,pset)
+        fn1 = PolyFn.create(3,[3.0,-1.0,2.0])
+        fn2 = LogParabola.create(1.0,2.0,0.1,10.0)
+
+        for fn in [fn0,fn1,fn2]:
+
+            P = fn.param().array()[:,0]*np.random.uniform(0.5,1.5,(5,fn.npar()))
+            v = fn.eval_batch(P,x)
+            self.assertEqual(v.shape,(5,len(x)))
+            for i in range(5): assert_almost_equal(v[i],fn.eval(x,P[i]))
+            assert_almost_equal(fn.eval_batch(P[:1],x)[0],fn.eval(x,P[0]))
+
+        h, fn = setup_gauss_test()
+        m0 = ScaledHistogramModel.create(h,pset=pset,name='m0')
+        m1 = ScaledHistogramModel.create(h*0.5,pset=pset,name='m1')
+        msum = CompositeSumModel([m0,m1])
+        
+        for objfn in [Chi2HistFn(h,msum),BinnedChi2Fn(h,fn),
+                      ParamFn.create(lambda a, b: a**2+b,[1.0,2.0])]:
+
+            P = np.random.uniform(0.5,1.5,(10,objfn.npar()))
+            v = objfn.eval_batch(P)
+            self.assertEqual(v.shape,(10,))
+            for i in range(10): assert_almost_equal(v[i],objfn.eval(P[i]))
+
+    def test_model_grad(self):
+
+        x = np.linspace(-1.0,1.0,7)
+        xy = np.vstack((x,x[::-1]+0.2))
+        edges = np.linspace(0.5,2.0,5)
+
+        fn0 = GaussFn.create(100.0,0.1,0.3)
+        fn1 = Gauss2DFn.create(2.0,0.1,-0.2,0.4)
+        fn2 = Gauss2DProjFn.create(2.0,0.4)
+        fn3 = PowerLaw.create(1E-3,2.2,10.)
+
+        for fn, xv in [(fn0,x),(fn1,xy),(fn2,x),(fn3,edges)]:
+
+            p = fn.param().array()[:,0]
+            self.assertTrue(fn.has_grad())
+            assert_almost_equal(fn.grad(xv,p)/fn.eval(xv,p),
+                                num_grad(lambda t: fn.eval(xv,t),p)/
+                                fn.eval(xv,p),5)
+
+        p = fn3.param().array()[:,0]
+        f = lambda t: fn3.histogram(edges,t)
+        assert_almost_equal(fn3.histogram_grad(edges,p)/f(p),
+                            num_grad(f,p)/f(p),5)
+
+    def test_objfn_grad(self):
+
+        h, fn = setup_gauss_test()
+        pset = ParameterSet()
+        m0 = ScaledHistogramModel.create(h,pset=pset,name='m0')
+        m1 = ScaledHistogramModel.create(h*0.5+1.0,pset=pset,name='m1')
+        msum = CompositeSumModel([m0,m1])
+
+        x = h.axis().center
+        y = fn(x)*1.1
+        
+        for objfn in [Chi2HistFn(h,msum),BinnedChi2Fn(h,fn),
+                      Chi2Fn(x[y>1],y[y>1],np.sqrt(y[y>1]),fn),
+                      JointLnL([Chi2HistFn(h*1.2,m0),
+                                Chi2HistFn(h,msum)])]:
+
+            self.assertTrue(objfn.has_grad())
+            p = objfn.param().array()[:,0]*1.05
+            g = num_grad(objfn.eval,p)
+            assert_almost_equal(objfn.grad(p)/np.abs(g).max(),
+                                g/np.abs(g).max(),5)
+
+        self.assertFalse(ParamFn.create(lambda a: a**2,[1.0]).has_grad())
+
     def test_binned_polyfn_fit(self):
 
         np.random.seed(1)
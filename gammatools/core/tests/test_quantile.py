@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal, assert_almost_equal
+from gammatools.core.quantile import *
+from gammatools.core.histogram import Histogram
+
+
+class TestQuantile(unittest.TestCase):
+
+    def test_cumsum_quantile(self):
+
+        edges = np.linspace(0.0,4.0,5)
+        ncum = np.array([[0.0,1.0,2.0,3.0,4.0],
+                         [0.0,4.0,4.0,4.0,4.0],
+                         [0.0,-1.0,-2.0,-3.0,-4.0]])
+
+        xq = cumsum_quantile(edges,ncum,0.5)
+        assert_almost_equal(xq,[2.0,0.5,0.0])
+
+        xq = cumsum_quantile(edges,ncum,[0.25,0.5])
+        self.assertEqual(xq.shape,(2,3))
+        assert_almost_equal(xq[:,0],[1.0,2.0])
+
+        # Non-monotonic distribution returns the first crossing
+        xq = cumsum_quantile(edges,[0.0,3.0,1.0,3.0,2.0],0.75)
+        assert_almost_equal(xq,0.5)
+
+        # No crossing
+        self.assertTrue(np.isnan(cumsum_quantile(edges,ncum[0],0.5,
+                                                 ntot=10.)))
+        
+    def test_hist_quantile_bootstrap(self):
+
+        np.random.seed(1)
+        
+        edges = np.linspace(0,3,61)
+        xs = np.sqrt(np.sum(np.random.normal(0,0.3,(2000,2))**2,axis=1))
+        xb = np.sqrt(np.random.uniform(0,9,3000))
+        hon = Histogram(edges)
+        hon.fill(np.concatenate((xs,xb[:1500])))
+        hoff = Histogram(edges)
+        hoff.fill(xb[1500:])
+
+        # Compare with quantiles of individual replicas
+        hq = HistQuantileOnOff(hon,hoff,1.0)
+        xq_mean, xq_rms = hq.bootstrap(0.68,200,seed=3)
+
+        rnd = np.random.RandomState(3)
+        mon = Histogram.createHistModel(edges,hq._non[1:]).counts
+        moff = Histogram.createHistModel(edges,hq._noff[1:]).counts
+        non = rnd.poisson(np.concatenate(([0],mon)),(200,61))
+        noff = rnd.poisson(np.concatenate(([0],moff)),(200,61))
+        xq = [hq._quantile(non[i]*1.0,noff[i]*1.0,0.68) for i in range(200)]
+
+        assert_almost_equal(xq_mean,np.mean(xq))
+        assert_almost_equal(xq_rms,np.std(xq))
+
+        xq_mean, xq_rms = hq.bootstrap([0.68,0.5],200,seed=3)
+        self.assertEqual(xq_mean.shape,(2,))
+        assert_almost_equal(xq_mean[0],np.mean(xq))
+
+        hq = HistQuantileBkgFn(hon,lambda x: x**2/9.,1500)
+        xq_mean, xq_rms = hq.bootstrap(0.68,200,xmax=3.0,seed=3)
+
+        rnd = np.random.RandomState(3)
+        nbkg = rnd.poisson(1500,200)
+        mon = Histogram.createHistModel(edges,hq._ncounts[1:]).counts
+        non = rnd.poisson(np.concatenate(([0],mon)),(200,61))
+        xq = [hq._quantile(nbkg[i],edges,non[i]*1.0,0.68) 
+              for i in range(200)]
+
+        assert_almost_equal(xq_mean,np.mean(xq))
+        assert_almost_equal(xq_rms,np.std(xq))
+
+        hq = HistQuantile(hon)
+        xq_mean, xq_rms = hq.bootstrap(0.68,200,seed=3)
+        self.assertEqual(hq.bootstrap(0.68,200,seed=3),(xq_mean,xq_rms))
+
+        # Without a seed the replicas are drawn from the global RNG
+        np.random.seed(3)
+        self.assertEqual(hq.bootstrap(0.68,200),(xq_mean,xq_rms))
+
+        rnd = np.random.RandomState(3)
+        non = rnd.poisson(hq._ncounts,(200,61))
+        xq = [HistQuantile.array_quantile(edges,non[i],0.68) 
+              for i in range(200)]
+
+        assert_almost_equal(xq_mean,np.mean(xq))
+        assert_almost_equal(xq_rms,np.std(xq))
+
+        hb = HistBootstrap(hon,lambda h: h.sum())
+        v = hb.bootstrap(100,seed=3)
+        assert_array_equal(hon.counts,hb._ncounts)
+        self.assertTrue(abs(v[0]-np.sum(hon.counts)) < 3*v[1])
@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal, assert_almost_equal
+from gammatools.core.stats import *
+from gammatools.core.nonlinear_fitting import BFGSFitter
+
+
+class TestStats(unittest.TestCase):
+
+    def test_onoff_mc_ts(self):
+
+        np.random.seed(1)
+
+        mus = np.array([5.,3.,1.,0.5])
+        mub = np.array([10.,20.,30.,40.])
+        alpha = 0.2
+        ntrial = 20
+
+        onoff = OnOffExperiment(mus,mub,alpha)
+
+        ns = np.random.poisson(mus*0.7+mub,(ntrial,4)).T.astype(float)
+        nc = np.random.poisson(np.sum(mub)/alpha,(ntrial,1)).T.astype(float)
+
+        xs, ys = onoff.fit_signal(ns,nc)
+        y0 = onoff.fit_null(ns,nc)
+
+        for i in range(ntrial):
+
+            fn0 = lambda x,y: -OnOffExperiment.lnl_signal(ns[:,i],nc[:,i],
+                                                         x*mus,y*mub,
+                                                         onoff._alpha)
+            fn1 = lambda x: -OnOffExperiment.lnl_null(ns[:,i],nc[:,i],
+                                                      x*mub,onoff._alpha)
+
+            p0 = BFGSFitter.fit(fn0,[1.0,1.0],
+                                bounds=[[0.01,None],[0.01,None]])
+            p1 = BFGSFitter.fit(fn1,[1.0],bounds=[[0.01,None]])
+
+            # Newton solution is at least as good as BFGS
+            self.assertTrue(fn0(xs[i],ys[i]) <= 
+                            fn0(p0[0].value,p0[1].value) + 1E-8)
+            assert_almost_equal(xs[i],p0[0].value,3)
+            assert_almost_equal(y0[i],p1[0].value,4)
+
+        # Chunked simulation reproduces a single pass
+        np.random.seed(2)
+        ts0 = onoff.mc_ts(1.0,1000)
+        self.assertEqual(ts0.shape,(1000,))
+        self.assertTrue(np.all(ts0 >= 0))
+
+        np.random.seed(2)
+        ts = list(onoff.mc_ts_iter(1.0,1000,chunk_size=300))
+        self.assertEqual([len(t) for t in ts],[300,300,300,100])
+        assert_array_equal(np.concatenate(ts),ts0)
+
+        np.random.seed(2)
+        assert_array_equal(onoff.mc_ts(1.0,1000,chunk_size=300),ts0)
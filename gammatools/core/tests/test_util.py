@@ -8,6 +8,80 @@ from gammatools.core.histogram import Axis
 
 class TestUtil(unittest.TestCase):
 
+    def test_grid_interpolator(self):
+
+        x0 = [np.linspace(0,1,6),np.logspace(0,1,5),
+              np.array([-1.0,-0.5,0.5,2.0])]
+
+        fn = lambda x, y, z: 1.0 + 2.0*x - 0.5*y + 3.0*z + x*y*z
+        
+        xm, ym, zm = np.meshgrid(*x0,indexing='ij')
+        z = fn(xm,ym,zm)
+
+        np.random.seed(1)
+        x = np.vstack((np.random.uniform(-0.2,1.2,100),
+                       np.random.uniform(0.5,12.0,100),
+                       np.random.uniform(-1.5,2.5,100)))
+
+        # Trilinear function is reproduced exactly inside the mesh
+        # and linearly extrapolated outside
+        interp = GridInterpolator(x0,z)
+        assert_almost_equal(interp(x),fn(*x),10)
+        assert_almost_equal(interpolatend(x0,z,x),fn(*x),10)
+        assert_almost_equal(interp(x,2*z),2*fn(*x),10)
+
+        # Mesh points are reproduced exactly
+        xv = np.vstack((np.ravel(xm),np.ravel(ym),np.ravel(zm)))
+        assert_almost_equal(interp(xv),np.ravel(z),10)
+
+        interp = GridInterpolator(x0,z,dtype=np.float32)
+        v = interp(x)
+        self.assertEqual(v.dtype,np.float32)
+        assert_almost_equal(v,fn(*x),4)
+
+    def test_quad_batch(self):
+
+        a = np.array([1.5,1.0,2.0,4.0])
+        lo = np.zeros(4)
+        hi = np.array([1.0,2.0,3.0,0.0])
+
+        fn = lambda x, idx: a[idx]*np.power(x,a[idx]-1.0)*np.exp(-x)
+        v, err = quad_batch(fn,lo,hi,epsrel=1E-8)
+
+        # int a*x^(a-1)*exp(-x) = a*Gamma(a)*P(a,hi)
+        vref = a*spfn.gamma(a)*spfn.gammainc(a,hi)
+        assert_almost_equal(v,vref,7)
+        self.assertTrue(np.all(err <= np.maximum(1E-7*np.abs(v),1E-12)))
+
+        # Infinite upper bound
+        v, err = quad_batch(fn,lo,np.inf,epsrel=1E-8)
+        assert_almost_equal(v,a*spfn.gamma(a),7)
+
+    def test_atomic_write(self):
+
+        import os
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir,'table.npz')
+            with atomic_write(path) as f:
+                np.savez(f,x=np.arange(3))
+            assert_array_equal(np.load(path)['x'],np.arange(3))
+
+            # The existing file is kept if the write fails
+            try:
+                with atomic_write(path) as f:
+                    np.savez(f,x=np.arange(5))
+                    raise RuntimeError
+            except RuntimeError: pass
+
+            assert_array_equal(np.load(path)['x'],np.arange(3))
+            self.assertEqual(os.listdir(tmpdir),['table.npz'])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_convolve2d_king(self):
         
         gfn = lambda r, s: np.power(2*np.pi*s**2,-1)*np.exp(-r**2/(2*s**2))
@@ -43,6 +117,59 @@ class TestUtil(unittest.TestCase):
 
         assert_almost_equal(fval0,fval1,4)
 
+    def test_convolve2d_king_cache(self):
+
+        gfn = lambda r, s: np.power(2*np.pi*s**2,-1)*np.exp(-r**2/(2*s**2))
+
+        r = np.linspace(0,2,50)
+        cache = KingKernelCache(max_bytes=2*50*1000*8)
+
+        for sig, gam in [(0.2,4.0),(0.1,1.3),(0.3,80.),
+                         (np.array([0.1,0.2]),np.array([2.0,3.0]))]:
+
+            fval0 = convolve2d_king(lambda t: gfn(t,0.1),r,sig,gam,3.0,
+                                    nstep=1000,cache=None)
+            fval1 = convolve2d_king(lambda t: gfn(t,0.1),r,sig,gam,3.0,
+                                    nstep=1000,cache=cache)
+            fval2 = convolve2d_king(lambda t: gfn(t,0.2),r,sig,gam,3.0,
+                                    nstep=1000,cache=cache)
+            fval3 = convolve2d_king(lambda t: gfn(t,0.2),r,sig,gam,3.0,
+                                    nstep=1000,cache=None)
+
+            assert_almost_equal(fval1/np.max(fval0),fval0/np.max(fval0),6)
+            assert_almost_equal(fval2/np.max(fval3),fval3/np.max(fval3),6)
+
+        # Cache size is bounded by max_bytes
+        self.assertTrue(len(cache._cache) <= 2)
+
+    def test_convolve2d_hankel(self):
+
+        gfn = lambda r, s: np.power(2*np.pi*s**2,-1)*np.exp(-r**2/(2*s**2))
+
+        r = np.linspace(0,2,100)
+
+        # Gaussian convolved with a gaussian
+        fval0 = gfn(r,np.sqrt(0.1**2+0.2**2))
+        fval1 = convolve2d_gauss(lambda t: gfn(t,0.1),r,0.2,3.0,
+                                 method='hankel',tol=1E-6)
+        assert_almost_equal(fval1/np.max(fval0),fval0/np.max(fval0),5)
+
+        # Vector input for gaussian width
+        sigma = np.array([0.1,0.15,0.2])
+        fval0 = convolve2d_gauss(lambda t: gfn(t,0.1),r,sigma,3.0,
+                                 nstep=2000)
+        fval1 = convolve2d_gauss(lambda t: gfn(t,0.1),r,sigma,3.0,
+                                 method='hankel')
+        self.assertEqual(fval0.shape,fval1.shape)
+        assert_almost_equal(fval1/np.max(fval0),fval0/np.max(fval0),4)
+
+        # Gaussian convolved with a King function
+        fval0 = convolve2d_king(lambda t: gfn(t,0.5),r,0.1,2.0,4.0,
+                                nstep=20000,cache=None)
+        fval1 = convolve2d_king(lambda t: gfn(t,0.5),r,0.1,2.0,4.0,
+                                method='hankel')
+        assert_almost_equal(fval1/np.max(fval0),fval0/np.max(fval0),4)
+
     def test_convolve2d_gauss(self):
 
         gfn0 = lambda x, y, mux, muy, s: np.power(2*np.pi*s**2,-1)* \
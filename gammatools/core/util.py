@@ -1,5 +1,7 @@
 import os
 import errno
+import tempfile
+import contextlib
 import numpy as np
 import scipy.special as spfn
 import re
@@ -317,18 +319,30 @@ def expand_array(*x):
 
     return xv, shape
 
-def bitarray_to_int(x,big_endian=False):
+def iter_chunks(data,cols,chunk_size=1000000,nrows=None):
+    """Generator that yields successive row slices of a set of
+    columns.  data can be any table object that supports column
+    access by name and row slicing (e.g. a FITS table, record array,
+    or dictionary of arrays).  Each iteration yields a tuple
+    containing chunk_size rows of each of the columns in cols.  When
+    data is a memory-mapped FITS table only the rows in the current
+    chunk are read from disk."""
 
-    if x.dtype == 'int': return x
-    elif x.dtype == 'float': return x.astype('int')
-    
-    o = np.zeros(x.shape[0],dtype=int)
+    if isinstance(cols,str): cols = [cols]
 
-    for i in range(x.shape[1]):
-        if big_endian: o += (1<<i)*x[:,::-1][:,i]
-        else: o += (1<<i)*x[:,i]
+    if nrows is None: nrows = len(data[cols[0]])
 
-    return o
+    for i in range(0,nrows,chunk_size):
+        yield tuple([np.asarray(data[c][i:i+chunk_size]) for c in cols])
+
+def bitarray_to_int(x,big_endian=False):
+
+    x = np.asarray(x)
+    if x.ndim == 1: return x.astype('int')
+
+    w = 1<<np.arange(x.shape[1])
+    if big_endian: w = w[::-1]
+    return np.dot(x.astype('int'),w)
 
 
 
@@ -337,6 +351,25 @@ def make_dir(d):
     except os.error, e:
         if e.errno != errno.EEXIST: raise 
 
+@contextlib.contextmanager
+def atomic_write(path,mode='wb'):
+    """Context manager that returns a file object for writing the
+    file at path.  The contents are written to a temporary file in
+    the same directory which is renamed to path when the block exits
+    so that concurrent readers never see a partial file.  The
+    temporary file is removed if the block raises an exception."""
+
+    path = os.path.abspath(path)
+    fd, tmpfile = tempfile.mkstemp(suffix=os.path.splitext(path)[1],
+                                   dir=os.path.dirname(path))
+
+    try:
+        with os.fdopen(fd,mode) as f: yield f
+        os.rename(tmpfile,path)
+    except:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise
+
 def get_parameters(expr):
     m = re.compile('([a-zA-Z])([a-zA-Z0-9\_\[\]]+)')
     pars = []
@@ -394,6 +427,109 @@ def integrate(fn,lo,hi,npoints):
     w = edges[1:] - edges[:-1]
     return np.sum(fn(x)*w)
 
+def quad_batch(fn,lo,hi,epsabs=0.0,epsrel=1E-6,nnode=16,npanel=1,
+               max_level=12):
+    """Compute a set of independent 1D integrals with an adaptive
+    composite Gauss-Legendre rule.  All integrals are evaluated
+    together at each refinement level.  The number of panels of an
+    integral is doubled until the change in its value between two
+    levels is smaller than max(epsabs,epsrel*|I|).  Integrals that
+    have converged are dropped from subsequent levels.  Integrals
+    with an infinite upper bound are mapped onto the unit interval
+    with the substitution x = lo + t/(1-t).
+
+    Parameters
+    ----------
+    fn : callable
+        Integrand with signature fn(x,index) where x is an array
+        with shape (npoints,nint) and index is an array of length
+        nint with the indices of the integrals being evaluated.
+
+    lo : array_like
+        Array of lower integration bounds.
+
+    hi : array_like
+        Array of upper integration bounds.  Bounds can be infinite.
+
+    nnode : int
+        Number of Gauss-Legendre nodes per panel.
+
+    npanel : int
+        Number of panels at the first refinement level.
+
+    max_level : int
+        Maximum number of refinement levels.
+
+    Returns
+    -------
+    v : `~numpy.ndarray`
+        Array of integral values.
+
+    err : `~numpy.ndarray`
+        Array of error estimates.
+    """
+
+    lo = np.array(lo,ndmin=1,dtype=float)
+    hi = np.array(hi,ndmin=1,dtype=float)
+    lo, hi = np.broadcast_arrays(lo,hi)
+
+    if np.any(np.isinf(lo)):
+        raise ValueError('Lower integration bounds must be finite.')
+
+    tail = np.isposinf(hi)
+    if np.any(tail):
+
+        x0 = lo
+        lo = np.where(tail,0.0,lo)
+        hi = np.where(tail,1.0,hi)
+        tailfn = fn
+
+        def fn(x,idx):
+
+            m = tail[idx]
+            if not np.any(m): return tailfn(x,idx)
+
+            t = x[:,m]
+            x = np.array(x)
+            x[:,m] = x0[idx][m] + t/(1.0-t)
+            y = np.array(tailfn(x,idx),dtype=float)
+            y[:,m] /= (1.0-t)**2
+            return y
+
+    xg, wg = np.polynomial.legendre.leggauss(nnode)
+    xg = 0.5*(xg+1.0)
+    wg = 0.5*wg
+
+    def panel_sum(idx,npan):
+        w = (hi[idx]-lo[idx])/float(npan)
+        xp = (np.arange(npan)[:,np.newaxis] + xg[np.newaxis,:]).ravel()
+        x = lo[idx] + np.outer(xp,w)
+        wp = np.tile(wg,npan)
+        return np.dot(wp,fn(x,idx))*w
+
+    v = np.zeros(lo.shape)
+    err = np.zeros(lo.shape)
+
+    idx = np.arange(lo.size)
+    v0 = panel_sum(idx,npanel)
+
+    for i in range(1,max_level+1):
+
+        if idx.size == 0: break
+
+        npanel *= 2
+        v1 = panel_sum(idx,npanel)
+        e1 = np.abs(v1-v0)
+
+        v[idx] = v1
+        err[idx] = e1
+
+        msk = e1 > np.maximum(epsabs,epsrel*np.abs(v1))
+        idx = idx[msk]
+        v0 = v1[msk]
+
+    return v, err
+
 def find_root(x,y,y0):
     """Solve for the x coordinate at which f(x)-y=0 where f(x) is
     a smooth interpolation of the histogram contents."""
@@ -477,60 +613,175 @@ def interpolate2d(x0,y0,z,x,y):
     return (z[ix,iy]*(1-xs)*(1-ys) + z[ix+1,iy]*xs*(1-ys) +
             z[ix,iy+1]*(1-xs)*ys + z[ix+1,iy+1]*xs*ys)
 
-def interpolatend(x0,z,x):
-    """Perform linear interpolation over an N-dimensional mesh.
+class GridInterpolator(object):
+    """Linear interpolator over an N-dimensional rectilinear mesh.
+    The mesh is bound to the interpolator when it is constructed and
+    the spacing of each mesh dimension is precomputed such that
+    repeated evaluations only perform the bin search and a single
+    gather of the 2^N stencil corners.  Uniformly spaced mesh
+    dimensions are indexed arithmetically.  Points outside the mesh
+    are linearly extrapolated from the nearest mesh cell.
 
     Parameters
     ----------
     x0:  List of arrays defining mesh coordinates in each of N dimensions.
 
-    z: N-dimesional array of scalar values evaluated on the coordinate
-    mesh defined by x0.  The number of elements along each dimension must
-    equal to the corresponding number of mesh points in x0 (N_tot = Prod_i N_i).
+    z: N-dimensional array of scalar values evaluated on the
+    coordinate mesh (optional).  If z is not given it must be provided
+    when the interpolator is called.
 
-    x: NxM numpy array specifying the M points in N-dimensional space at
-    which the interpolation should be evaluated.
+    dtype: Data type used for the interpolation weights and output
+    values (e.g. np.float32).  Defaults to float64.
 
     """
 
-    x = np.array(x,ndmin=2)
-    ndim = len(x0)
+    def __init__(self,x0,z=None,dtype=float):
 
-    index = np.zeros(shape=(2**ndim,ndim,len(x[0])),dtype=int)
-    psum = np.ones(shape=(2**ndim,len(x[0])))
+        self._dtype = np.dtype(dtype)
+        self._points = []
+        self._width = []
+        self._uniform = []
+        self._shape = []
 
-    for i, t in enumerate(x0):
+        for t in x0:
 
-        p = np.array(t,ndmin=1)
-        w = p[1:]-p[:-1]
-        ix = np.digitize(x[i],p)-1
-        ix[ix<0]=0
-        ix[ix > x0[i].shape[0] -2 ] = len(x0[i]) - 2
-        xs = (x[i] - x0[i][:-1][ix])/w[ix]
+            p = np.array(t,ndmin=1,dtype=float)
+            w = p[1:]-p[:-1]
 
+            self._points.append(p)
+            self._width.append(w)
+            self._shape.append(len(p))
+
+            self._uniform.append(None)
+
+            if len(w) == 0 or np.any(w <= 0): continue
+            elif np.allclose(w,w[0],rtol=1E-8,atol=0):
+                self._uniform[-1] = (False,p[0],1./w[0])
+            elif p[0] > 0:
+                dlog = np.diff(np.log(p))
+                if np.allclose(dlog,dlog[0],rtol=1E-8,atol=0):
+                    self._uniform[-1] = (True,np.log(p[0]),1./dlog[0])
+
+        self._ndim = len(self._points)
+
+        # Flat index offsets of the 2^N corners of a mesh cell
+        strides = np.cumprod([1] + self._shape[::-1])[:-1][::-1]
+        stencil = np.zeros(1,dtype=int)
+        for i in range(self._ndim):
+            stencil = np.concatenate((stencil,stencil+strides[i]))
+
+        self._strides = strides
+        self._stencil = stencil
+
+        self._z = None
+        if z is not None: self._z = self._flatten(z)
+
+    @property
+    def ndim(self):
+        return self._ndim
+
+    def _flatten(self,z):
+
+        z = np.asarray(z)
+        if z.shape != tuple(self._shape):
+            raise ValueError('Value array does not match mesh dimensions.')
+
+        return np.ravel(z).astype(self._dtype,copy=False)
+
+    def _index(self,i,x):
+        """Compute the mesh cell index and fractional offset within
+        the cell along dimension i."""
+
+        p = self._points[i]
+
+        if self._uniform[i] is not None:
+            logx, offset, scale = self._uniform[i]
+            with np.errstate(invalid='ignore',divide='ignore'):
+                if logx: t = np.log(x)
+                else: t = np.array(x,dtype=float)
+                t -= offset
+                t *= scale
+                ix = np.floor(t).astype(int)
+            np.clip(ix,0,len(p)-2,out=ix)
+
+            # On a uniform mesh the fractional offset follows directly
+            # from the scaled coordinate
+            if not logx:
+                t -= ix
+                return ix, t.astype(self._dtype,copy=False)
+
+        elif p[-1] > p[0]:
+            ix = np.searchsorted(p,x,side='right')-1
+            np.clip(ix,0,len(p)-2,out=ix)
+        else:
+            ix = np.digitize(x,p)-1
+            np.clip(ix,0,len(p)-2,out=ix)
+
+        xs = (x - p[ix])/self._width[i][ix]
+        return ix, xs.astype(self._dtype,copy=False)
+
+    def __call__(self,x,z=None):
+        """Evaluate the interpolation at the M points given in the
+        NxM array x.  If z is provided it is used in place of the
+        value array bound to the interpolator."""
+
+        if z is None: z = self._z
+        else: z = self._flatten(z)
+
+        if z is None:
+            raise ValueError('No value array defined for interpolation.')
+
+        x = np.array(x,ndmin=2,copy=False)
+
+        if x.shape[0] != self._ndim:
+            raise ValueError('Coordinate dimension of input array must be '
+                             'equal to mesh dimension.')
+
+        npts = x.shape[1]
+        index = np.zeros(npts,dtype=int)
+        wt = np.empty((len(self._stencil),npts),dtype=self._dtype)
+        wt[0] = 1.0
+
+        # Build the weights of the cell corners in the same order as
+        # the stencil offsets
+        n = 1
+        for i in range(self._ndim):
+            ix, xs = self._index(i,x[i])
+            ix *= self._strides[i]
+            index += ix
+            np.multiply(wt[:n],xs,out=wt[n:2*n])
+            wt[:n] -= wt[n:2*n]
+            n *= 2
+
+        v = np.zeros(npts,dtype=self._dtype)
+        zc = np.empty(npts,dtype=self._dtype)
+        ic = np.empty(npts,dtype=int)
+
+        for j, offset in enumerate(self._stencil):
+            np.add(index,offset,out=ic)
+            np.take(z,ic,mode='clip',out=zc)
+            zc *= wt[j]
+            v += zc
 
-        for j in range(len(psum)):
-            if j & (1<<i):
-                index[j][i] = ix+1
-                psum[j] *= xs
-            else:
-                index[j][i] = ix
-                psum[j] *= (1.0-xs)
+        return v
 
-#    print index
-#    print index[0].shape
-#    print z[np.ix_(index[0])]
+def interpolatend(x0,z,x):
+    """Perform linear interpolation over an N-dimensional mesh.
 
-    for j in range(len(psum)):
+    Parameters
+    ----------
+    x0:  List of arrays defining mesh coordinates in each of N dimensions.
 
-        idx = []
-        for i in range(ndim): idx.append(index[j][i])
+    z: N-dimesional array of scalar values evaluated on the coordinate
+    mesh defined by x0.  The number of elements along each dimension must
+    equal to the corresponding number of mesh points in x0 (N_tot = Prod_i N_i).
 
-#        print idx
+    x: NxM numpy array specifying the M points in N-dimensional space at
+    which the interpolation should be evaluated.
 
-        psum[j] *= z[idx]
+    """
 
-    return np.sum(psum,axis=0)
+    return GridInterpolator(x0,z)(x)
 
 def percentile(x,cdf,frac=0.68):
     """Given a cumulative distribution function C(x) find the value
@@ -546,7 +797,291 @@ def edge_to_center(edges):
 def edge_to_width(edges):
     return (edges[1:]-edges[:-1])
 
-def convolve2d_king(fn,r,sig,gam,rmax,nstep=200):
+class HankelConvolution(object):
+    """Convolution engine for azimuthally symmetric functions in two
+    dimensions.  Functions are sampled on a logarithmic radial grid
+    and transformed to Hankel space with a zeroth-order fast Hankel
+    transform (the FFTLog algorithm of Hamilton 2000).  The
+    convolution is the product of the transforms followed by the
+    inverse transform, which costs O(n log n) for a grid of n points
+    independent of the number of evaluation radii.
+
+    With the transform F(k) = Int f(r) J0(kr) r dr the convolution
+    of f and g is given by
+
+    (f*g)(r) = 2*pi Int F(k) G(k) J0(kr) k dk
+
+    Parameters
+    ----------
+
+    rmin : Lower edge of the logarithmic radial grid.
+
+    rmax : Upper edge of the logarithmic radial grid.
+
+    n : Number of grid points.
+
+    """
+
+    def __init__(self,rmin,rmax,n=1024):
+
+        self._n = n
+        self._dln = np.log(rmax/rmin)/float(n-1)
+        self._r = np.exp(np.linspace(np.log(rmin),np.log(rmax),n))
+
+        # Choose the offset log(k_c r_c) that minimizes ringing
+        y = np.pi/(2*self._dln)
+        arg = np.log(2.)/self._dln + 2*spfn.loggamma(0.5+1j*y).imag/np.pi
+        self._offset = (arg-np.round(arg))*self._dln
+
+        self._k = np.exp(self._offset)/self._r[::-1]
+
+        y = np.linspace(0,np.pi*(n//2)/(n*self._dln),n//2+1)
+        u = spfn.loggamma(0.5+1j*y)
+        self._coeff = np.exp(2j*(u.imag + y*(np.log(2.)-self._offset)))
+        self._coeff.imag[-1] = 0
+
+    @property
+    def r(self):
+        return self._r
+
+    @property
+    def k(self):
+        return self._k
+
+    def _fht(self,a):
+        c = np.fft.rfft(a)
+        c *= self._coeff
+        return np.fft.irfft(c,self._n)[...,::-1]
+
+    def transform(self,f):
+        """Compute the Hankel transform F(k) of a function sampled on
+        the radial grid."""
+        return self._fht(f*self._r)/self._k
+
+    def inverse(self,fk):
+        """Compute the inverse Hankel transform f(r) of a function
+        sampled on the wavenumber grid."""
+        return self._fht(fk*self._k)/self._r
+
+    def convolve(self,f,g=None,gk=None):
+        """Convolve two functions sampled on the radial grid.  The
+        second function may alternatively be provided by its Hankel
+        transform gk sampled on the wavenumber grid."""
+
+        if gk is None: gk = self.transform(g)
+        return 2*np.pi*self.inverse(self.transform(f)*gk)
+
+    def interpolate(self,v,r,rmin=None):
+        """Interpolate a function sampled on the radial grid at the
+        radii r.  Radii below rmin (by default the lower edge of the
+        grid) are assigned the value at rmin."""
+        if rmin is None: rmin = self._r[0]
+        lr = np.log(np.clip(r,rmin,None))
+        return np.interp(lr,np.log(self._r),v)
+
+def convolve2d_hankel(fn,r,rmax,kernel_fn=None,kernel_ft=None,tol=1E-6,
+                      nmin=256,nmax=4096,rscale=None):
+    """Evaluate the convolution of an azimuthally symmetric function
+    fn with an azimuthally symmetric kernel using HankelConvolution.
+    The kernel can be defined either in real space (kernel_fn) or by
+    its Hankel transform F(k) = Int g(r) J0(kr) r dr (kernel_ft).  As
+    in the direct quadrature the input function is truncated at
+    rmax.  The kernel width rscale sets the range of the radial
+    grid.  The number of grid points is doubled starting from nmin
+    until the maximum change in the result is less than tol times
+    its maximum value.
+
+    Parameters
+    ----------
+
+    fn : Input function that takes a single radial coordinate parameter.
+
+    r : Array of points at which the convolution is to be evaluated.
+
+    rmax : Upper integration radius of the input function.
+
+    rscale : Characteristic width of the kernel.  Defaults to rmax.
+
+    """
+
+    r = np.array(r,ndmin=1)
+    if rscale is None: rscale = rmax
+
+    # The transform is subject to ringing near the lower edge of the
+    # grid.  The result is evaluated at radii no smaller than reval
+    # where it is flat to O((reval/rscale)^2).
+    rlo = 1E-7*min(rscale,rmax)
+    rhi = 1E3*max(rscale,rmax+np.max(r))
+    reval = 1E-3*min(rscale,rmax)
+
+    n = nmin
+    v0 = None
+
+    while True:
+
+        hc = HankelConvolution(rlo,rhi,n)
+
+        f = fn(hc.r)
+        f[hc.r > rmax] = 0
+
+        if kernel_ft is not None: v = hc.convolve(f,gk=kernel_ft(hc.k))
+        else: v = hc.convolve(f,kernel_fn(hc.r))
+
+        v = hc.interpolate(v,r,reval)
+
+        if v0 is not None:
+            vmax = np.max(np.abs(v))
+            if np.max(np.abs(v-v0)) <= tol*vmax or 2*n > nmax: break
+
+        v0 = v
+        n *= 2
+
+    return v
+
+class KingKernelCache(object):
+    """Cache of the radial convolution kernels used by
+    convolve2d_king.  The kernel for a given set of evaluation radii
+    and King function parameters does not depend on the function
+    being convolved and is stored in an LRU cache keyed by (r, sig,
+    gam, rmax, nstep).  The cache is limited to max_bytes of kernel
+    storage.
+
+    On a cache miss the hypergeometric function in the kernel is
+    evaluated from a precomputed table rather than with
+    scipy.special.hyp2f1.  Using the Euler transformation
+
+    2F1(g/2,(1+g)/2;1;z) = (1-z)^(1/2-g) 2F1(1-g/2,(1-g)/2;1;z)
+
+    the logarithm of the second factor divided by y = -log(1-z) is
+    a smooth function of (log g, log y) that is tabulated on a mesh
+    and interpolated with a bicubic spline.  Values of gamma outside
+    the table range fall back to the direct evaluation."""
+
+    def __init__(self,max_bytes=256*1024**2,gam_range=(1.01,50.),
+                 ngam=100,y_range=(1E-8,40.),ny=200):
+
+        self._cache = OrderedDict()
+        self._max_bytes = max_bytes
+        self._nbytes = 0
+        self._gam_range = gam_range
+        self._y_range = y_range
+        self._ngam = ngam
+        self._ny = ny
+        self._ncolumn = 40*ny
+        self._max_columns = 8
+        self._table = None
+
+    def clear(self):
+        self._cache.clear()
+        self._nbytes = 0
+
+    def _create_table(self):
+
+        from scipy.interpolate import RectBivariateSpline
+
+        lgam = np.linspace(np.log(self._gam_range[0]),
+                           np.log(self._gam_range[1]),self._ngam)
+        ly = np.linspace(np.log(self._y_range[0]),
+                         np.log(self._y_range[1]),self._ny)
+
+        gam, y = np.meshgrid(np.exp(lgam),np.exp(ly),indexing='ij')
+        h = spfn.hyp2f1(1.0-gam/2.,(1.0-gam)/2.,1.0,-np.expm1(-y))
+        self._table = RectBivariateSpline(lgam,ly,np.log(h)/y,kx=3,ky=3)
+
+    def log_hyp2f1(self,gam,y):
+        """Evaluate log 2F1(g/2,(1+g)/2;1;z) as a function of gamma
+        and y = -log(1-z)."""
+
+        if self._table is None: self._create_table()
+
+        gam, y = np.broadcast_arrays(gam,y)
+        shape = gam.shape
+        gam = np.ravel(gam)
+        y = np.ravel(y)
+        
+        v = (0.5-gam)*(-y)
+        
+        msk = (gam >= self._gam_range[0]) & (gam <= self._gam_range[1])
+
+        # The Euler-transformed function converges to a constant for
+        # y > ymax
+        ys = np.clip(y[msk],0,self._y_range[1])
+        ly = np.log(np.clip(ys,self._y_range[0],None))
+        lgam = np.log(gam[msk])
+
+        # When the number of distinct gamma values is small (the
+        # usual case) the spline is sampled on a dense grid in log y
+        # for each value and linearly interpolated
+        ugam, index = np.unique(lgam,return_inverse=True)
+
+        if len(ugam) > self._max_columns:
+            v[msk] += self._table.ev(lgam,ly)*ys
+        else:
+            lyc = np.linspace(np.log(self._y_range[0]),
+                              np.log(self._y_range[1]),self._ncolumn)
+            vt = np.zeros(ly.shape)
+            for i, g in enumerate(ugam):
+                m = index == i
+                col = self._table.ev(g*np.ones(self._ncolumn),lyc)
+                vt[m] = np.interp(ly[m],lyc,col)
+            v[msk] += vt*ys
+
+        if np.any(~msk):
+            g = gam[~msk]
+            v[~msk] += np.log(spfn.hyp2f1(1.0-g/2.,(1.0-g)/2.,1.0,
+                                          -np.expm1(-y[~msk])))
+
+        return v.reshape(shape)
+
+    def kernel(self,r,sig,gam,rmax,nstep):
+        """Return the kernel matrix for the given evaluation radii
+        and King parameters.  r must be an array with shape (nr,1) or
+        (1,nr,1) and sig, gam must be broadcastable to it."""
+
+        key = (r.tobytes(),r.shape,sig.tobytes(),gam.tobytes(),
+               float(rmax),int(nstep))
+
+        k = self._cache.pop(key,None)
+
+        if k is None:
+            k = self.create_kernel(r,sig,gam,rmax,nstep)
+            self._nbytes += k.nbytes
+
+        self._cache[key] = k
+
+        while self._nbytes > self._max_bytes and len(self._cache) > 1:
+            self._nbytes -= self._cache.popitem(last=False)[1].nbytes
+
+        return k
+
+    def create_kernel(self,r,sig,gam,rmax,nstep,tabulated=True):
+
+        r2edge = np.linspace(0,rmax**2,nstep+1)
+        r2p = edge_to_center(r2edge)
+        r2w = edge_to_width(r2edge)
+
+        u = 0.5*(r/sig)**2
+        v = 0.5*r2p*(1./sig)**2
+        vw = 0.5*r2w*(1./sig)**2
+
+        a = gam+u+v
+
+        if tabulated:
+            # -log(1-z) with z = 4*u*v/(gam+u+v)**2
+            y = -np.log((gam*gam + 2*gam*(u+v) + (u-v)**2)/(a*a))
+            hgfn = np.exp(self.log_hyp2f1(gam*np.ones(y.shape),y) + 
+                          gam*np.log(gam/a))
+        else:
+            z = 4*u*v/a**2
+            hgfn = spfn.hyp2f1(gam/2.,(1.+gam)/2.,1.0,z)
+            hgfn *= np.power(gam/a,gam)
+
+        return (gam-1.0)/gam*hgfn*vw
+
+king_kernel_cache = KingKernelCache()
+
+def convolve2d_king(fn,r,sig,gam,rmax,nstep=200,cache=king_kernel_cache,
+                    method='direct',tol=1E-6):
     """Evaluate the convolution f'(x,y) = f(x,y) * g(x,y) where f(r) is
     azimuthally symmetric function in two dimensions and g is a
     King function given by:
@@ -564,41 +1099,45 @@ def convolve2d_king(fn,r,sig,gam,rmax,nstep=200):
 
     gam : Gamma parameter of the King function.
 
+    cache : KingKernelCache instance used to store and tabulate the
+    convolution kernel.  If None the kernel is recomputed with
+    scipy.special.hyp2f1 on every call.
+
+    method : Convolution method.  'direct' evaluates the convolution
+    by quadrature over nstep points.  'hankel' performs the
+    convolution in Hankel space (see convolve2d_hankel) with a
+    tolerance tol.
+
     """
 
+    if method == 'hankel':
+        return _convolve2d_hankel_vector(fn,r,rmax,tol,king_fn,sig,gam)
+    elif method != 'direct':
+        raise ValueError('Unrecognized convolution method: %s'%method)
+
     r = np.array(r,ndmin=1,copy=True)
-    sig = np.array(sig,ndmin=1,copy=True)
-    gam = np.array(gam,ndmin=1,copy=True)
+    sig = np.array(sig,ndmin=1,copy=True,dtype=float)
+    gam = np.array(gam,ndmin=1,copy=True,dtype=float)
 
-    r2p = edge_to_center(np.linspace(0,rmax**2,nstep+1))
-    r2w = edge_to_width(np.linspace(0,rmax**2,nstep+1))
+    nsig = max(sig.shape[0],gam.shape[0])
 
-    if sig.shape[0] > 1:        
-        r2p = r2p.reshape((1,1,nstep))
-        r2w = r2w.reshape((1,1,nstep))
+    if nsig > 1:
+        sig = (sig*np.ones(nsig)).reshape((nsig,1,1))
+        gam = (gam*np.ones(nsig)).reshape((nsig,1,1))
         r = r.reshape((1,r.shape[0],1))
-        sig = sig.reshape(sig.shape + (1,1))
-        gam = sig.reshape(gam.shape + (1,1))
-        saxis = 2
     else:
-        r2p = r2p.reshape(1,nstep)
-        r2w = r2w.reshape(1,nstep)
         r = r.reshape(r.shape + (1,))
-        saxis = 1
 
-    u = 0.5*(r/sig)**2
-    v = 0.5*r2p*(1./sig)**2
-    vw = 0.5*r2w*(1./sig)**2
+    if cache is None:
+        k = KingKernelCache().create_kernel(r,sig,gam,rmax,nstep,False)
+    else:
+        k = cache.kernel(r,sig,gam,rmax,nstep)
 
-    z = 4*u*v/(gam+u+v)**2
-    hgfn = spfn.hyp2f1(gam/2.,(1.+gam)/2.,1.0,z)
+    r2p = edge_to_center(np.linspace(0,rmax**2,nstep+1))
     fnrp = fn(np.sqrt(r2p))
-    s = np.sum(fnrp*(gam-1.0)/gam*np.power(gam/(gam+u+v),gam)*hgfn*vw,
-               axis=saxis)
+    return np.dot(k,fnrp)
 
-    return s
-
-def convolve2d_gauss(fn,r,sig,rmax,nstep=200):
+def convolve2d_gauss(fn,r,sig,rmax,nstep=200,method='direct',tol=1E-6):
     """Evaluate the convolution f'(r) = f(r) * g(r) where f(r) is
     azimuthally symmetric function in two dimensions and g is a
     gaussian given by:
@@ -614,7 +1153,18 @@ def convolve2d_gauss(fn,r,sig,rmax,nstep=200):
 
     sig : Width parameter of the gaussian.
 
+    method : Convolution method.  'direct' evaluates the convolution
+    by quadrature over nstep points.  'hankel' performs the
+    convolution in Hankel space (see convolve2d_hankel) with a
+    tolerance tol.
+
     """
+
+    if method == 'hankel':
+        return _convolve2d_hankel_vector(fn,r,rmax,tol,None,sig)
+    elif method != 'direct':
+        raise ValueError('Unrecognized convolution method: %s'%method)
+
     r = np.array(r,ndmin=1,copy=True)
     sig = np.array(sig,ndmin=1,copy=True)
 
@@ -656,6 +1206,40 @@ def convolve2d_gauss(fn,r,sig,rmax,nstep=200):
 #                      np.exp(np.log(je)+x-(r*r+rp*rp)/(2*sig2)),axis=1)*dr
 
 
+def king_fn(r,sig,gam):
+    """Two-dimensional King function normalized to unit integral."""
+    return (1.-1./gam)*np.power(1+0.5/gam*(r/sig)**2,-gam)/(2*np.pi*sig**2)
+
+def _convolve2d_hankel_vector(fn,r,rmax,tol,kfn,sig,*args):
+    """Apply convolve2d_hankel for one or more values of the kernel
+    width sig.  If kfn is None the kernel is a gaussian with width
+    sig.  The output shape follows that of the direct methods."""
+
+    sig = np.array(sig,ndmin=1,dtype=float)
+    args = [np.array(a,ndmin=1,dtype=float) for a in args]
+    nsig = max([sig.shape[0]] + [a.shape[0] for a in args])
+
+    sig = sig*np.ones(nsig)
+    args = [a*np.ones(nsig) for a in args]
+
+    v = []
+    for i in range(nsig):
+
+        s = sig[i]
+        a = [t[i] for t in args]
+
+        if kfn is None:
+            kft = lambda k: np.exp(-0.5*(k*s)**2)/(2*np.pi)
+            v.append(convolve2d_hankel(fn,r,rmax,kernel_ft=kft,
+                                       tol=tol,rscale=s))
+        else:
+            v.append(convolve2d_hankel(fn,r,rmax,
+                                       kernel_fn=lambda t: kfn(t,s,*a),
+                                       tol=tol,rscale=s))
+
+    if nsig == 1: return v[0]
+    else: return np.array(v)
+
 def convolve1(fn,r,sig,rmax):
 
     r = np.asarray(r)
@@ -6,7 +6,8 @@ from gammatools.dm.jcalc import *
 class HaloModelFactory(object):
 
     @staticmethod
-    def create(src_name,model_file = None,rho_rsun = None, gamma = None):
+    def create(src_name,model_file = None,rho_rsun = None, gamma = None,
+               cache = jtable_cache):
 
         if model_file is None:
             model_file = os.path.join(gammatools.PACKAGE_ROOT,
@@ -25,14 +26,14 @@ class HaloModelFactory(object):
         if gamma is not None:
             src['gamma'] = gamma
 
-        return HaloModel(src)
+        return HaloModel(src,cache)
 
 class HaloModel(object):
 
-    def __init__(self,src):
+    def __init__(self,src,cache=jtable_cache):
         self._losfn = LoSIntegralFnFast.create(src)
         self._dp = DensityProfile.create(src)
-        self._jp = JProfile(self._losfn)
+        self._jp = JProfile(self._losfn,cache)
         self._dist = src['dist']*Units.kpc
 
     @property
@@ -13,12 +13,13 @@ integral over a spherically symmetric DM distribution.
 __author__   = "Matthew Wood"
 __date__     = "12/01/2011"
 
+import os
 import copy
+import hashlib
+import zipfile
 import numpy as np
 
 from scipy.integrate import quad
-from scipy.interpolate import bisplrep
-from scipy.interpolate import bisplev
 from scipy.interpolate import interp1d, UnivariateSpline
 import scipy.special as spfn
 import scipy.optimize as opt
@@ -81,14 +82,22 @@ class LoSIntegralFn(object):
     is more densely sampled near the distance of closest of approach
     to the halo center.
 
+    The integrals for all offset angles are computed together with an
+    adaptive Gauss-Legendre rule (see `quad_batch`).  Only the angles
+    whose error estimate exceeds the tolerance are refined.
+
     Parameters
     ----------
     dist: Distance to halo center.
     dp: Density profile.
     alpha: Parameter determining the integration variable: x' = x^(1/alpha)
     rmax: Radius from center of halo at which LoS integral is truncated.
+    epsrel: Relative tolerance of the LoS integral.
+    epsabs: Absolute tolerance of the LoS integral.
+    nnode: Number of Gauss-Legendre nodes per integration panel.
     """
-    def __init__(self, dp, dist, rmax=None, alpha=3.0,ann=True):
+    def __init__(self, dp, dist, rmax=None, alpha=3.0,ann=True,
+                 epsrel=1E-6,epsabs=0.0,nnode=16):
         if rmax is None: rmax = np.inf
 
         self._dp = dp
@@ -96,6 +105,9 @@ class LoSIntegralFn(object):
         self._rmax = rmax
         self._alpha = alpha
         self._ann = ann
+        self._epsrel = epsrel
+        self._epsabs = epsabs
+        self._nnode = nnode
 
     @classmethod
     def create(cls,config,method='fast'):
@@ -104,8 +116,7 @@ class LoSIntegralFn(object):
         return LoSIntegralFnFast(dp,config['dist']*Units.kpc,
                                  config['rmax']*Units.kpc)
 
-
-    def __call__(self,psi,dhalo=None):
+    def __call__(self,psi,dhalo=None,return_err=False):
         """Evaluate the LoS integral at the offset angle psi for a halo
         located at the distance dhalo.
 
@@ -116,6 +127,10 @@ class LoSIntegralFn(object):
 
         dhalo : array_like
         Array of halo distances.
+
+        return_err : bool
+        Return an array with the error estimate of the LoS integral
+        at each angle.
         """
 
         if dhalo is None: dhalo = np.array(self._dist,ndmin=1)
@@ -126,50 +141,61 @@ class LoSIntegralFn(object):
         if dhalo.shape != psi.shape:
             dhalo = dhalo*np.ones(shape=psi.shape)
 
-        v = np.zeros(shape=psi.shape)
+        shape = psi.shape
+        psi = psi.ravel()
+        dhalo = dhalo.ravel()
+
+        # Closest approach to halo center
+        rmin = dhalo*np.sin(psi)
+
+        msk0 = self._rmax > dhalo
+        msk1 = self._rmax > rmin
+
+        xlim0 = np.power(np.abs(dhalo*np.cos(psi)),1./self._alpha)
+        xlim1 = np.zeros(psi.shape)
+        xlim1[msk1] = np.power(np.sqrt(self._rmax**2 - rmin[msk1]**2),
+                               1./self._alpha)
 
-        for i, t in np.ndenumerate(psi):
+        # Each LoS is split into at most two intervals (lo,hi) with
+        # a weight w.  The results for all intervals are accumulated
+        # into the angle index i.
+        
+        # If observer inside the halo...
+        msk01 = msk0 & (psi < np.pi/2.)
+        msk02 = msk0 & ~(psi < np.pi/2.)
 
-            s0 = 0
-            s1 = 0
+        # If observer outside the halo...
+        msk10 = ~msk0 & msk1
 
-            if self._ann:
-                losfn = LoSFn(dhalo[i],t,self._dp,self._alpha)
-            else:
-                losfn = LoSFnDecay(dhalo[i],t,self._dp,self._alpha)
+        i = np.arange(psi.size)
+        zero = np.zeros(psi.shape)
 
-            # Closest approach to halo center
-            rmin = dhalo[i]*np.sin(psi[i])
+        i = np.concatenate((i[msk01],i[msk01],i[msk02],i[msk10]))
+        lo = np.concatenate((zero[msk01],xlim0[msk01],
+                             xlim0[msk02],zero[msk10]))
+        hi = np.concatenate((xlim0[msk01],xlim1[msk01],
+                             xlim1[msk02],xlim1[msk10]))
+        w = np.concatenate((2*np.ones(np.sum(msk01)),
+                            np.ones(np.sum(msk01)+np.sum(msk02)),
+                            2*np.ones(np.sum(msk10))))
 
-            # If observer inside the halo...
-            if self._rmax > dhalo[i]:
+        if self._ann: losfn_type = LoSFn
+        else: losfn_type = LoSFnDecay
 
-                if psi[i] < np.pi/2.:
+        def fn(x,idx):
+            j = i[idx]
+            return losfn_type(dhalo[j],psi[j],self._dp,self._alpha)(x)
 
-                    x0 = np.power(dhalo[i]*np.cos(psi[i]),1./self._alpha)
-                    s0 = 2*quad(losfn,0.0,x0)[0]
+        s, serr = quad_batch(fn,lo,hi,epsabs=self._epsabs,
+                             epsrel=self._epsrel,nnode=self._nnode)
 
-                    x1 = np.power(np.sqrt(self._rmax**2 -
-                                          rmin**2),1./self._alpha)
-                
-                    s1 = quad(losfn,x0,x1)[0]
-                else:
-                    x0 = np.power(np.abs(dhalo[i]*np.cos(psi[i])),
-                                  1./self._alpha)
-
-                    x1 = np.power(np.sqrt(self._rmax**2 -
-                                          rmin**2),1./self._alpha)
-                    s1 = quad(losfn,x0,x1)[0]
-
-            # If observer outside the halo...
-            elif self._rmax > rmin:
-                x0 = np.power(np.sqrt(self._rmax**2 -
-                                      rmin**2),1./self._alpha)
-                s0 = 2*quad(losfn,0.0,x0)[0]
-                
-            v[i] = s0+s1
+        v = np.bincount(i,weights=w*s,minlength=psi.size).reshape(shape)
 
-        return v
+        if return_err:
+            err = np.bincount(i,weights=w*serr,minlength=psi.size)
+            return v, err.reshape(shape)
+        else:
+            return v
 
 class LoSIntegralFnFast(LoSIntegralFn):
     """Vectorized version of LoSIntegralFn that performs midpoint
@@ -278,35 +304,103 @@ class LoSIntegralFnFast(LoSIntegralFn):
         return v
 
 class LoSIntegralSplineFn(object):
+    """Interpolation table of the LoS integral for a density profile
+    with rhos = 1 and rs = 1.  The table is defined on a mesh in log
+    halo distance, log offset angle, and optionally a set of profile
+    shape parameters and is evaluated with linear interpolation in
+    log J.  Because the LoS integral scales as rhos^2*rs at fixed
+    d/rs, a single table can be used for any choice of rhos and rs.
+    For a profile with a density cap (rmin or rhomax) the cap is
+    tabulated in units of rs and rhos, so the table applies to
+    profiles with the same values of rmin/rs and rhomax/rhos.
+
+    Parameters
+    ----------
+    dp : Density profile.  The table is computed for a copy of this
+    profile rescaled to rhos = 1 and rs = 1.
+
+    dhalo : Array of halo distances (in units of rs) at which the LoS
+    integral is tabulated.
+
+    psi : Array of offset angles (in radians) at which the LoS
+    integral is tabulated.
+
+    shape_params : Dictionary of arrays with the values of profile
+    shape parameters (e.g. {'gamma' : [0.5,1.0,1.5]}) at which the
+    LoS integral is tabulated.  The keys are the profile attributes
+    without the leading underscore.
+
+    rmax : Radius (in units of rs) at which the LoS integral is
+    truncated.
+
+    alpha, ann, epsrel : Parameters passed to LoSIntegralFn when
+    computing the table.
+    """
+
+    def __init__(self,dp=None,dhalo=None,psi=None,shape_params=None,
+                 rmax=100.,alpha=3.0,ann=True,epsrel=1E-6):
 
-    def __init__(self,dp=None,nx=40,ny=20):
         self.dp = copy.copy(dp)
+        self._names = []
+        self._axes = []
+        self._interp = None
 
-        if self.dp is not None:
-            nx = 40
-            ny = 20
-            dhalo, psi = np.mgrid[1:2:ny*1j,0.001:2.0:nx*1j]
-            dhalo = np.power(10,dhalo)
-            psi = np.radians(psi)            
-            f = LoSIntegralFn(self.dp)
-            self.z = f(dhalo,psi)
-            self.init_spline(dhalo,psi,self.z)
-
-    def init_spline(self,dhalo,psi,z):
-        """Compute knots and coefficients of an interpolating spline
-        given a grid of points in halo distance (dhalo) and offset
-        angle (psi) at which the LoS integral has been computed.
-        """
+        if self.dp is None: return
+
+        if dhalo is None: dhalo = np.logspace(0.,3.,61)
+        if psi is None: psi = np.radians(np.logspace(-3.,2.,201))
+        if shape_params is None: shape_params = {}
+
+        if self.dp._rmin is not None: self.dp._rmin /= self.dp._rs
+        if self.dp._rhomax is not None: self.dp._rhomax /= self.dp._rhos
+        self.dp._rhos = 1.0
+        self.dp._rs = 1.0
+
+        self._names = ['dhalo','psi'] + sorted(shape_params.keys())
+        self._axes = [np.log10(dhalo),np.log10(psi)]
+        self._axes += [np.array(shape_params[k],ndmin=1,dtype=float)
+                       for k in self._names[2:]]
+
+        dhalo, psi = np.meshgrid(dhalo,psi,indexing='ij')
+        shape = [len(x) for x in self._axes]
+        z = np.zeros(shape)
+
+        for idx in np.ndindex(*shape[2:]):
+
+            for k, i in zip(self._names[2:],idx):
+                setattr(self.dp,'_' + k,self._axes[self._names.index(k)][i])
+                
+            f = LoSIntegralFn(self.dp,1.0,rmax,alpha=alpha,ann=ann,
+                              epsrel=epsrel)
+            z[(slice(None),slice(None)) + idx] = f(psi,dhalo)
+
+        self.init_table(z)
+
+    def init_table(self,z):
+        """Initialize the interpolator given the LoS integral
+        evaluated on the table mesh."""
+
+        z = np.array(z,dtype=float)
+        zmin = np.min(z[z>0]) if np.any(z>0) else 1.0
+        z = np.log10(np.maximum(z,1E-10*zmin))
 
-        kx = 2
-        ky = 2
-        self._psi_min = psi.min()
-        self._tck = bisplrep(dhalo,psi,np.log10(z),s=0.0,kx=kx,ky=ky,
-                             nxest=int(kx+np.sqrt(len(z.flat))),
-                             nyest=int(ky+np.sqrt(len(z.flat))))
+        self._z = z
+        self._interp = GridInterpolator(self._axes,z)
 
-    def __call__(self,dhalo,psi,rho=1,rs=1):
-        """Compute the LoS integral using a 2D spline table.
+    def __call__(self,dhalo,psi,rho=1,rs=1,**shape_params):
+        """Compute the LoS integral using the interpolation table.
+        All arguments are broadcast against each other and may be
+        arrays of scattered points.
+
+        Parameters
+        ----------
+        dhalo : Halo distance.
+
+        psi : Offset angle in radians.
+
+        rho : Density normalization (rhos).
+
+        rs : Scale radius.  The table is evaluated at dhalo/rs.
 
         Returns
         -------
@@ -314,20 +408,45 @@ class LoSIntegralSplineFn(object):
         vals: LoS amplitude per steradian.
         """
 
-        dhalo = np.asarray(dhalo)
-        psi = np.asarray(psi)
+        rho = np.asarray(rho)
+        rs = np.asarray(rs)
 
-        if dhalo.ndim == 0: dhalo = np.array([dhalo])
-        if psi.ndim == 0: psi = np.array([psi])
+        args = [np.log10(dhalo/rs),np.log10(psi)]
+        args += [shape_params[k] for k in self._names[2:]]
+        args += [rho,rs]
+        args = np.broadcast_arrays(*args)
 
-        if psi.ndim == 2 and dhalo.ndim == 2:
-            v = np.power(10,bisplev(dhalo[:,0],psi[0,:],self._tck))
-        else:
-            v = np.power(10,bisplev(dhalo,psi,self._tck))
+        shape = args[0].shape
+        x = np.vstack([np.ravel(t) for t in args[:len(self._names)]])
 
-        v *= rho*rho*rs
+        v = np.power(10,self._interp(x)).reshape(shape)
+        v *= args[-2]*args[-2]*args[-1]
         return v
 
+    def save(self,outfile):
+        """Write the table to an npz file."""
+        
+        d = { 'names' : np.array(self._names), 'z' : self._z }
+        for k, x in zip(self._names,self._axes):
+            d['axis_' + k] = x
+
+        np.savez(outfile,**d)
+
+    @staticmethod
+    def load(infile):
+        """Create a table object from an npz file written with
+        LoSIntegralSplineFn.save."""
+
+        fn = LoSIntegralSplineFn()
+
+        with np.load(infile) as f:
+            fn._names = [str(t) for t in f['names']]
+            fn._axes = [f['axis_' + k] for k in fn._names]
+            fn._z = f['z']
+
+        fn._interp = GridInterpolator(fn._axes,fn._z)
+        return fn
+
 
 def SolidAngleIntegral(psi,pdf,angle):
     """ Compute the solid-angle integrated j-value
@@ -362,7 +481,10 @@ def SolidAngleIntegral(psi,pdf,angle):
     return integral*scale
 
 class JProfile(object):
-    def __init__(self,losfn):
+    """Spline interpolation of the LoS integral and its cumulative
+    integral in solid angle.  If a JTableCache is given the LoS
+    integral table is read from the cache when available."""
+    def __init__(self,losfn,cache=None):
 
         self._log_psi = np.linspace(np.log10(np.radians(0.001)),
                                     np.log10(np.radians(90.)),1000)
@@ -371,15 +493,16 @@ class JProfile(object):
         domega = 2*np.pi*(-np.cos(self._psi[1:])+np.cos(self._psi[:-1]))
         x = 0.5*(self._psi[1:]+self._psi[:-1])
 
-        self._jpsi = losfn(self._psi)
+        if cache is None: self._jpsi = losfn(self._psi)
+        else: self._jpsi = cache.tabulate(losfn,self._psi)[0]
         self._spline = UnivariateSpline(self._psi,self._jpsi,s=0,k=2)
         self._jcum = np.cumsum(self._spline(x)*domega)
         self._cum_spline = UnivariateSpline(x,self._jcum,s=0,k=2)
 
     @staticmethod
-    def create(dp,dist,rmax):
+    def create(dp,dist,rmax,cache=None):
         losfn = LoSIntegralFn(dp,dist,rmax=rmax)        
-        return JProfile(losfn)
+        return JProfile(losfn,cache)
 
     def __call__(self,psi):
         return self._spline(psi)
@@ -397,92 +520,310 @@ class JProfile(object):
 #        dcos = -np.cos(psi[1:])+np.cos(psi[:-1])
 #        return np.cumsum(self._spline(x)*dcos)
 
+class JTableCache(object):
+    """Persistent on-disk cache of tabulated LoS integrals.  Each
+    table is stored as an npz file in cachedir with a name given by
+    a hash of the density profile class and parameters, the halo
+    distance, the truncation radius, the integrator settings, and
+    the grid of offset angles.  When the total size of the cache
+    exceeds max_bytes the least recently used tables are removed.
+
+    Parameters
+    ----------
+    cachedir : str
+        Cache directory.  Defaults to $GAMMATOOLS_CACHE or
+        ~/.gammatools/cache.
+
+    max_bytes : int
+        Maximum size of the cache in bytes.
+    """
+
+    def __init__(self,cachedir=None,max_bytes=256*1024**2):
+
+        if cachedir is None:
+            cachedir = os.environ.get('GAMMATOOLS_CACHE',
+                                      os.path.join(os.path.expanduser('~'),
+                                                   '.gammatools','cache'))
+        self._cachedir = os.path.join(cachedir,'jtable')
+        self._max_bytes = max_bytes
+
+    @property
+    def cachedir(self):
+        return self._cachedir
+
+    @staticmethod
+    def _state(obj):
+        """Return a sorted list of the scalar attributes of an
+        object."""
+        state = []
+        for k, v in sorted(vars(obj).items()):
+            if isinstance(v,(bool,int,long,float,str,type(None))):
+                state.append((k,v))
+            elif isinstance(v,np.ndarray) and v.ndim == 0:
+                state.append((k,v.item()))
+        return [obj.__class__.__name__] + state
+
+    def key(self,losfn,psi):
+        """Compute the cache key for the LoS integral losfn evaluated
+        at the angles psi."""
+
+        h = hashlib.sha1()
+        h.update(repr(self._state(losfn._dp)))
+        h.update(repr(self._state(losfn)))
+        h.update(np.ascontiguousarray(psi,dtype=float).tostring())
+        return h.hexdigest()
+
+    def path(self,key):
+        return os.path.join(self._cachedir,key + '.npz')
+
+    def load(self,key):
+        """Load the table with the given key.  Returns None if the
+        table is not in the cache."""
+
+        path = self.path(key)
+        if not os.path.isfile(path): return None
+
+        try:
+            with np.load(path) as f:
+                d = dict([(k,f[k]) for k in f.files])
+        except (IOError,ValueError,zipfile.BadZipfile):
+            return None
+
+        # Update access time for LRU eviction
+        try: os.utime(path,None)
+        except OSError: pass
+        return d
+
+    def save(self,key,**arrays):
+        """Write a table to the cache."""
+
+        make_dir(self._cachedir)
+
+        with atomic_write(self.path(key)) as f:
+            np.savez(f,**arrays)
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used tables until the cache
+        size is below max_bytes."""
+
+        if not os.path.isdir(self._cachedir): return
+
+        files = []
+        for f in os.listdir(self._cachedir):
+            if not f.endswith('.npz'): continue
+            path = os.path.join(self._cachedir,f)
+            try: st = os.stat(path)
+            except OSError: continue
+            files.append((st.st_mtime,st.st_size,path))
+
+        nbytes = sum([t[1] for t in files])
+        for mtime, size, path in sorted(files):
+            if nbytes <= self._max_bytes: break
+            try: os.remove(path)
+            except OSError: continue
+            nbytes -= size
+
+    def clear(self):
+        """Remove all tables from the cache."""
+        if not os.path.isdir(self._cachedir): return
+        for f in os.listdir(self._cachedir):
+            if f.endswith('.npz'): os.remove(os.path.join(self._cachedir,f))
+
+    def tabulate(self,losfn,psi):
+        """Return the LoS integral and the cumulative J(<psi) for the
+        LoS integral object losfn at the offset angles psi (in
+        radians).  The tables are read from the cache if available
+        and otherwise computed and saved.
+
+        Returns
+        -------
+        jpsi : `~numpy.ndarray`
+            LoS integral per steradian at psi.
+
+        jcum : `~numpy.ndarray`
+            LoS integral within psi.
+        """
+
+        psi = np.array(psi,ndmin=1,dtype=float)
+        key = self.key(losfn,psi)
+
+        d = self.load(key)
+        if d is not None: return d['jpsi'], d['jcum']
+
+        jpsi = losfn(psi)
+
+        # J(<psi) with the trapezoid rule in solid angle.  The LoS
+        # integral is assumed constant inside the first angle.
+        domega = 2*np.pi*(np.cos(psi[:-1])-np.cos(psi[1:]))
+        jcum = np.zeros(psi.shape)
+        jcum[0] = jpsi[0]*2*np.pi*(1.-np.cos(psi[0]))
+        jcum[1:] = jcum[0] + np.cumsum(0.5*(jpsi[1:]+jpsi[:-1])*domega)
+
+        self.save(key,psi=psi,jpsi=jpsi,jcum=jcum)
+        return jpsi, jcum
+
+jtable_cache = JTableCache()
+
 class ROIIntegrator(object):
+    """Compute the J factor integrated over a Galactic center ROI
+    defined by a latitude cut, a longitude cut, and an optional list
+    of masked point sources.  The sky is divided into HEALPix pixels
+    and the ROI mask is evaluated for all pixels in a single pass.
+    The J factor of each ring in Galactocentric angle is integrated
+    from the J profile and weighted by the unmasked fraction of the
+    ring solid angle.  The pixel geometry and ring integrals are
+    computed once such that compute() can be called repeatedly to
+    scan over ROI definitions.
+
+    Parameters
+    ----------
+    jspline : Function returning the LoS integral at an offset angle
+    (in radians) from the Galactic center.
+
+    lat_cut : Minimum absolute Galactic latitude in degrees.  Pixels
+    at lower latitude are kept only when |lon| < lon_cut.
+
+    lon_cut : Longitude cut in degrees.
+
+    source_list : Path to a text file with the latitude and longitude
+    of sources to be masked in columns 1 and 2 (in degrees) or an
+    array with shape (2,nsrc).
+
+    src_radius : Radius in degrees of the mask around each source.
+
+    nside : HEALPix nside parameter of the sky pixelization.
+    """
+
+    def __init__(self,jspline,lat_cut,lon_cut,source_list=None,
+                 src_radius=0.62,nside=512,nbin_thetagc=720,
+                 thetagc_max=180.):
 
-    def __init__(self,jspline,lat_cut,lon_cut,source_list=None):
+        import healpy
 
         self._jspline = jspline
         self._lat_cut = lat_cut
         self._lon_cut = lon_cut
+        self._src_radius = src_radius
+        self._nside = nside
 
-        nbin_thetagc = 720
-        thetagc_max = 180.
-
-        self._phi_edges = np.linspace(0.,360.,720+1)
         self._theta_edges = np.linspace(0.,thetagc_max,nbin_thetagc+1)
+        self._theta = 0.5*(self._theta_edges[:-1] + self._theta_edges[1:])
 
         self._sources = None
 
-        if not source_list is None:
-            source_list = np.loadtxt(opts.source_list,unpack=True,usecols=(1,2))
-            self._sources = Vector3D.createLatLon(np.radians(source_list[0]),
-                                                  np.radians(source_list[1]))
+        if isinstance(source_list,str):
+            self._sources = np.loadtxt(source_list,unpack=True,usecols=(1,2))
+        elif source_list is not None:
+            self._sources = np.array(source_list,ndmin=2)
+
+        # Pixel coordinates and Galactocentric angle
+        npix = healpy.nside2npix(nside)
+        th, phi = healpy.pix2ang(nside,np.arange(npix))
+        lat = np.pi/2. - th
+        lon = np.where(phi > np.pi,phi-2*np.pi,phi)
+        rgc = np.degrees(ahavsin(havsin(lat) + np.cos(lat)*havsin(lon)))
+
+        ring = np.digitize(rgc,self._theta_edges)-1
+        msk = ring < nbin_thetagc
+
+        self._rgc = rgc
+        self._pix = np.arange(npix)[msk]
+        self._ring = ring[msk]
+        self._abslat = np.abs(np.degrees(lat[msk]))
+        self._abslon = np.abs(np.degrees(lon[msk]))
+        self._ring_npix = np.bincount(self._ring,minlength=nbin_thetagc)
+
+        # Pixels outside the source mask
+        self._src_msk = np.ones(npix,dtype=bool)
+        if self._sources is not None:
+            vec = healpy.ang2vec(np.radians(90.-self._sources[0]),
+                                 np.radians(self._sources[1]))
+            for v in vec:
+                ipix = healpy.query_disc(nside,v,np.radians(src_radius))
+                self._src_msk[ipix] = False
+        self._src_msk_ring = self._src_msk[self._pix]
+
+        # Integral of J over each ring
+        npts = 100
+        xedge = np.radians(self._theta_edges)
+        dx = (xedge[1:] - xedge[:-1])/float(npts)
+        x = xedge[:-1,np.newaxis] + \
+            dx[:,np.newaxis]*(np.arange(npts)[np.newaxis,:]+0.5)
+        jx = np.reshape(self._jspline(np.ravel(x)),x.shape)
+        self._jring = 2.*np.pi*np.sum(jx*np.sin(x),axis=1)*dx
+
+        costh_edges = np.cos(xedge)
+        self._domega_ring = 2.*np.pi*(costh_edges[:-1]-costh_edges[1:])
 
         self.compute()
 
-    def compute(self):
-        
-        yaxis = Vector3D(np.pi/2.*np.array([0.,1.,0.]))
-
-        costh_edges = np.cos(np.radians(self._theta_edges))
-        costh_width = costh_edges[:-1]-costh_edges[1:]
-    
-        phi = 0.5*(self._phi_edges[:-1] + self._phi_edges[1:])
-        self._theta = 0.5*(self._theta_edges[:-1] + self._theta_edges[1:])
-
-        self._jv = []
-        self._domega = []
+    def _mask(self,lat_cut=None,lon_cut=None):
 
-        for i0, th in enumerate(self._theta):
+        if lat_cut is None: lat_cut = self._lat_cut
+        if lon_cut is None: lon_cut = self._lon_cut
 
-            jtot = integrate(lambda t: self._jspline(t)*np.sin(t),
-                             np.radians(self._theta_edges[i0]),
-                             np.radians(self._theta_edges[i0+1]),100)
+        msk = (self._abslat>=lat_cut) | (self._abslon<lon_cut)
+        msk &= self._src_msk_ring
+        return msk
 
-#    jval = jspline(np.radians(th))*costh_width[i0]
-            v = Vector3D.createThetaPhi(np.radians(th),np.radians(phi))
-            v.rotate(yaxis)
+    def mask(self,lat_cut=None,lon_cut=None):
+        """Return a boolean HEALPix map that is true for pixels
+        inside the ROI."""
 
-            lat = np.degrees(v.lat())
-            lon = np.degrees(v.phi())
+        msk = np.zeros(len(self._src_msk),dtype=bool)
+        msk[self._pix] = self._mask(lat_cut,lon_cut)
+        return msk
 
-            src_msk = len(lat)*[True]
+    def jmap(self,lat_cut=None,lon_cut=None):
+        """Return a HEALPix map of the J factor integrated over
+        each pixel inside the ROI.  The LoS integral is evaluated at
+        the pixel center."""
 
-            if not self._sources is None:
+        import healpy
 
-                for k in range(len(v.lat())):
-                    p = Vector3D(v._x[:,k])
+        domega = healpy.nside2pixarea(self._nside)
+        return self._jspline(np.radians(self._rgc))*domega* \
+            self.mask(lat_cut,lon_cut)
 
-                    sep = np.degrees(p.separation(self._sources))
-                    imin = np.argmin(sep)
-                    minsep = sep[imin]
+    def compute(self,lat_cut=None,lon_cut=None):
+        """Compute the J factor and solid angle of the ROI inside
+        each Galactocentric angle.
 
-                    if minsep < 0.62: src_msk[k] = False
+        Returns
+        -------
+        theta : `~numpy.ndarray`
+            Array of Galactocentric angles in degrees.
 
-            msk = ((np.abs(lat)>=self._lat_cut) |
-                   ((np.abs(lat)<=self._lat_cut)&(np.abs(lon)<self._lon_cut)))
+        jv_cum : `~numpy.ndarray`
+            Cumulative J factor inside theta.
 
-            msk &= src_msk
-            dphi = 2.*np.pi*float(len(lat[msk]))/float(len(phi))
+        domega_cum : `~numpy.ndarray`
+            Cumulative solid angle inside theta.
+        """
 
-#    hc._counts[i0,msk] = 1
+        msk = self._mask(lat_cut,lon_cut)
+        nmsk = np.bincount(self._ring[msk],minlength=len(self._theta))
 
-            jtot *= dphi
-#            jsum += jtot
-#            domegasum += costh_width[i0]*dphi
+        # Fraction of each ring inside the ROI.  The fraction for
+        # rings without pixels is interpolated from the neighboring
+        # rings.
+        has_pix = self._ring_npix > 0
+        idx = np.arange(len(self._theta))
+        frac = np.interp(idx,idx[has_pix],nmsk[has_pix]/
+                         self._ring_npix[has_pix].astype(float))
 
-            self._jv.append(jtot)
-            self._domega.append(costh_width[i0]*dphi)
-    
-        self._jv = np.array(self._jv)
+        self._jv = self._jring*frac
         self._jv_cum = np.cumsum(self._jv)
-
         self._jv_cum_spline = UnivariateSpline(self._theta_edges[1:],
                                                self._jv_cum,
                                                s=0,k=1)
 
-        self._domega = np.array(self._domega)
+        self._domega = self._domega_ring*frac
         self._domega_cum = np.cumsum(self._domega)
+
+        return self._theta_edges[1:], self._jv_cum, self._domega_cum
     
     def eval(self,rgc,decay=False):
         
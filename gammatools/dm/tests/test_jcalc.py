@@ -0,0 +1,182 @@
+import unittest
+import numpy as np
+from numpy.testing import assert_almost_equal
+from scipy.integrate import quad
+from gammatools.dm.jcalc import *
+
+class TestJCalc(unittest.TestCase):
+
+    def test_los_integral(self):
+
+        dp = NFWProfile(1.0,1.0)
+        psi = np.radians(np.array([0.01,0.1,1.0,10.,60.,120.]))
+
+        for dist, rmax in [(100.,10.),(8.5,100.)]:
+
+            fn = LoSIntegralFn(dp,dist,rmax,epsrel=1E-8)
+            v, err = fn(psi,return_err=True)
+
+            vref = []
+            for t in psi:
+
+                losfn = lambda x: dp.rho(np.sqrt(x**2+(dist*np.sin(t))**2))**2
+                x1 = np.sqrt(rmax**2-min(rmax,dist*np.sin(t))**2)
+                x0 = dist*np.cos(t)
+
+                if rmax < dist: 
+                    vref.append(2*quad(losfn,0,x1,epsrel=1E-10,limit=200)[0])
+                else:
+                    vref.append(quad(losfn,-x0,x1,epsrel=1E-10,
+                                     limit=200,points=[0.0])[0])
+
+            vref = np.array(vref)
+            msk = vref > 0
+
+            assert_almost_equal(v[msk]/vref[msk],np.ones(np.sum(msk)),6)
+            assert_almost_equal(v[~msk],vref[~msk])
+            self.assertTrue(np.all(err <= 1E-6*v))
+
+            # Halo distance array
+            v1 = fn(psi,dist*np.ones(len(psi)))
+            assert_almost_equal(v1,v,10)
+
+    def test_los_integral_inf(self):
+        """LoS integral without truncation radius."""
+
+        dp = NFWProfile(1.0,1.0)
+        psi = np.radians(np.array([0.01,0.1,1.0,10.,60.,120.]))
+
+        for dist in [100.,8.5]:
+
+            v, err = LoSIntegralFn(dp,dist,epsrel=1E-8)(psi,return_err=True)
+
+            vref = []
+            for t in psi:
+
+                losfn = lambda x: dp.rho(np.sqrt(x**2+(dist*np.sin(t))**2))**2
+                x0 = dist*np.cos(t)
+
+                # Split at the closest approach and multiples of the
+                # halo distance so that quad resolves the integrand
+                xp = [0.0,dist,10*dist,100*dist]
+                x = [-x0] + [xi for xi in xp if xi > -x0] + [np.inf]
+                vref.append(np.sum([quad(losfn,x[i],x[i+1],epsrel=1E-12,
+                                         limit=200)[0]
+                                    for i in range(len(x)-1)]))
+
+            vref = np.array(vref)
+            assert_almost_equal(v/vref,np.ones(len(psi)),6)
+            self.assertTrue(np.all(err <= 1E-6*v))
+
+    def test_jtable_cache(self):
+
+        import tempfile
+        import shutil
+
+        cachedir = tempfile.mkdtemp()
+
+        try:
+            cache = JTableCache(cachedir)
+            psi = np.radians(np.logspace(-2,1,50))
+
+            dp = NFWProfile(1.0,1.0)
+            fn = LoSIntegralFn(dp,100.,10.)
+            jpsi0, jcum0 = cache.tabulate(fn,psi)
+            assert_almost_equal(jpsi0,fn(psi))
+            self.assertEqual(len(os.listdir(cache.cachedir)),1)
+
+            # Cached table is returned without evaluating the LoS
+            # integral
+            jpsi1, jcum1 = cache.tabulate(fn,psi)
+            assert_almost_equal(jpsi1,jpsi0)
+            assert_almost_equal(jcum1,jcum0)
+
+            # A different profile or integrator creates a new table
+            cache.tabulate(LoSIntegralFn(NFWProfile(1.0,2.0),100.,10.),psi)
+            cache.tabulate(LoSIntegralFn(dp,100.,10.,epsrel=1E-8),psi)
+            self.assertEqual(len(os.listdir(cache.cachedir)),3)
+
+            # Cache size is bounded by max_bytes
+            cache = JTableCache(cachedir,max_bytes=0)
+            cache.evict()
+            self.assertEqual(len(os.listdir(cache.cachedir)),0)
+
+            jp0 = JProfile(fn)
+            jp1 = JProfile(fn,cache=JTableCache(cachedir))
+            assert_almost_equal(jp1(psi)/jp0(psi),np.ones(len(psi)))
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_los_integral_spline(self):
+
+        import tempfile
+        import shutil
+
+        dhalo = np.logspace(0.,3.,41)
+        psi = np.radians(np.logspace(-3.,2.,101))
+        gamma = np.linspace(0.5,1.5,3)
+
+        fn = LoSIntegralSplineFn(GNFWProfile(),dhalo,psi,
+                                 shape_params={'gamma' : gamma})
+
+        np.random.seed(1)
+        rs = 2.0
+        d = rs*np.power(10,np.random.uniform(0.,2.,20))
+        p = np.radians(np.power(10,np.random.uniform(-2.,1.,20)))
+        
+        # Scattered evaluation at tabulated values of gamma
+        for g in [0.5,1.0]:
+            dp = GNFWProfile(3.0,rs,gamma=g)
+            vref = LoSIntegralFn(dp,1.0,100.*rs)(p,d)
+            v = fn(d,p,rho=3.0,rs=rs,gamma=g)
+            assert_almost_equal(v/vref,np.ones(len(d)),2)
+
+        # Profiles with a density cap
+        dhalo = np.logspace(0.,3.,31)
+        psi = np.radians(np.logspace(-3.,2.,81))
+        d = np.array([5.,20.,50.])
+        p = np.radians(np.array([0.01,0.1,1.0]))
+        for dp in [NFWProfile(2.0,0.5),NFWProfile(2.0,0.5,rhomax=0.5),
+                   NFWProfile(2.0,0.5,rmin=0.05),
+                   NFWProfile(2.0,0.5,rmin=0.05,rhomax=5.0)]:
+            fn_cap = LoSIntegralSplineFn(dp,dhalo,psi)
+            vref = LoSIntegralFn(dp,1.0,100.*dp.rs)(p,d)
+            v = fn_cap(d,p,rho=dp.rhos,rs=dp.rs)
+            assert_almost_equal(v/vref,np.ones(len(d)),2)
+
+        # Serialize and reload
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outfile = os.path.join(tmpdir,'table.npz')
+            fn.save(outfile)
+            fn1 = LoSIntegralSplineFn.load(outfile)
+            assert_almost_equal(fn1(d,p,gamma=1.2),fn(d,p,gamma=1.2))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_roi_integrator(self):
+
+        fn = lambda t: np.ones(np.shape(t))
+        
+        roi = ROIIntegrator(fn,10.,0.,nside=128)
+        th, jcum, domega = roi.compute()
+
+        # Solid angle of |b| > 10 deg
+        assert_almost_equal(domega[-1]/(4*np.pi),1.-np.sin(np.radians(10.)),2)
+        assert_almost_equal(jcum,domega)
+
+        # Scan over ROI definitions
+        th, jcum, domega = roi.compute(0.,0.)
+        assert_almost_equal(domega[-1],4*np.pi)
+        th, jcum, domega = roi.compute(90.,0.)
+        assert_almost_equal(domega[-1],0.0)
+
+        # Source mask
+        roi = ROIIntegrator(fn,0.,0.,source_list=[[30.],[40.]],
+                            src_radius=5.0,nside=128)
+        th, jcum, domega = roi.compute()
+        
+        assert_almost_equal((4*np.pi-domega[-1])/
+                            (2*np.pi*(1.-np.cos(np.radians(5.0)))),1.0,2)
+        self.assertEqual(np.sum(~roi.mask()),
+                         len(roi.mask())-np.sum(roi.jmap()>0))
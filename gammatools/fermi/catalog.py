@@ -21,6 +21,7 @@ import copy
 import re
 
 import xml.etree.cElementTree as et
+from scipy.spatial import cKDTree
 
 from gammatools.core.astropy_helper import pyfits
 import matplotlib.pyplot as plt
@@ -38,6 +39,74 @@ def latlon_to_xyz(lat,lon):
                      np.sin(theta)*np.sin(phi),
                      np.cos(theta)]).T
 
+def radec_to_xyz(ra,dec):
+    """Convert celestial coordinates in degrees to an array of unit
+    vectors with shape (n,3)."""
+    return latlon_to_xyz(np.radians(np.array(dec,ndmin=1,dtype=float)),
+                         np.radians(np.array(ra,ndmin=1,dtype=float)))
+
+def chord_to_angle(d):
+    """Convert the distance between two unit vectors to an angle
+    in radians."""
+    return 2.0*np.arcsin(np.minimum(0.5*d,1.0))
+
+def angle_to_chord(angle):
+    """Convert an angle in radians to the distance between two unit
+    vectors."""
+    return 2.0*np.sin(0.5*np.minimum(angle,np.pi))
+
+def create_tree(xyz):
+    """Create a KD-tree of an array of unit vectors with shape
+    (n,3)."""
+    return cKDTree(xyz,balanced_tree=False,compact_nodes=False)
+
+def match_positions(xyz0,xyz1,radius,tree0=None,tree1=None):
+    """Find all pairs of directions from two sets of unit vectors
+    that are separated by less than a given angle.  Pairs are found in
+    a single pass over KD-trees of the two sets.
+
+    Parameters
+    ----------
+    xyz0, xyz1 : array
+        Unit vectors with shape (n,3).
+
+    radius : float
+        Maximum angular separation in radians.
+
+    tree0, tree1 : cKDTree
+        Precomputed KD-trees of xyz0 and xyz1.
+
+    Returns
+    -------
+    i0, i1 : array
+        Indices in xyz0 and xyz1 of each pair.  Pairs are sorted by i0
+        and then by i1.
+
+    sep : array
+        Angular separation in radians of each pair.
+    """
+
+    if len(xyz0) == 0 or len(xyz1) == 0:
+        return (np.zeros(0,dtype=int),np.zeros(0,dtype=int),np.zeros(0))
+
+    if tree0 is None: tree0 = create_tree(xyz0)
+    if tree1 is None: tree1 = create_tree(xyz1)
+
+    pairs = tree0.sparse_distance_matrix(tree1,
+                                         angle_to_chord(radius)*(1+1E-12),
+                                         output_type='ndarray')
+
+    isort = np.argsort(pairs['i']*len(xyz1) + pairs['j'])
+    i0 = pairs['i'][isort]
+    i1 = pairs['j'][isort]
+
+    # Recompute the separation from the vectors since pairs with zero
+    # distance are not returned with an exact distance
+    sep = chord_to_angle(np.sqrt(np.sum((xyz0[i0]-xyz1[i1])**2,axis=1)))
+
+    msk = sep < radius
+    return i0[msk], i1[msk], sep[msk]
+
 
 class CatalogSource(object):
 
@@ -159,6 +228,12 @@ class Catalog(object):
         self._src_data = []
         self._src_index = {}
         self._src_radec = np.zeros(shape=(0,3))
+        self._tree = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_tree',None)
+        return state
 
     def get_source_by_name(self,name):
 
@@ -167,19 +242,87 @@ class Catalog(object):
         else:
             return None
 
-    def get_source_by_position(self,ra,dec,radius,min_radius=None):
-        
-        x = latlon_to_xyz(np.radians(dec),np.radians(ra))
-        costh = np.sum(x*self._src_radec,axis=1)        
-        costh[costh>1.0] = 1.0
+    def spatial_index(self):
+        """Return a KD-tree of the source directions.  The tree is
+        built on the first call and reused until a source is
+        added."""
+
+        if getattr(self,'_tree',None) is None:
+            self._tree = create_tree(self._src_radec[:len(self._src_data)])
+        return self._tree
+
+    def query_radius(self,ra,dec,radius,min_radius=None):
+        """Find the sources within a radius of a set of positions.
+
+        Parameters
+        ----------
+        ra, dec : array
+            Celestial coordinates in degrees of the positions.
+
+        radius : float
+            Search radius in degrees.
+
+        min_radius : float
+            Only return sources further than this radius in degrees.
+
+        Returns
+        -------
+        ipos : array
+            Position index of each matched source.
+
+        isrc : array
+            Source index of each matched source.  The corresponding
+            sources are returned by sources().
+
+        sep : array
+            Angular separation in degrees.
+
+        Matches are sorted by position index and then by source
+        index.
+        """
+
+        xyz = radec_to_xyz(ra,dec)
+        nsrc = len(self._src_data)
+
+        ipos, isrc, sep = match_positions(xyz,self._src_radec[:nsrc],
+                                          np.radians(radius),
+                                          tree1=self.spatial_index())
+        sep = np.degrees(sep)
 
         if min_radius is not None:
-            msk = np.where((np.arccos(costh) < np.radians(radius)) &
-                           (np.arccos(costh) > np.radians(min_radius)))[0]
-        else:
-            msk = np.where(np.arccos(costh) < np.radians(radius))[0]
+            msk = sep > min_radius
+            ipos, isrc, sep = ipos[msk], isrc[msk], sep[msk]
+
+        return ipos, isrc, sep
+
+    def nearest(self,ra,dec,k=1):
+        """Find the k nearest sources to a set of positions.
+
+        Parameters
+        ----------
+        ra, dec : array
+            Celestial coordinates in degrees of the positions.
+
+        k : int
+            Number of sources.
+
+        Returns
+        -------
+        isrc : array
+            Source indices with shape (n,) if k = 1 or (n,k)
+            otherwise.  Neighbors are sorted by distance.
+
+        sep : array
+            Angular separation in degrees.
+        """
+
+        d, isrc = self.spatial_index().query(radec_to_xyz(ra,dec),k)
+        return isrc, np.degrees(chord_to_angle(d))
+
+    def get_source_by_position(self,ra,dec,radius,min_radius=None):
 
-        srcs = [ self._src_data[i] for i in msk]
+        ipos, isrc, sep = self.query_radius(ra,dec,radius,min_radius)
+        srcs = [ self._src_data[i] for i in isrc]
         return srcs
 
     def sources(self):
@@ -517,6 +660,7 @@ class Catalog(object):
         src_index = len(self._src_data)
 
         self._src_data.append(src)
+        self._tree = None
         phi = np.radians(src['RAJ2000'])
         theta = np.pi/2.-np.radians(src['DEJ2000'])
 
@@ -619,6 +763,7 @@ class Catalog(object):
         self._src_data = d['src_data']
         self._src_index = d['src_name_index']
         self._src_radec = d['src_radec']
+        self._tree = None
 
         
             
@@ -9,10 +9,11 @@
 __author__   = "Matthew Wood"
 __date__     = "01/01/2013"
 
+import os
 import numpy as np
 import re
 import copy
-import pyfits
+from gammatools.core.astropy_helper import pyfits
 from gammatools.core.algebra import Vector3D
 import matplotlib.pyplot as plt
 from catalog import Catalog, CatalogSource
@@ -20,6 +21,8 @@ from catalog import Catalog, CatalogSource
 from gammatools.core.histogram import *
 import yaml
 from gammatools.core.util import expand_aliases, eq2gal, interpolate2d
+from gammatools.core.util import save_object, load_object
+from gammatools.core.column_store import ColumnStore
 
 
 class Data(object):
@@ -50,6 +53,214 @@ class Data(object):
 
 
 
+_cut_defs_cache = {}
+_cut_expr_cache = {}
+
+def load_cut_defs(cuts_file):
+    """Load a dictionary of cut definitions from a YAML file.  The
+    definitions are cached and reloaded only when the file is
+    modified."""
+
+    mtime = os.path.getmtime(cuts_file)
+    if (cuts_file,mtime) in _cut_defs_cache:
+        return _cut_defs_cache[(cuts_file,mtime)]
+    
+    cut_defs = yaml.load(open(cuts_file,'r'))
+    cut_defs['CTBBestLogEnergy'] = 'data[\'energy\']'
+    cut_defs['CTBCORE'] = 'data[\'psfcore\']'
+    cut_defs['pow'] = 'np.power'
+    _cut_defs_cache[(cuts_file,mtime)] = cut_defs
+    return cut_defs
+
+def compile_cut(cut_defs,expr):
+    """Expand the aliases in a cut expression and compile it.
+    Compiled expressions are cached."""
+
+    expr = expand_aliases(cut_defs,expr)
+    if not expr in _cut_expr_cache:
+        _cut_expr_cache[expr] = compile(expr,'<cut>','eval')
+    return _cut_expr_cache[expr]
+
+class PhotonSelection(object):
+    """Compiled selection of photon events.  The selection criteria
+    are parsed once into a plan that can be applied to any number of
+    data sets.  Calling the object with a PhotonData (or any object
+    that returns columns by name) returns a boolean mask of the
+    events passing all criteria.
+
+    Parameters
+    ----------
+    selections : dict
+        Dictionary of inclusive ranges [lo, hi] keyed by column name.
+
+    conversion_type : str
+        Select front (front) or back (any other value) converting
+        events.
+
+    event_class : str
+        Select an event class by name (source, clean, ultraclean).
+
+    event_class_id : int
+        Select events with the given event class bit.  Takes
+        precedence over event_class.
+
+    event_type_id : int
+        Select events with the given event type bit.
+
+    phases : list
+        List of (lo, hi) phase intervals.  Events with a phase in any
+        of the open intervals or with a negative phase are selected.
+
+    cuts : str
+        Comma-separated list of cut expressions or var/lo/hi ranges.
+        Only applied if cuts_file is given.
+
+    src_index : list
+        List of source indices.  Events associated with one of these
+        sources or with a negative source index are selected.
+
+    cuts_file : str
+        YAML file with the definitions of the aliases used in cuts.
+    """
+
+    event_class_bits = { 'source' : 2, 'clean' : 3, 'ultraclean' : 4 }
+
+    def __init__(self,selections=None,conversion_type=None,
+                 event_class=None,
+                 event_class_id=None,
+                 event_type_id=None,
+                 phases=None,cuts=None,
+                 src_index=None,cuts_file=None):
+
+        self._ranges = []
+        if not selections is None:
+            self._ranges = [(k,v[0],v[1]) for k, v in selections.iteritems()]
+
+        self._conversion_type = None
+        if not conversion_type is None:
+            self._conversion_type = 0 if conversion_type == 'front' else 1
+
+        self._event_class_bit = None
+        if not event_class_id is None:
+            self._event_class_bit = int(event_class_id)
+        elif event_class in PhotonSelection.event_class_bits:
+            self._event_class_bit = PhotonSelection.event_class_bits[event_class]
+
+        self._event_type_bit = None
+        if not event_type_id is None:
+            self._event_type_bit = int(event_type_id)
+
+        # Lookup table of selected source indices.  The last element
+        # flags indices beyond the largest selected source.
+        self._src_index = None
+        if src_index is not None:
+            self._src_index = np.unique(np.array(src_index,dtype=int))
+            nlut = max(self._src_index.max(),-1)+2 \
+                if len(self._src_index) else 1
+            self._src_lut = np.zeros(nlut,dtype=bool)
+            self._src_lut[self._src_index[self._src_index>=0]] = True
+            
+        # Merge overlapping phase intervals into a sorted list of
+        # disjoint open intervals
+        self._phases = None
+        if phases is not None:
+            self._phases = []
+            p = np.array(phases,dtype=float).reshape((-1,2))
+            for lo, hi in p[np.argsort(p[:,0])]:
+                if self._phases and lo < self._phases[-1][1]:
+                    self._phases[-1][1] = max(hi,self._phases[-1][1])
+                else:
+                    self._phases.append([lo,hi])
+            self._phases = np.array(self._phases).reshape((-1,2))
+
+        self._cuts = []
+        if not cuts is None and not cuts_file is None:
+            cut_defs = load_cut_defs(cuts_file)
+
+            for c in cuts.split(','):
+                cv = c.split('/')
+                if len(cv) == 1:
+                    self._cuts.append(compile_cut(cut_defs,cv[0]))
+                elif len(cv) == 3:
+                    self._ranges.append((cv[0],float(cv[1]),float(cv[2]),
+                                         True))
+
+    @staticmethod
+    def _int_column(data,col):
+        v = np.asarray(data[col])
+        if v.dtype.kind in 'iu': return v
+        return v.astype('int')
+
+    def __call__(self,data):
+
+        mask = np.asarray(data['energy']) > 0
+        
+        for r in self._ranges:
+
+            # Ranges from cut strings are skipped for missing columns
+            if len(r) == 4 and not r[0] in data: continue
+            
+            v = data[r[0]]
+            mask &= (v >= r[1])
+            mask &= (v <= r[2])
+
+        if not self._conversion_type is None:
+            mask &= (data['conversion_type'] == self._conversion_type)
+        
+        for c in self._cuts:
+            mask &= eval(c,{'np' : np, 'data' : data})
+
+        if not self._event_class_bit is None:
+            mask &= ((self._int_column(data,'event_class') & 
+                      (1<<self._event_class_bit)) > 0)
+
+        if not self._event_type_bit is None:
+            mask &= ((self._int_column(data,'event_type') & 
+                      (1<<self._event_type_bit)) > 0)
+
+        if self._src_index is not None:
+            mask &= self._src_mask(data)
+
+        if self._phases is not None:
+            mask &= self._phase_mask(data)
+
+        return mask
+
+    def _phase_mask(self,data):
+
+        phase = np.asarray(data['phase'])
+        phase_mask = phase < 0
+
+        # For many intervals find the interval with the largest lower
+        # edge below each phase with a binary search
+        if len(self._phases) > 8:
+            lo, hi = self._phases[:,0], self._phases[:,1]
+            i = np.searchsorted(lo,phase,side='left')-1
+            phase_mask |= (i >= 0) & (phase < hi[np.maximum(i,0)])
+            return phase_mask
+
+        for lo, hi in self._phases:
+            phase_mask |= (phase > lo) & (phase < hi)
+        return phase_mask
+
+    def _src_mask(self,data):
+
+        offsets = getattr(data,'_src_offsets',None)
+
+        # Sorted data: select contiguous slices
+        if offsets is not None:
+            src_mask = np.zeros(len(data['src_index']),dtype=bool)
+            src_mask[data.src_slice(-1)] = True
+            for isrc in self._src_index:
+                if isrc >= 0: src_mask[data.src_slice(isrc)] = True
+            return src_mask
+
+        src = np.asarray(data['src_index'])
+        lut = self._src_lut
+        src_mask = lut[np.clip(src,0,len(lut)-1).astype(int)]
+        src_mask |= (src < 0)
+        return src_mask
+
 class PhotonData(object):
 
     def __init__(self):
@@ -70,8 +281,42 @@ class PhotonData(object):
                        'phase'         : np.array([]),
                        'cth'           : np.array([]) }
 
+        # Arrays appended to each column that have not yet been
+        # concatenated
+        self._chunks = {}
         self._srcs = []
 
+        # Offsets of the events of each source (see index_sources)
+        self._src_offsets = None
+
+    def __getstate__(self):
+        self._consolidate()
+        state = dict(self.__dict__)
+        del state['_chunks']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._chunks = {}
+        self.__dict__.setdefault('_src_offsets',None)
+
+    def _consolidate(self,cols=None):
+        """Concatenate the arrays appended to each column."""
+
+        if cols is None: cols = self._chunks.keys()
+
+        for col in cols:
+            chunks = self._chunks.pop(col,None)
+            if not chunks: continue
+            if col in self._data: chunks = [self._data[col]] + chunks
+            self._data[col] = np.concatenate(chunks)
+
+    def columns(self):
+        return self._data.keys()
+
+    def nrow(self):
+        return len(self['energy'])
+
     def get_srcs(self,names):
 
         src_index = []
@@ -92,25 +337,39 @@ class PhotonData(object):
     
 
     def merge(self,d):
+        """Append the rows of another PhotonData object.  Rows are
+        buffered and concatenated once when a column is next
+        accessed so that merging many objects has linear cost."""
 
         self._srcs = d._srcs
         
-        for k, v in self._data.iteritems():
-            self._data[k] = np.append(self._data[k],d._data[k])
+        for k in d.columns():
+            self.append(k,d[k])
         
     def append(self,col,d):
-        self._data[col] = np.append(self._data[col],d)
+        self._src_offsets = None
+        self._chunks.setdefault(col,[]).append(np.ravel(d))
+
+    def __contains__(self,col):
+        return col in self._data or col in self._chunks
 
     def __getitem__(self,col):
+        if col in self._chunks: self._consolidate([col])
         return self._data[col]
 
     def __setitem__(self,col,val):
+        if col == 'src_index': self._src_offsets = None
+        self._chunks.pop(col,None)
         self._data[col] = val
 
     def apply_mask(self,mask):
 
+        self._consolidate()
         for k in self._data.keys():
             self._data[k] = self._data[k][mask]
+
+        # Masking preserves the order of the events
+        if not self._src_offsets is None: self.index_sources()
     
     def save(self,outfile):
 
@@ -119,11 +378,52 @@ class PhotonData(object):
         pickle.dump(self,fp,protocol = pickle.HIGHEST_PROTOCOL)
         fp.close()
 
+    def save_columns(self,path,append=False):
+        """Write this object to a columnar store (see
+        ColumnStore).  If append is True and the store exists the
+        rows of this object are appended to it.  The source list is
+        written to srcs.P in the store directory."""
+
+        self._consolidate()
+
+        if append and ColumnStore.is_store(path):
+            store = ColumnStore(path)
+        else:
+            store = ColumnStore.create(path,[(k,v.dtype) for k, v in 
+                                             sorted(self._data.items())])
+
+        store.append(self._data)
+        save_object(self._srcs,os.path.join(path,'srcs.P'))
+
+    @staticmethod
+    def load_columns(path,columns=None):
+        """Load a columnar store.  Columns are returned as
+        read-only memory maps that are paged in from disk when they
+        are accessed.
+
+        Parameters
+        ----------
+        path : str
+           Path to the store directory.
+
+        columns : list
+           List of columns to load.  Defaults to all columns.
+        """
+
+        store = ColumnStore(path)
+        
+        d = PhotonData()
+        d._data = store.load(columns)
+
+        srcfile = os.path.join(path,'srcs.P')
+        if os.path.isfile(srcfile): d._srcs = load_object(srcfile)
+        return d
+
     def hist(self,var_name,mask=None,edges=None):
     
         h = Histogram(edges)    
-        if not mask is None: h.fill(self._data[var_name][mask])
-        else: h.fill(self._data[var_name])
+        if not mask is None: h.fill(self[var_name][mask])
+        else: h.fill(self[var_name])
         return h
 
     def mask(self,selections=None,conversion_type=None,
@@ -147,84 +447,57 @@ class PhotonData(object):
                  event_type_id=None,
                  phases=None,cuts=None,
                  src_index=None,cuts_file=None):
+        """Return a boolean mask for the events in data passing a
+        selection.  See PhotonSelection for a description of the
+        arguments."""
         
-        mask = data['energy'] > 0
-
-        if not selections is None:
-            for k, v in selections.iteritems():
-                mask &= (data[k] >= v[0]) & (data[k] <= v[1])
-
-#    mask = (data['energy'] >= egy_range[0]) & \
-#        (data['energy'] <= egy_range[1]) & \
-#        (data['cth'] >= cth_range[0]) & (data['cth'] <= cth_range[1]) \
-        
-        if not conversion_type is None:
-            if conversion_type == 'front':
-                mask &= (data['conversion_type'] == 0)
-            else:
-                mask &= (data['conversion_type'] == 1)
-        
-        if not cuts is None and not cuts_file is None:
-            cut_defs = yaml.load(open(cuts_file,'r'))
-            cut_defs['CTBBestLogEnergy'] = 'data[\'energy\']'
-            cut_defs['CTBCORE'] = 'data[\'psfcore\']'
-            cut_defs['pow'] = 'np.power'
-
-            for c in cuts.split(','):
-            
-                cv = c.split('/')
-
-                if len(cv) == 1:
-                    cut_expr = expand_aliases(cut_defs,cv[0])
-                    mask &= eval(cut_expr)
-                else:
-                    clo = float(cv[1])
-                    chi = float(cv[2])
-
-                if len(cv) == 3 and cv[0] in data._data:
-                    mask &= (data[cv[0]] >= clo)&(data[cv[0]] <= chi)
-
-        if not event_class_id is None:
-            mask &= (data['event_class'].astype('int')&
-                     ((0x1)<<event_class_id)>0)
-        elif event_class == 'source':
-            mask &= (data['event_class'].astype('int')&((0x1)<<2)>0)
-        elif event_class == 'clean':
-            mask &= (data['event_class'].astype('int')&((0x1)<<3)>0)
-        elif event_class == 'ultraclean':
-            mask &= (data['event_class'].astype('int')&((0x1)<<4)>0)
-
-        if not event_type_id is None:
-
-            print np.sum(mask)
-            
-            mask &= (data['event_type'].astype('int')&
-                     ((0x1)<<event_type_id)>0)
-
-            print np.sum(mask)
-            
-        if src_index is not None:
-
-            src_mask = data['src_index'].astype('int') < 0
-            for isrc in src_index: 
-                src_mask |= (data['src_index'].astype('int') == int(isrc))
-
-            mask &= src_mask
-
-        if phases is not None:
-            
-            phase_mask = data['phase'] < 0
-            for p in phases:            
-                phase_mask |= ((data['phase'] > p[0]) & (data['phase'] < p[1]))
-            mask &= phase_mask
-
-        return mask
+        sel = PhotonSelection(selections,conversion_type,event_class,
+                              event_class_id,event_type_id,phases,
+                              cuts,src_index,cuts_file)
+        return sel(data)
+
+    def index_sources(self):
+        """Sort the events by source index and compute the offset of
+        the events of each source.  Selections on src_index then
+        reduce to contiguous slices.  Events with a negative source
+        index are placed first."""
+
+        src = self['src_index']
+        if len(src) > 1 and np.any(src[1:] < src[:-1]):
+            isort = np.argsort(src,kind='mergesort')
+            self._consolidate()
+            for k, v in self._data.items():
+                if len(v) == len(isort): self._data[k] = v[isort]
+            src = self._data['src_index']
+
+        nsrc = src.max()+1 if len(src) else 0
+        offsets = np.searchsorted(src,np.arange(-1,nsrc+1),side='left')
+        offsets[0] = 0
+        self._src_offsets = offsets
+
+    def src_slice(self,isrc):
+        """Return the slice of events associated with the source
+        isrc.  isrc = -1 returns the slice of events with a negative
+        source index.  Requires index_sources to have been called."""
+
+        off = self._src_offsets
+        i = min(max(isrc+1,0),len(off)-1)
+        return slice(off[i],off[min(i+1,len(off)-1)])
 
     @staticmethod
-    def load(infile):
-
-        import cPickle as pickle
-        return pickle.load(open(infile,'rb'))
+    def load(infile,columns=None):
+        """Load a PhotonData object from a pickle file or a
+        columnar store.  If columns is given only those columns are
+        loaded."""
+
+        if ColumnStore.is_store(infile):
+            return PhotonData.load_columns(infile,columns)
+
+        d = load_object(infile)
+        if not columns is None:
+            d._consolidate()
+            d._data = dict([(k,d._data[k]) for k in columns])
+        return d
         
 
 class QuantileData(object):
@@ -1,8 +1,13 @@
+import os
+import re
+import hashlib
+import multiprocessing
 import numpy as np
+from gammatools.core.astropy_helper import pyfits
 from gammatools.core.histogram import *
 from irf_util import IRFManager
 from catalog import Catalog
-from gammatools.core.util import eq2gal, gal2eq
+from gammatools.core.util import eq2gal, gal2eq, make_dir, atomic_write
 import healpy
 
 def get_src_mask(src,ra,dec,radius=5.0):
@@ -10,57 +15,215 @@ def get_src_mask(src,ra,dec,radius=5.0):
     msk = dist > np.radians(radius)
     return msk
 
+def _sum_ltfiles(files):
+    """Sum the livetime maps of a list of livetime cube files.  Each
+    file is memory-mapped and added to a running sum so that only the
+    sum and the pages of the current input are held in memory.
+
+    Returns
+    -------
+    ltmap : array
+        Summed livetime map with shape (npix,ncth).
+
+    tstart, tstop : float
+        Start and stop time of the summed cube.
+    """
+
+    ltmap, tstart, tstop = None, None, None
+    for f in files:
+
+        print 'Loading ', f
+
+        hdulist = pyfits.open(f,memmap=True)
+        lt = hdulist[1].data.field(0)
+        header = hdulist[0].header
+
+        if ltmap is None:
+            ltmap = np.array(lt,dtype=float)
+            tstart, tstop = header['TSTART'], header['TSTOP']
+        elif lt.shape != ltmap.shape:
+            raise ValueError('Livetime cube %s has a different binning.'%f)
+        else:
+            ltmap += lt
+            tstart = min(tstart,header['TSTART'])
+            tstop = max(tstop,header['TSTOP'])
+
+        del lt
+        hdulist.close()
+
+    return ltmap, tstart, tstop
+
 class LTCube(object):
+    """Livetime cube.  The livetime of each HEALPix pixel is binned
+    in the cosine of the incidence angle.  The cube can be created
+    from a single livetime file or the sum of a list of files.
 
-    def __init__(self,ltfile):
+    Parameters
+    ----------
+    ltfile : str or list
+        Livetime cube file, list of files, or text file (.txt) with
+        one file per line.
+
+    cache_dir : str
+        Directory in which the summed cube is cached.  The cache file
+        is keyed by the path, size and modification time of every
+        input file.  A matching cache file is loaded instead of the
+        inputs.
+
+    workers : int
+        Number of worker processes used to sum the inputs.
+    """
+
+    def __init__(self,ltfile=None,cache_dir=None,workers=1):
 
         self._ltmap = None
+        if ltfile is None: return
 
         if isinstance(ltfile,list):
-            for f in ltfile: self.load_ltfile(f)
+            files = ltfile
         elif not re.search('\.txt?',ltfile) is None:
-            files=np.loadtxt(ltfile,unpack=True,dtype='str')
-            for f in files: self.load_ltfile(f)
+            files = list(np.loadtxt(ltfile,unpack=True,dtype='str',ndmin=1))
         else:
-            self.load_ltfile(ltfile)
-        
+            files = [ltfile]
 
-    def load_ltfile(self,ltfile):
+        self.load_ltfiles(files,cache_dir,workers)
 
-        print 'Loading ', ltfile
-        
-        import healpy
-        import pyfits
-        
-        hdulist = pyfits.open(ltfile)
-                
-        if self._ltmap is None:
-            self._ltmap = hdulist[1].data.field(0)
-            self._tstart = hdulist[0].header['TSTART']
-            self._tstop = hdulist[0].header['TSTOP']
+    @staticmethod
+    def cache_key(files):
+        """Return a key that identifies the sum of a list of livetime
+        cube files."""
+
+        h = hashlib.sha1()
+        for f in sorted([os.path.abspath(f) for f in files]):
+            st = os.stat(f)
+            h.update('%s %i %r\n'%(f,st.st_size,st.st_mtime))
+        return h.hexdigest()
+
+    def load_ltfiles(self,files,cache_dir=None,workers=1):
+        """Add the sum of a list of livetime cube files to this cube.
+        The sum is computed in parallel when workers > 1."""
+
+        cache_file = None
+        if cache_dir is not None and self._ltmap is None:
+            cache_file = os.path.join(cache_dir,'ltcube_%s.npz'%
+                                      LTCube.cache_key(files))
+            if os.path.isfile(cache_file):
+                self.load_cache(cache_file)
+                return
+
+        if self._ltmap is None: self.read_header(files[0])
+
+        if workers > 1 and len(files) > 1:
+            nproc = min(workers,len(files))
+            pool = multiprocessing.Pool(nproc)
+            results = pool.imap_unordered(_sum_ltfiles,
+                                          [files[i::nproc] 
+                                           for i in range(nproc)])
         else:
-            self._ltmap += hdulist[1].data.field(0)
-            self._tstart = min(self._tstart,hdulist[0].header['TSTART'])
-            self._tstop = max(self._tstop,hdulist[0].header['TSTOP'])
+            pool = None
+            results = [_sum_ltfiles(files)]
 
-        self._cth_edges = np.array(hdulist[3].data.field(0))
-        self._cth_edges = np.concatenate(([1],self._cth_edges))
-        self._cth_edges = self._cth_edges[::-1]
-        self._cth_axis = Axis(self._cth_edges)
+        for ltmap, tstart, tstop in results:
+            self.add(ltmap,tstart,tstop)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if cache_file is not None: self.save_cache(cache_file)
+
+    def load_ltfile(self,ltfile):
+        """Add a single livetime cube file to this cube."""
+        self.load_ltfiles([ltfile])
+
+    def read_header(self,ltfile):
+        """Read the pixelization and incidence angle binning of a
+        livetime cube file."""
+
+        hdulist = pyfits.open(ltfile,memmap=True)
+        header = hdulist[1].header
+
+        if 'NSIDE' in header: self._nside = header['NSIDE']
+        else: self._nside = healpy.npix2nside(header['NAXIS2'])
+        self._nest = header.get('ORDERING','NESTED') == 'NESTED'
+
+        cth_edges = np.array(hdulist[3].data.field(0),dtype=float)
+        self.set_cth_edges(np.concatenate(([1],cth_edges))[::-1])
+        hdulist.close()
 
+    def set_cth_edges(self,cth_edges):
+
+        self._cth_edges = np.array(cth_edges)
+        self._cth_axis = Axis(self._cth_edges)
         self._domega = (self._cth_edges[1:]-self._cth_edges[:-1])*2*np.pi
+
+    def add(self,ltmap,tstart,tstop):
+        """Add a livetime map to this cube."""
+
+        if self._ltmap is None:
+            self._ltmap = np.array(ltmap,dtype=float)
+            self._tstart, self._tstop = tstart, tstop
+            return
+        elif ltmap.shape != self._ltmap.shape:
+            raise ValueError('Livetime map has a different binning.')
+
+        self._ltmap += ltmap
+        self._tstart = min(self._tstart,tstart)
+        self._tstop = max(self._tstop,tstop)
+
+    def save_cache(self,cache_file):
+        """Write the summed cube to an npz file."""
+
+        make_dir(os.path.dirname(os.path.abspath(cache_file)))
+
+        with atomic_write(cache_file) as f:
+            np.savez(f,ltmap=self._ltmap,cth_edges=self._cth_edges,
+                     tstart=self._tstart,tstop=self._tstop,
+                     nside=self._nside,nest=self._nest)
+
+    def load_cache(self,cache_file):
+        """Load a summed cube written with save_cache."""
+
+        print 'Loading ', cache_file
+
+        d = np.load(cache_file)
+        self._ltmap = d['ltmap']
+        self._tstart = float(d['tstart'])
+        self._tstop = float(d['tstop'])
+        self._nside = int(d['nside'])
+        self._nest = bool(d['nest'])
+        self.set_cth_edges(d['cth_edges'])
+
+    @property
+    def nside(self):
+        return self._nside
+
+    @property
+    def nest(self):
+        return self._nest
+
+    @property
+    def cth_axis(self):
+        return self._cth_axis
+
+    def get_pix(self,ra,dec):
+        """Return the index of the livetime cube pixel containing the
+        direction (ra,dec) in degrees."""
+        return healpy.ang2pix(self._nside,np.pi/2. - np.radians(dec),
+                              np.radians(ra),nest=self._nest)
             
     def get_src_lthist(self,ra,dec):
-        
-        lthist = Histogram(self._cth_axis)
-        ipix = healpy.ang2pix(64,np.pi/2. - np.radians(dec),
-                              np.radians(ra),nest=True)
+        """Return the livetime versus cosine of the incidence angle at
+        the direction (ra,dec) in degrees.  If ra and dec are arrays
+        a 2D histogram with one row per direction is returned."""
 
-        lt = self._ltmap[ipix,::-1]
+        ipix = self.get_pix(ra,dec)
+        lt = self._ltmap[ipix][...,::-1]
 
-        lthist._counts = lt
+        if lt.ndim == 1: return Histogram(self._cth_axis,counts=lt)
 
-        return lthist
+        pos_axis = Axis.create(0,lt.shape[0],lt.shape[0])
+        return Histogram2D(pos_axis,self._cth_axis,counts=lt)
 
     def get_allsky_lthist(self,slat_axis,lon_axis,coordsys='gal'):
 
@@ -85,8 +248,8 @@ class LTCube(object):
                                   indexing='ij')
 
         
-        ipix = healpy.ang2pix(64,np.ravel(np.pi/2. - dec),
-                              np.ravel(ra),nest=True)
+        ipix = self.get_pix(np.degrees(np.ravel(ra)),
+                            np.degrees(np.ravel(dec)))
 
         lt = self._ltmap[ipix,::-1]
 
@@ -105,11 +268,6 @@ class LTCube(object):
         
     def get_hlat_ltcube(self):
 
-        
-        import healpy
-        
-        
-
         nbin = 400
 
         ra_edge = np.linspace(0,2*np.pi,nbin+1)
@@ -123,8 +281,8 @@ class LTCube(object):
         lthist = pHist([ra_edge,dec_edge,self._cth_edges])
         
         srcs = np.loadtxt('src.txt',unpack=False)
-        ipix = healpy.ang2pix(64,np.ravel(np.pi/2. - dec),
-                              np.ravel(ra),nest=True)
+        ipix = self.get_pix(np.degrees(np.ravel(ra)),
+                            np.degrees(np.ravel(dec)))
 
         lt = self._ltmap[ipix,::-1]
         
@@ -162,44 +320,266 @@ class LTCube(object):
 
 
 
-class ExposureCalc(object):
+def write_healpix_cube(filename,exp,egy,coordsys='cel'):
+    """Write a HEALPix exposure cube with NESTED ordering.  The cube
+    is written to a SKYMAP table with one column per energy and the
+    energies are written to an ENERGIES table.
+
+    Parameters
+    ----------
+    exp : array
+        Exposure in m^2 s with shape (negy,npix).  It is written in
+        cm^2 s.
+
+    egy : array
+        Log10 of the energy in MeV of each plane.
+    """
+
+    exp = np.asarray(exp)
+    npix = exp.shape[1]
+
+    cols = [pyfits.Column(name='ENERGY%i'%(i+1),format='E',unit='cm^2 s',
+                          array=exp[i]*1E4) for i in range(exp.shape[0])]
+    hdu_map = pyfits.BinTableHDU.from_columns(cols)
+    hdu_map.name = 'SKYMAP'
+    hdu_map.header['PIXTYPE'] = 'HEALPIX'
+    hdu_map.header['ORDERING'] = 'NESTED'
+    hdu_map.header['NSIDE'] = healpy.npix2nside(npix)
+    hdu_map.header['FIRSTPIX'] = 0
+    hdu_map.header['LASTPIX'] = npix-1
+    hdu_map.header['INDXSCHM'] = 'IMPLICIT'
+    if coordsys == 'gal': hdu_map.header['COORDSYS'] = 'GAL'
+    else: hdu_map.header['COORDSYS'] = 'EQU'
+
+    hdulist = pyfits.HDUList([pyfits.PrimaryHDU(),hdu_map,
+                              _create_energies_hdu(egy)])
+    hdulist.writeto(filename,clobber=True)
+
+def write_wcs_cube(filename,exp,egy,wcs):
+    """Write a WCS exposure cube.
+
+    Parameters
+    ----------
+    exp : array
+        Exposure in m^2 s with shape (negy,ny,nx).  It is written in
+        cm^2 s.
+
+    egy : array
+        Log10 of the energy in MeV of each plane.  The third axis is
+        written as log_Energy if the planes are equally spaced in
+        log10(E/MeV).  Otherwise the energies are only given by the
+        ENERGIES table.
+
+    wcs : WCS
+        Two-dimensional WCS of the spatial axes.
+    """
+
+    exp = np.asarray(exp)
+    egy = np.array(egy,ndmin=1,dtype=float)
+
+    header = wcs.to_header()
+    header['BUNIT'] = 'cm^2 s'
+
+    delta = np.diff(egy)
+    if len(egy) == 1 or np.allclose(delta,delta[0]):
+        header['CTYPE3'] = 'log_Energy'
+        header['CUNIT3'] = 'log10(MeV)'
+        header['CRPIX3'] = 1.0
+        header['CRVAL3'] = egy[0]
+        header['CDELT3'] = delta[0] if len(egy) > 1 else 1.0
+
+    hdu = pyfits.PrimaryHDU(np.array(exp*1E4,dtype=np.float32),header)
+    hdulist = pyfits.HDUList([hdu,_create_energies_hdu(egy)])
+    hdulist.writeto(filename,clobber=True)
+
+def _create_energies_hdu(egy):
+
+    egy = np.array(egy,ndmin=1,dtype=float)
+    hdu = pyfits.BinTableHDU.from_columns([
+            pyfits.Column(name='Energy',format='D',unit='MeV',
+                          array=10**egy)])
+    hdu.name = 'ENERGIES'
+    return hdu
 
-    def __init__(self,irfm,ltc):
+class ExposureCalc(object):
+    """Compute exposure by folding the livetime cube with the
+    effective area.  The exposure of every livetime cube pixel and
+    energy is the matrix product of the livetime cube (npix x ncth)
+    and the effective area evaluated on the incidence angle bins of
+    the livetime cube (ncth x negy).  Exposure at an arbitrary
+    direction is taken from the livetime cube pixel that contains
+    it.  All exposures are in m^2 s.
+
+    Parameters
+    ----------
+    irfm : IRFManager
+
+    ltc : LTCube
+
+    chunk_size : int
+        Number of pixels evaluated in each block.  Sets the size of
+        the temporary arrays.
+    """
+
+    def __init__(self,irfm,ltc,chunk_size=65536):
         self._irfm = irfm
         self._ltc = ltc
+        self._chunk_size = chunk_size
 
     def getExpByName(self,src_names,egy_edges):
+        """Return the exposure summed over a list of sources."""
 
-        exp = None
+        cat = Catalog.get()
 
-        cat = Catalog()
+        ra, dec = [], []
         for s in src_names:
             src = cat.get_source_by_name(s) 
-            
-            if exp is None:
-                exp = self.eval(src['RAJ2000'], src['DEJ2000'],egy_edges)
-            else:
-                exp += self.eval(src['RAJ2000'], src['DEJ2000'],egy_edges)
+            ra.append(src['RAJ2000'])
+            dec.append(src['DEJ2000'])
+
+        return np.sum(self.eval(np.array(ra),np.array(dec),egy_edges),axis=0)
+
+    def aeff_table(self,egy):
+        """Return the effective area in m^2 with shape (ncth,negy)
+        evaluated at the energies egy (log10(E/MeV)) and the centers
+        of the incidence angle bins of the livetime cube.  Rows are in
+        the order of the livetime cube columns."""
+
+        egy = np.array(egy,ndmin=1,dtype=float)
+        cth = self._ltc._cth_axis.center[::-1]
+
+        x, y = np.meshgrid(egy,cth)
+
+        aeff = self._irfm.aeff(np.ravel(x),np.ravel(y))
+        return np.asarray(aeff,dtype=float).reshape((len(cth),len(egy)))
+
+    def fold(self,egy,ipix=None):
+        """Return the exposure of livetime cube pixels with shape
+        (negy,npix).
+
+        Parameters
+        ----------
+        egy : array
+            Log10 of the energy in MeV.
+
+        ipix : array
+            Indices of the livetime cube pixels.  If None the exposure
+            of all pixels is returned.
+        """
+
+        aeffT = self.aeff_table(egy).T
+        ltmap = self._ltc._ltmap
+        if ipix is None: ipix = np.arange(ltmap.shape[0])
+
+        exp = np.empty((aeffT.shape[0],len(ipix)))
+        for i in range(0,len(ipix),self._chunk_size):
+            s = slice(i,i+self._chunk_size)
+            exp[:,s] = np.dot(aeffT,ltmap[ipix[s]].T)
 
         return exp
 
+    def exposure(self,ra,dec,egy):
+        """Return the exposure at arrays of directions (ra,dec) in
+        degrees and energies egy (log10(E/MeV)).  The output has
+        shape (negy,) + the shape of ra."""
+
+        ra, dec = np.broadcast_arrays(np.asarray(ra,dtype=float),
+                                      np.asarray(dec,dtype=float))
+        ipix = np.ravel(self._ltc.get_pix(ra,dec))
+
+        # Fold only the pixels that are needed
+        upix, inv = np.unique(ipix,return_inverse=True)
+        exp = self.fold(egy,upix)[:,inv]
+        return exp.reshape((exp.shape[0],) + ra.shape)
+
     def eval(self,ra,dec,egy_edges):
+        """Return the exposure at the centers of the energy bins with
+        edges egy_edges.  The output has shape (negy,) for a single
+        direction and (ndir,negy) for arrays of directions."""
 
-        cth = self._ltc._cth_center
+        egy_edges = np.asarray(egy_edges)
         egy = 0.5*(egy_edges[1:] + egy_edges[:-1])
+        return np.rollaxis(self.exposure(ra,dec,egy),0,np.ndim(ra)+1)
 
-        x, y = np.meshgrid(egy,cth)
+    def healpix_exposure(self,egy,nside=None,coordsys='cel'):
+        """Compute an all-sky HEALPix exposure cube with NESTED
+        ordering.
+
+        Parameters
+        ----------
+        egy : array
+            Log10 of the energy in MeV of each plane.
+
+        nside : int
+            HEALPix resolution of the output.  Defaults to the
+            resolution of the livetime cube.
+
+        coordsys : str
+            Coordinate system of the output (cel or gal).
+
+        Returns
+        -------
+        exp : array
+            Exposure with shape (negy,npix).
+        """
+
+        if nside is None: nside = self._ltc.nside
+
+        exp_lt = self.fold(egy)
+        if nside == self._ltc.nside and coordsys == 'cel' and self._ltc.nest:
+            return exp_lt
 
-        aeff = self._irfm.aeff(x.T.flat,y.T.flat)
+        npix = healpy.nside2npix(nside)
+        exp = np.empty((exp_lt.shape[0],npix))
 
-        aeff = aeff.reshape((len(egy),len(cth)))
-        lthist = self._ltc.get_src_lthist(ra,dec)
+        for i in range(0,npix,self._chunk_size):
 
-        exp = np.sum(aeff*lthist._counts,axis=1)
+            pix = np.arange(i,min(i+self._chunk_size,npix))
+            theta, phi = healpy.pix2ang(nside,pix,nest=True)
+            lon, lat = np.degrees(phi), 90. - np.degrees(theta)
+            if coordsys == 'gal': lon, lat = gal2eq(lon,lat)
+            exp[:,pix] = exp_lt[:,self._ltc.get_pix(lon,lat)]
 
         return exp
-        
 
+    def wcs_exposure(self,egy,wcs,shape):
+        """Compute a WCS exposure cube.
+
+        Parameters
+        ----------
+        egy : array
+            Log10 of the energy in MeV of each plane.
+
+        wcs : WCS
+            Two-dimensional WCS of the spatial axes.  Galactic
+            coordinates are used if the first axis type starts with
+            GLON.
+
+        shape : tuple
+            Number of pixels (nx,ny) along each spatial axis.
+
+        Returns
+        -------
+        exp : array
+            Exposure with shape (negy,ny,nx).  Pixels outside of the
+            projection have zero exposure.
+        """
+
+        nx, ny = shape
+        gal = wcs.wcs.ctype[0].startswith('GLON')
+        exp_lt = self.fold(egy)
+        exp = np.zeros((exp_lt.shape[0],nx*ny))
+
+        for i in range(0,nx*ny,self._chunk_size):
+
+            pix = np.arange(i,min(i+self._chunk_size,nx*ny))
+            lon, lat = wcs.wcs_pix2world(pix%nx,pix//nx,0)
+            msk = np.isfinite(lon) & np.isfinite(lat)
+            lon, lat = lon[msk], lat[msk]
+            if gal: lon, lat = gal2eq(lon,lat)
+            exp[:,pix[msk]] = exp_lt[:,self._ltc.get_pix(lon,lat)]
+
+        return exp.reshape((exp.shape[0],ny,nx))
 
     @staticmethod
     def create(irf,ltfile,irf_dir=None):
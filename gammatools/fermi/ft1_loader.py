@@ -0,0 +1,354 @@
+"""
+@file  ft1_loader.py
+
+@brief Vectorized loading of photon events from FT1 files.
+
+@author Matthew Wood       <mdwood@slac.stanford.edu>
+"""
+
+import multiprocessing
+import numpy as np
+
+from gammatools.core.astropy_helper import pyfits
+from gammatools.core.util import bitarray_to_int
+from gammatools.fermi.catalog import radec_to_xyz, match_positions
+from gammatools.fermi.data import PhotonData, PhotonSelection
+
+def match_sources(ra,dec,src_ra,src_dec,max_dist):
+    """Find all pairs of events and sources separated by less than
+    max_dist.
+
+    Parameters
+    ----------
+    ra, dec : array
+        Event coordinates in degrees.
+
+    src_ra, src_dec : array
+        Source coordinates in degrees.
+
+    max_dist : float
+        Maximum angular separation in degrees.
+
+    Returns
+    -------
+    ievt : array
+        Event index of each pair.
+
+    isrc : array
+        Source index of each pair.
+
+    dtheta : array
+        Angular separation in radians of each pair.
+
+    Pairs are sorted by source index and then by event index.
+    """
+
+    isrc, ievt, dtheta = match_positions(radec_to_xyz(src_ra,src_dec),
+                                         radec_to_xyz(ra,dec),
+                                         np.radians(max_dist))
+    return ievt, isrc, dtheta
+
+class PointingHistory(object):
+    """Spacecraft pointing history.  The direction of the
+    spacecraft z-axis at an arbitrary time is computed by linear
+    interpolation of the cartesian components of the tabulated
+    pointing directions.
+
+    Parameters
+    ----------
+    time : array
+        Times (MET) at which the pointing direction is tabulated.
+
+    ra_scz, dec_scz : array
+        Celestial coordinates in degrees of the spacecraft z-axis.
+    """
+
+    def __init__(self,time,ra_scz,dec_scz):
+
+        isort = np.argsort(time)
+        self._time = np.array(time,dtype=float)[isort]
+        self._zaxis = radec_to_xyz(np.array(ra_scz)[isort],
+                                   np.array(dec_scz)[isort])
+
+    @staticmethod
+    def create(ft2files):
+        """Create a pointing history from one or more FT2 files."""
+
+        if isinstance(ft2files,str): ft2files = [ft2files]
+
+        time, ra, dec = [], [], []
+        for f in ft2files:
+            hdulist = pyfits.open(f)
+            table = hdulist['SC_DATA'].data
+            time.append(np.array(table.field('START'),dtype=float))
+            ra.append(np.array(table.field('RA_SCZ'),dtype=float))
+            dec.append(np.array(table.field('DEC_SCZ'),dtype=float))
+            hdulist.close()
+
+        return PointingHistory(np.concatenate(time),np.concatenate(ra),
+                               np.concatenate(dec))
+
+    def zaxis(self,time):
+        """Return the unit vectors of the spacecraft z-axis with shape
+        (n,3) at an array of times."""
+
+        time = np.array(time,ndmin=1,dtype=float)
+        x = np.zeros((len(time),3))
+        for i in range(3):
+            x[:,i] = np.interp(time,self._time,self._zaxis[:,i])
+        x /= np.sqrt(np.sum(x**2,axis=1))[:,np.newaxis]
+        return x
+
+    def cos_theta(self,time,ra,dec):
+        """Return the cosine of the angle between the spacecraft
+        z-axis and the direction (ra,dec) at an array of times."""
+        return np.sum(self.zaxis(time)*radec_to_xyz(ra,dec),axis=1)
+
+def project2d(ra,dec,ref_ra,ref_dec):
+    """Rotate the directions (ra,dec) such that the reference
+    direction (ref_ra,ref_dec) is at the pole.  Equivalent to
+    Vector3D.project2d.  All coordinates are in degrees.
+
+    Returns
+    -------
+    theta, phi : array
+        Polar and azimuthal angle in radians of each direction in the
+        rotated frame.
+    """
+
+    x = radec_to_xyz(ra,dec)
+    a = -np.radians(ref_ra)
+    b = np.radians(ref_dec) - 0.5*np.pi
+
+    # Rotation about the z-axis by a followed by a rotation about the
+    # y-axis by b
+    x0 = x[:,0]*np.cos(a) - x[:,1]*np.sin(a)
+    x1 = x[:,0]*np.sin(a) + x[:,1]*np.cos(a)
+    x2 = x[:,2]*np.cos(b) - x0*np.sin(b)
+    x0 = x0*np.cos(b) + x[:,2]*np.sin(b)
+
+    return np.arctan2(np.sqrt(x0**2+x1**2),x2), np.arctan2(x1,x0)
+
+def project_events(ra,dec,src_ra,src_dec,ptz_ra,ptz_dec):
+    """Compute the offsets of events from a reference direction.
+    All coordinates are arrays in degrees with one element per event.
+
+    Returns
+    -------
+    delta_ra, delta_dec : array
+        Offsets in degrees in the projection centered on the source.
+
+    delta_phi, delta_theta : array
+        Offsets in degrees in the same projection rotated such that
+        the second axis points toward the spacecraft z-axis.
+    """
+
+    th, phi = project2d(ra,dec,src_ra,src_dec)
+    ptz_th, ptz_phi = project2d(ptz_ra,ptz_dec,src_ra,src_dec)
+
+    th = np.degrees(th)
+    phi2 = phi - ptz_phi
+
+    return (th*np.sin(phi),-th*np.cos(phi),
+            th*np.sin(phi2),-th*np.cos(phi2))
+
+def _load_init(loader):
+    global _loader
+    _loader = loader
+
+def _load_worker(fname):
+    return _loader.load_file(fname)
+
+class FT1Loader(object):
+    """Load the events within a maximum distance of a list of sources
+    from a set of FT1 files.  Events are assigned to all sources
+    within max_dist_deg in one pass over each file.  Each event-source
+    pair becomes one row of the output with the PhotonData columns.
+
+    Parameters
+    ----------
+    srcs : list
+        List of catalog sources.  Sources are indexed with the
+        RAJ2000 and DEJ2000 keys.
+
+    max_dist_deg : float
+        Maximum distance in degrees between an event and a source.
+
+    zenith_cut : float
+        Upper bound on the zenith angle in degrees.
+
+    conversion_type : str
+        Select front or back converting events.
+
+    event_class_id : int
+        Select events with this event class bit.
+
+    event_type_id : int
+        Select events with this event type bit.
+
+    phases : list
+        List of (lo, hi) pulse phase intervals.
+
+    erange : list
+        Energy range in log10(E/MeV).
+
+    max_events : int
+        Maximum number of events read from each file.
+
+    ft2file : str
+        FT2 file or list of FT2 files used to compute the cosine of
+        the angle between each source and the spacecraft z-axis.
+    """
+
+    def __init__(self,srcs,max_dist_deg=25.0,zenith_cut=105.,
+                 conversion_type=None,event_class_id=None,
+                 event_type_id=None,phases=None,erange=None,
+                 max_events=None,ft2file=None):
+
+        self._srcs = list(srcs)
+        self._src_ra = np.array([s['RAJ2000'] for s in self._srcs],dtype=float)
+        self._src_dec = np.array([s['DEJ2000'] for s in self._srcs],dtype=float)
+        self._max_dist = max_dist_deg
+        self._zenith_cut = zenith_cut
+        self._max_events = max_events
+
+        selections = None
+        if erange is not None: selections = {'energy' : erange}
+
+        if event_class_id is not None: event_class_id = int(event_class_id)
+        if event_type_id is not None: event_type_id = int(event_type_id)
+
+        self._selection = PhotonSelection(selections,conversion_type,
+                                          event_class_id=event_class_id,
+                                          event_type_id=event_type_id,
+                                          phases=phases)
+
+        self._phist = None
+        if ft2file is not None:
+            self._phist = PointingHistory.create(ft2file)
+
+    def load_file(self,fname):
+        """Load the events of a single FT1 file.  Returns a dictionary
+        of arrays keyed by PhotonData column name."""
+
+        hdulist = pyfits.open(fname,memmap=True)
+        table = hdulist['EVENTS'].data
+        colnames = hdulist['EVENTS'].columns.names
+        nevent = len(table)
+        if self._max_events is not None:
+            nevent = min(nevent,self._max_events)
+
+        def column(name,dtype=float):
+            return np.array(table.field(name)[:nevent],dtype=dtype)
+
+        evt = {}
+        evt['ra'] = column('RA')
+        evt['dec'] = column('DEC')
+        evt['energy'] = np.log10(column('ENERGY'))
+        evt['time'] = column('TIME')
+        evt['conversion_type'] = column('CONVERSION_TYPE',int)
+        evt['event_class'] = bitarray_to_int(table.field('EVENT_CLASS')[:nevent],
+                                             True)
+
+        if 'EVENT_TYPE' in colnames:
+            evt['event_type'] = bitarray_to_int(table.field('EVENT_TYPE')[:nevent],
+                                                True)
+        else:
+            evt['event_type'] = np.zeros(nevent,dtype=int)
+
+        if 'PULSE_PHASE' in colnames: evt['phase'] = column('PULSE_PHASE')
+        else: evt['phase'] = np.zeros(nevent)
+
+        if 'CTBCORE' in colnames: evt['psfcore'] = column('CTBCORE')
+        else: evt['psfcore'] = np.zeros(nevent)
+
+        evt['ptz_ra'] = column('PtRaz')
+        evt['ptz_dec'] = column('PtDecz')
+
+        msk = column('ZENITH_ANGLE') < self._zenith_cut
+        msk &= self._selection(evt)
+
+        hdulist.close()
+
+        for k in evt.keys(): evt[k] = evt[k][msk]
+
+        print 'Loading ', fname, ' nevent: ', np.sum(msk)
+
+        ievt, isrc, dth = match_sources(evt['ra'],evt['dec'],
+                                        self._src_ra,self._src_dec,
+                                        self._max_dist)
+
+        data = {}
+        for k in ['ra','dec','energy','time','conversion_type',
+                  'event_class','event_type','phase','psfcore']:
+            data[k] = evt[k][ievt]
+
+        data['src_index'] = isrc
+        data['dtheta'] = dth
+
+        src_ra = self._src_ra[isrc]
+        src_dec = self._src_dec[isrc]
+
+        (data['delta_ra'], data['delta_dec'],
+         data['delta_phi'], data['delta_theta']) = \
+         project_events(data['ra'],data['dec'],src_ra,src_dec,
+                        evt['ptz_ra'][ievt],evt['ptz_dec'][ievt])
+
+        if self._phist is not None:
+            data['cth'] = self._phist.cos_theta(data['time'],src_ra,src_dec)
+        else:
+            data['cth'] = np.zeros(len(isrc))*np.nan
+
+        return data
+
+    def load(self,files,output=None,workers=1,append=False):
+        """Load the events from a list of FT1 files.  Files are
+        processed in parallel with a pool of workers.  Events are
+        written in the order of the input files.
+
+        Parameters
+        ----------
+        files : list
+            List of FT1 files.
+
+        output : str
+            Path to a column store (see PhotonData.save_columns) to
+            which the events of each file are written as soon as they
+            are loaded.  If None the events are returned as a
+            PhotonData.
+
+        workers : int
+            Number of worker processes.
+
+        append : bool
+            Append to an existing store.
+        """
+
+        if isinstance(files,str): files = [files]
+
+        if workers > 1 and len(files) > 1:
+            pool = multiprocessing.Pool(min(workers,len(files)),
+                                        initializer=_load_init,
+                                        initargs=(self,))
+            results = pool.imap(_load_worker,files)
+        else:
+            pool = None
+            results = (self.load_file(f) for f in files)
+
+        pd = PhotonData()
+        pd._srcs = list(self._srcs)
+
+        for i, data in enumerate(results):
+
+            for k, v in data.items(): pd.append(k,v)
+
+            if output is not None:
+                pd.save_columns(output,append=(append or i > 0))
+                pd = PhotonData()
+                pd._srcs = list(self._srcs)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if output is None: return pd
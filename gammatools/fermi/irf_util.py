@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from scipy.interpolate import UnivariateSpline
 import bisect
 from gammatools.core.histogram import *
+from gammatools.core.util import GridInterpolator
 
 def expand_irf(irf):
     
@@ -22,6 +23,155 @@ def expand_irf(irf):
     return irf_names
 
 
+class PSFQuantileTable(object):
+    """Table of PSF containment radii on a grid of log energy, cosine
+    of the incidence angle, and containment fraction.  Radii at
+    arbitrary points are computed by trilinear interpolation of the
+    log of the tabulated radius.
+
+    Parameters
+    ----------
+    loge : array
+        Log10 of the energy in MeV of the grid points.
+
+    cth : array
+        Cosine of the incidence angle of the grid points.
+
+    frac : array
+        Containment fraction of the grid points.
+
+    radius : array
+        Containment radii in degrees with shape (nloge,ncth,nfrac).
+
+    key : list
+        List of strings identifying the PSF from which the table was
+        computed.  Saved with the table and used to validate cached
+        tables.
+    """
+
+    def __init__(self,loge,cth,frac,radius,key=None):
+
+        self.key = key
+        self._loge = np.array(loge,dtype=float)
+        self._cth = np.array(cth,dtype=float)
+        self._frac = np.array(frac,dtype=float)
+        self._radius = np.array(radius,dtype=float)
+        
+        with np.errstate(divide='ignore'):
+            self._interp = GridInterpolator([self._loge,self._cth,self._frac],
+                                            np.log(self._radius))
+
+    @staticmethod
+    def create(psf_fn,loge=None,cth=None,frac=None,dtheta_max=90.0,
+               nstep=300):
+        """Compute the containment table of a PSF.
+
+        Parameters
+        ----------
+        psf_fn : function
+            Function returning the PSF density for broadcastable
+            arrays of angular offset in degrees, log energy, and
+            cosine of the incidence angle.
+
+        dtheta_max : float
+            Upper bound in degrees of the angular offset.
+
+        nstep : int
+            Number of integration steps in angular offset.
+        """
+
+        if loge is None: loge = np.linspace(1.0,6.5,56)
+        if cth is None: cth = np.linspace(0.2,1.0,17)
+        if frac is None:
+            frac = np.concatenate((np.linspace(0.01,0.99,99),[0.995,0.999]))
+
+        loge = np.array(loge,ndmin=1,dtype=float)
+        cth = np.array(cth,ndmin=1,dtype=float)
+        frac = np.array(frac,ndmin=1,dtype=float)
+        
+        x = np.concatenate(([0],np.logspace(-3.0,np.log10(dtheta_max),nstep)))
+        xc = 0.5*(x[:-1]+x[1:])
+        deltax = np.radians(x[1:] - x[:-1])
+
+        y = psf_fn(xc[np.newaxis,np.newaxis,:],loge[:,np.newaxis,np.newaxis],
+                   cth[np.newaxis,:,np.newaxis])
+
+        cdf = np.zeros(y.shape[:2] + (len(x),))
+        cdf[...,1:] = np.cumsum(2*np.pi*np.sin(np.radians(xc))*y*deltax,
+                                axis=-1)
+        cdf = cdf.reshape((-1,len(x)))
+        valid = cdf[:,-1] > 0
+        cdf[valid] /= cdf[valid,-1:]
+        cdf[~valid] = np.linspace(0.,1.,len(x))
+
+        # Offset the CDF of each cell such that all CDFs form a single
+        # increasing sequence and find the crossing of every fraction
+        # in every cell with one search
+        offset = 2.0*np.arange(cdf.shape[0])
+        target = np.ravel(offset[:,np.newaxis] + frac[np.newaxis,:])
+        cdf += offset[:,np.newaxis]
+        cdf = np.ravel(cdf)
+
+        i1 = np.searchsorted(cdf,target,side='left')
+        i1 = np.clip(i1,1,len(cdf)-1)
+        i0 = i1-1
+        j0 = i0 % len(x)
+        j1 = np.minimum(j0+1,len(x)-1)
+
+        dc = cdf[i1]-cdf[i0]
+        w = (target-cdf[i0])/np.where(dc > 0,dc,1.0)
+        radius = x[j0] + w*(x[j1]-x[j0])
+        radius = radius.reshape((-1,len(frac)))
+        radius[~valid] = np.nan
+        
+        return PSFQuantileTable(loge,cth,frac,
+                                radius.reshape((len(loge),len(cth),len(frac))))
+
+    @staticmethod
+    def load(filename):
+        d = np.load(filename)
+        return PSFQuantileTable(d['loge'],d['cth'],d['frac'],d['radius'],
+                                PSFQuantileTable.load_key(filename))
+
+    @staticmethod
+    def load_key(filename):
+        """Return the key of a saved table or None if the table was
+        saved without a key."""
+        d = np.load(filename)
+        if not 'key' in d.files: return None
+        return [str(k) for k in d['key']]
+
+    def save(self,filename):
+        kwargs = {}
+        if self.key is not None: kwargs['key'] = np.array(self.key)
+        np.savez(filename,loge=self._loge,cth=self._cth,frac=self._frac,
+                 radius=self._radius,**kwargs)
+
+    def __call__(self,egy,cth,frac=0.68):
+        """Return the containment radius in degrees.  The arguments
+        can be arrays of any shape that can be broadcast against each
+        other and the output has the broadcast shape.
+
+        Parameters
+        ----------
+        egy : array
+            Log10 of the energy in MeV.
+
+        cth : array
+            Cosine of the incidence angle.
+
+        frac : array
+            Containment fraction.
+        """
+
+        egy, cth, frac = np.broadcast_arrays(np.asarray(egy,dtype=float),
+                                             np.asarray(cth,dtype=float),
+                                             np.asarray(frac,dtype=float))
+
+        v = self._interp(np.vstack((np.ravel(egy),np.ravel(cth),
+                                    np.ravel(frac))))
+        return np.exp(v).reshape(egy.shape)
+
 class IRFManager(object):
 
     load_irf = False
@@ -33,6 +183,7 @@ class IRFManager(object):
     def __init__(self,irfs=None):
 
         self._irfs = []
+        self._quantile_table = None
         if not irfs is None: self._irfs = irfs
 
     @staticmethod
@@ -68,6 +219,34 @@ class IRFManager(object):
 #        irf.loadPyIRF(irf_name)
         return irfset
 
+    @staticmethod
+    def createFromCALDB(irf_name,caldb=None,expand_irf_name=True):
+        """Create an IRF set from the FITS tables of a CALDB
+        installation (see IRF.createFromCALDB).  This is not a drop-in
+        replacement for createFromPyIRF: the PSF is returned in
+        deg^-2 whereas createFromPyIRF returns it in sr^-1.  Multiply
+        by (180/pi)^2 to convert deg^-2 to sr^-1.
+
+        Parameters
+        ----------
+        irf_name : str
+            IRF name.  If it has no conversion type and
+            expand_irf_name is True, both FRONT and BACK are loaded.
+
+        caldb : str
+            Path to the CALDB installation.  Defaults to $CALDB.
+        """
+
+        if expand_irf_name: irf_names = expand_irf(irf_name)
+        else: irf_names = [irf_name]
+
+        irfset = IRFManager()
+
+        for name in irf_names:
+            irf = IRF.createFromCALDB(name,caldb)
+            irfset.add_irf(irf)
+        return irfset
+
     @staticmethod
     def createFromPyIRF(irf_name,expand_irf_name=True):
 
@@ -90,6 +269,7 @@ class IRFManager(object):
 
     def add_irf(self,irf):
         self._irfs.append(irf)
+        self._quantile_table = None
 
     def fisheye(self,egy,cth,**kwargs):
         
@@ -120,35 +300,59 @@ class IRFManager(object):
 
         return v/aeff_tot
 
+    def psf_cache_key(self):
+        """Return a list of strings with the path and modification
+        time of the PSF table of each IRF.  Returns None if the PSF of
+        an IRF is not read from a FITS file."""
+
+        key = []
+        for irf in self._irfs:
+            fits_file = getattr(irf._psf,'_fits_file',None)
+            if fits_file is None: return None
+            key.append('%s:%r'%(os.path.abspath(fits_file),
+                                os.path.getmtime(fits_file)))
+        return key
+
+    def psf_quantile_table(self,cache_file=None):
+        """Return the containment table of the summed PSF of all
+        IRFs.  The table is computed on the first call and reused
+        afterwards.  If cache_file is given the table is read from
+        this file if it was computed from the same PSF files
+        (see psf_cache_key) and otherwise written to it.  The cache
+        file is not used if the PSF of an IRF is not read from a FITS
+        file."""
+
+        key = None
+        if cache_file is not None: key = self.psf_cache_key()
+
+        cache_valid = False
+        if key is not None and os.path.isfile(cache_file):
+            cache_valid = PSFQuantileTable.load_key(cache_file) == key
+
+        table = self._quantile_table
+        if table is None and cache_valid:
+            table = PSFQuantileTable.load(cache_file)
+        elif table is None:
+
+            def psf_fn(dtheta,egy,cth):
+                y = 0
+                for irf in self._irfs: y = y + irf.psf(dtheta,egy,cth)
+                return y
+
+            table = PSFQuantileTable.create(psf_fn)
+
+        if key is not None and not cache_valid:
+            table.key = key
+            table.save(cache_file)
+
+        self._quantile_table = table
+        return table
+
     def psf_quantile(self,egy,cth,frac=0.68):
-        x = np.logspace(-3.0,np.log10(90.0),300)        
-        x = np.concatenate(([0],x))
-        xc = 0.5*(x[:-1]+x[1:])
-        deltax = np.radians(x[1:] - x[:-1])
+        """Return the PSF containment radius in degrees.  The
+        arguments are broadcast against each other."""
         
-        xc = xc.reshape((1,300))
-        deltax = deltax.reshape((1,300))
-        egy = np.ravel(np.array(egy,ndmin=1))
-        cth = np.ravel(np.array(cth,ndmin=1))
-        egy = egy.reshape((egy.shape[0],) + (1,))
-        cth = cth.reshape((cth.shape[0],) + (1,))
-
-        y = np.zeros((egy.shape[0],300))
-        for i in range(len(self._irfs)):
-            y += self._irfs[i].psf(xc,egy,cth).reshape(y.shape)
-
-
-        cdf = 2*np.pi*np.sin(np.radians(xc))*y*deltax
-        cdf = np.cumsum(cdf,axis=1)
-#        cdf = np.concatenate(([0],cdf))
-#        cdf = np.vstack((np.zeros(cdf.shape[0]),cdf))
-        cdf /= cdf[:,-1][:,np.newaxis]
-
-        p = np.zeros(cdf.shape[0])
-        for i in range(len(p)): 
-            p[i] = percentile(x[1:],cdf[i],frac)
-        return p
-#        return percentile(x,cdf,frac)
+        return np.array(self.psf_quantile_table()(egy,cth,frac),ndmin=1)
     
     def aeff(self,*args,**kwargs):
 
@@ -205,6 +409,37 @@ class IRF(object):
         
         return IRF(psf,aeff,edisp)
 
+    @staticmethod
+    def createFromCALDB(irf_name,caldb=None):
+        """Create IRF object from the FITS tables of a CALDB
+        installation.  The IRFs are evaluated with NumPy using the
+        bilinear interpolation scheme of the Science Tools.  Unlike
+        createFromPyIRF, the PSF is returned in deg^-2 rather than
+        sr^-1.  The effective area is in m^2 in both cases.
+
+        Parameters
+        ----------
+        irf_name : str
+            IRF name with conversion type (e.g. P7REP_SOURCE_V15::FRONT).
+
+        caldb : str
+            Path to the CALDB installation.  Defaults to $CALDB.
+        """
+
+        if caldb is None: caldb = os.environ['CALDB']
+        bcf_dir = os.path.join(caldb,'data','glast','lat','bcf')
+
+        irf_name = irf_name.replace('::FRONT','_front')
+        irf_name = irf_name.replace('::BACK','_back')
+
+        psf = PSFIRF(os.path.join(bcf_dir,'psf','psf_%s.fits'%(irf_name)),
+                     bilinear=True)
+        aeff = AeffIRF(os.path.join(bcf_dir,'ea','aeff_%s.fits'%(irf_name)))
+        edisp = EDispIRF(os.path.join(bcf_dir,'edisp',
+                                      'edisp_%s.fits'%(irf_name)))
+
+        return IRF(psf,aeff,edisp)
+
     @staticmethod
     def createFromPyIRF(irf_name):
         """Create IRF object using pyIrf modules in Science Tools."""
@@ -300,10 +535,14 @@ class AeffIRF(IRFComponent):
         
         
     def __call__(self,egy,cth,**kwargs):
-
-        egy = np.array(egy,ndmin=1)
-        cth = np.array(cth,ndmin=1)
-        aeff = self._aeff_hist.interpolate(cth,egy)
+        """Evaluate the effective area in m^2 by bilinear
+        interpolation.  The arguments can be arrays of any shape that
+        can be broadcast against each other."""
+
+        egy, cth = np.broadcast_arrays(np.array(egy,ndmin=1,dtype=float),
+                                       np.array(cth,ndmin=1,dtype=float))
+        aeff = self._aeff_hist.interpolate(np.ravel(cth),np.ravel(egy))
+        aeff = aeff.reshape(egy.shape)
         aeff[aeff<= 0.0] = 0.0
         return aeff
 
@@ -322,22 +561,17 @@ class AeffPyIRF(IRFComponent):
         self._irf.setPhiDependence(False)
     
     def __call__(self,egy,cth):
+        """Evaluate the effective area in m^2.  The arguments are
+        broadcast against each other."""
 
-        egy = np.asarray(egy)
-        if egy.ndim == 0: egy.resize((1))
+        egy, cth = np.broadcast_arrays(np.asarray(egy,dtype=float),
+                                       np.asarray(cth,dtype=float))
+        theta = np.degrees(np.arccos(cth))
 
-        cth = np.asarray(cth)
-        if cth.ndim == 0: cth.resize((1))
-        
-        if cth.shape[0] > 1:
-            z = np.zeros(shape=cth.shape)
-            for j, c in enumerate(cth):
-                z[j] = self._irf.value(float(np.power(10,egy)),
-                                       float(np.degrees(np.arccos(c))),0)
-#            return z
-        else:
-            z = self._irf.value(float(np.power(10,egy)),
-                               float(np.degrees(np.arccos(cth))),0)
+        z = np.zeros(egy.shape)
+        for idx in np.ndindex(*z.shape):
+            z[idx] = self._irf.value(float(np.power(10,egy[idx])),
+                                     float(theta[idx]),0)
 
         z *= 1E-4
         return z
@@ -391,9 +625,12 @@ class EDispPyIRF(IRFComponent):
     
 class PSFIRF(IRFComponent):
 
-    def __init__(self,fits_file,interpolate_density=True):
+    def __init__(self,fits_file,interpolate_density=True,bilinear=False):
 
         self._interpolate_density = interpolate_density
+        self._bilinear = bilinear
+        self._fits_file = fits_file
+        self._quantile_table = None
         self._hdulist = pyfits.open(fits_file)
         hdulist = self._hdulist
         hdulist.info()
@@ -469,12 +706,12 @@ class PSFIRF(IRFComponent):
                                      
         th = self._theta_axis.center
 
-        for i in range(nx):
-            for j in range(ny):
-                x = self._cth_axis.center[i]
-                y = self._energy_axis.center[j]                
-                z = self.eval(10**th,y,x)
-                self._psf_hist._counts[i,j] = self.eval(10**th,y,x)
+        # Evaluate the density table on the full (cth,energy,theta)
+        # grid in a single call
+        self._psf_hist._counts[...] = \
+            self.eval(10**th[np.newaxis,np.newaxis,:],
+                      self._energy_axis.center[np.newaxis,:,np.newaxis],
+                      self._cth_axis.center[:,np.newaxis,np.newaxis])
 
 
         return
@@ -550,8 +787,28 @@ class PSFIRF(IRFComponent):
         fig.plot()
                 
     def __call__(self,dtheta,egy,cth,**kwargs):        
+        return self.eval_batch(dtheta,egy,cth)
 
-        if self._interpolate_density:
+    def eval_batch(self,dtheta,egy,cth):
+        """Evaluate the PSF density.  The arguments can be arrays of
+        any shape that can be broadcast against each other and the
+        output has the broadcast shape.
+
+        Parameters
+        ----------
+        dtheta : array
+            Angular offset in degrees.
+
+        egy : array
+            Log10 of the energy in MeV.
+
+        cth : array
+            Cosine of the incidence angle.
+        """
+
+        if getattr(self,'_bilinear',False):
+            return self.eval3(dtheta,egy,cth)
+        elif self._interpolate_density:
             return self.eval2(dtheta,egy,cth)
         else:
             return self.eval(dtheta,egy,cth)
@@ -568,20 +825,35 @@ class PSFIRF(IRFComponent):
         else:
             raise Exception('Invalid fisheye correction.')
         
-    def quantile(self,egy,cth,frac=0.68):
-        x = np.logspace(-3.0,np.log10(45.0),300)
-        x = np.concatenate(([0],x))
-        xc = 0.5*(x[:-1]+x[1:])
-        y = self(xc,egy,cth)
-
-        deltax = np.radians(x[1:] - x[:-1])
+    def quantile_table(self,persist=False):
+        """Return the containment table of this PSF.  The table is
+        computed on the first call and reused afterwards.  If persist
+        is True the table is saved next to the FITS file and read
+        from there when it is newer than the FITS file."""
+
+        fits_file = getattr(self,'_fits_file',None)
+        cache_file = None
+        cache_valid = False
+        if fits_file is not None:
+            cache_file = os.path.splitext(fits_file)[0] + '_quantiles.npz'
+            cache_valid = (os.path.isfile(cache_file) and
+                           os.path.getmtime(cache_file) >= 
+                           os.path.getmtime(fits_file))
+
+        table = getattr(self,'_quantile_table',None)
+        if table is None and cache_valid:
+            table = PSFQuantileTable.load(cache_file)
+        elif table is None:
+            table = PSFQuantileTable.create(self)
+
+        if persist and cache_file is not None and not cache_valid:
+            table.save(cache_file)
+
+        self._quantile_table = table
+        return table
         
-        cdf = 2*np.pi*np.sin(np.radians(xc))*y*deltax
-        cdf = np.cumsum(cdf)
-        cdf = np.concatenate(([0],cdf))
-        cdf /= cdf[-1]
-
-        return percentile(x,cdf,frac)
+    def quantile(self,egy,cth,frac=0.68):
+        return self.quantile_table()(egy,cth,frac)
 
     def psf_scale(self,loge):
 
@@ -593,16 +865,15 @@ class PSFIRF(IRFComponent):
     
         
     def eval(self,dtheta,egy,cth):
-        """Evaluate PSF by interpolating in PSF parameters."""
-        
-        if self._ct == 'back': c = self._cback
-        else: c = self._cfront
-        
-        spx = np.sqrt(np.power(c[0]*np.power(10,-self._beta*(2.0-egy)),2) +
-                      np.power(c[1],2))
+        """Evaluate PSF by interpolating in PSF parameters.  The
+        parameters are interpolated on the broadcast shape of egy and
+        cth only."""
 
-        spx = np.degrees(spx)
+        dtheta = np.array(dtheta,ndmin=1,dtype=float)
+        egy, cth = np.broadcast_arrays(np.array(egy,ndmin=1,dtype=float),
+                                       np.array(cth,ndmin=1,dtype=float))
         
+        spx = np.degrees(self.psf_scale(egy))
         x = dtheta/spx
                 
         gcore = self._gcore_hist.interpolate(cth,egy)
@@ -616,49 +887,90 @@ class PSFIRF(IRFComponent):
 
         #gcore = max(1.2,gcore)
         #gtail = max(1.2,gtail)
-        
-        return (fcore*self.king(x,score,gcore) +
-                (1-fcore)*self.king(x,stail,gtail))/(spx*spx)
+
+        v = self.king(x,score,gcore)
+        v *= fcore
+        v += (1-fcore)*self.king(x,stail,gtail)
+        v /= spx*spx
+        return v
 
     def eval2(self,dtheta,egy,cth):
         """Evaluate PSF by interpolating in PSF density."""
-        dtheta = np.array(dtheta,ndmin=1)
-        egy = np.array(egy,ndmin=1)
-        cth = np.array(cth,ndmin=1)
 
+        dtheta, egy, cth = np.broadcast_arrays(np.array(dtheta,ndmin=1),
+                                               np.array(egy,ndmin=1),
+                                               np.array(cth,ndmin=1))
 
-        dtheta[dtheta <= 10**self._theta_axis.lo_edge()] =\
-            10**self._theta_axis.lo_edge()
-        
-        return self._psf_hist.interpolate(cth,egy,np.log10(dtheta))
+        logth = np.log10(np.maximum(np.ravel(dtheta),
+                                    10**self._theta_axis.lo_edge()))
+        v = self._psf_hist.interpolate(np.vstack((np.ravel(cth),
+                                                  np.ravel(egy),logth)))
+        return v.reshape(dtheta.shape)
 
-    def king(self,dtheta,sig,g):
+    def eval3(self,dtheta,egy,cth):
+        """Evaluate PSF by bilinear interpolation in energy and
+        incidence angle between the PSF densities at the four nearest
+        table nodes.  The density at each node is evaluated with the
+        parameters and PSF scale factor of that node.  This is the
+        interpolation scheme of the ScienceTools PSF classes.  Points
+        outside the table are evaluated at the nearest edge."""
 
-        if sig.shape[0] > 1:
+        dtheta, egy, cth = np.broadcast_arrays(np.array(dtheta,ndmin=1),
+                                               np.array(egy,ndmin=1),
+                                               np.array(cth,ndmin=1))
+        shape = dtheta.shape
+        dtheta = np.ravel(dtheta).astype(float)
 
-            if dtheta.ndim == 1:
-                dtheta2 = np.empty(shape=(dtheta.shape[0],sig.shape[0]))
-                dtheta2.T[:] = dtheta
-            else:
-                dtheta2 = dtheta
+        ie, we = self._node_index(self._energy_axis.center,np.ravel(egy))
+        ic, wc = self._node_index(self._cth_axis.center,np.ravel(cth))
 
-            sig2 = np.empty(shape=(dtheta.shape[0],sig.shape[0]))
-            sig2[:] = sig
-            
-            g2 = np.empty(shape=(dtheta.shape[0],sig.shape[0]))
-            g2[:] = g
+        v = np.zeros(len(dtheta))
+        for i, j, w in [(ic,ie,(1-wc)*(1-we)),(ic+1,ie,wc*(1-we)),
+                        (ic,ie+1,(1-wc)*we),(ic+1,ie+1,wc*we)]:
+            v += w*self._eval_node(dtheta,i,j)
 
-            n = 1./(2*np.pi*sig2*sig2)
-            u = np.power(dtheta2,2)/(2*sig2*sig2)
-            
-            return n*(1-1/g2)*np.power(1+u/g2,-g2)
+        return v.reshape(shape)
 
-        else:
-                    
-            n = 1./(2*np.pi*sig*sig)
-            u = np.power(dtheta,2)/(2*sig*sig)
-            
-            return n*(1-1/g)*np.power(1+u/g,-g)
+    @staticmethod
+    def _node_index(x0,x):
+        """Return the index of the lower node and the interpolation
+        weight of the upper node for each point in x."""
+
+        i = np.searchsorted(x0,x,side='right')-1
+        i = np.clip(i,0,len(x0)-2)
+        w = np.clip((x-x0[i])/(x0[i+1]-x0[i]),0.0,1.0)
+        return i, w
+
+    def _eval_node(self,dtheta,icth,iegy):
+        """Evaluate the PSF with the parameters of the table nodes
+        (icth,iegy)."""
+
+        spx = np.degrees(self.psf_scale(self._energy_axis.center[iegy]))
+        x = dtheta/spx
+
+        fcore = np.clip(self._fcore_hist.counts[icth,iegy],0.0,1.0)
+
+        v = self.king(x,self._score_hist.counts[icth,iegy],
+                      self._gcore_hist.counts[icth,iegy])
+        v *= fcore
+        v += (1-fcore)*self.king(x,self._stail_hist.counts[icth,iegy],
+                                 self._gtail_hist.counts[icth,iegy])
+        v /= spx*spx
+        return v
+
+    def king(self,dtheta,sig,g):
+        """Evaluate the King function.  The arguments are broadcast
+        against each other.  Only one array with the broadcast shape
+        is allocated when sig and g have fewer elements than
+        dtheta."""
+
+        s2 = 2*sig*sig
+        
+        v = np.square(dtheta)/(s2*g)
+        v += 1
+        np.power(v,-g,out=v)
+        v *= (1-1/g)/(np.pi*s2)
+        return v
     
     def save(self,filename):
 
@@ -686,29 +998,19 @@ class PSFPyIRF(PSFIRF):
         self._irf = irf
 
     def __call__(self,dtheta,egy,cth):
-
-        dtheta = np.asarray(dtheta)
-        cth = np.asarray(cth)
-        
-        if dtheta.ndim == 0:
-            return self._irf.value(dtheta,float(np.power(10,egy)),
-                                   float(np.degrees(np.arccos(cth))),0)
-
-        if cth.shape[0] > 1:        
-            z = np.zeros(shape=(dtheta.shape[0],cth.shape[0]))
-
-            for i, t in enumerate(dtheta):
-                for j, c in enumerate(cth):
-                    z[i,j] = self._irf.value(t,float(np.power(10,egy)),
-                                             float(np.degrees(np.arccos(c))),0)
-        else:
-
-            
-            
-            z =  np.zeros(shape=dtheta.shape)
-            for i, t in enumerate(dtheta):
-                z[i] = self._irf.value(t,float(np.power(10,egy)),
-                                       float(np.degrees(np.arccos(cth))),0)
+        """Evaluate the PSF in sr^-1.  The arguments are broadcast
+        against each other."""
+
+        dtheta, egy, cth = np.broadcast_arrays(np.asarray(dtheta,dtype=float),
+                                               np.asarray(egy,dtype=float),
+                                               np.asarray(cth,dtype=float))
+        theta = np.degrees(np.arccos(cth))
+
+        z = np.zeros(dtheta.shape)
+        for idx in np.ndindex(*z.shape):
+            z[idx] = self._irf.value(float(dtheta[idx]),
+                                     float(np.power(10,egy[idx])),
+                                     float(theta[idx]),0)
 
         return z
             
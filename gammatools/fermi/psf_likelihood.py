@@ -8,77 +8,87 @@ import numpy as np
 
 from gammatools.core.histogram import Histogram
 
-from gammatools.core.model_fn import PDF, ParamFnBase
+from gammatools.core.model_fn import PDF, ParamFnBase, param_array
+from gammatools.core.parameter_set import Parameter, ParameterSet
 
 from gammatools.core.util import convolve2d_gauss
 import scipy.special as spfn
+from scipy.interpolate import UnivariateSpline
 
 
 class ConvolvedGaussFn(PDF):
-    def __init__(self,pset,psf_model):   
+    def __init__(self,pnorm,psigma,psf_model,method='direct'):
+        """Model for a 2D gaussian convolved with a PSF model.  The
+        convolution method can be 'direct' (quadrature) or 'hankel'
+        (see util.convolve2d_hankel)."""
+
+        pset = ParameterSet([pnorm,psigma])
+        pset.addSet(psf_model.param())
         PDF.__init__(self,pset)
         self._psf_model = copy.deepcopy(psf_model)
-#        self._pid = [pnorm.pid(),psigma.pid()]
+        self._method = method
+        self._pid = [pnorm.pid,psigma.pid]
+
+        pids = pset.pids()
+        self._idx = [pids.index(pid) for pid in self._pid]
 
         x = np.linspace(-4,4,800)
         self._ive = UnivariateSpline(x,spfn.ive(0,10**x),s=0,k=2)
 
     @staticmethod
-    def create(norm,sigma,psf_model,pset=None,prefix=''):
+    def create(norm,sigma,psf_model,pset=None,prefix='',method='direct'):
 
         if pset is None: pset = ParameterSet()
-#        
+
+        # Parameter IDs are assigned after those of the PSF model
+        pset.addSet(psf_model.param()) 
         p0 = pset.createParameter(norm,prefix + 'norm')
         p1 = pset.createParameter(sigma,prefix + 'sigma')
-        pset.addSet(psf_model.param()) 
 
-        return ConvolvedGaussFn(pset,psf_model)
+        return ConvolvedGaussFn(p0,p1,psf_model,method)
 
-    def _eval(self,dtheta,pset):
+    def _eval_pdf(self,dtheta,pset):
 
         a = pset.array()
 
-        print 'a ', a
+        v = []
+        for i in range(a.shape[1]):
+            p = self._param.overlay(a[:,i])
+            fn = lambda x: self._psf_model.eval(x,p)
+            v.append(a[self._idx[0],i]*self.convolve(fn,dtheta,
+                                                     a[self._idx[1],i],
+                                                     3.0,nstep=200)[0])
 
-#        norm = pset[self._pid[0]]
-#        sig = pset[self._pid[1]]
-
-#        self._psf_model.setParam(pset)
-        v = self._psf_model.eval(dtheta,pset)
-
-        return a[0]*self.convolve(lambda x: self._psf_model.eval(x),
-                                  dtheta,a[1],3.0,nstep=200)
+        if len(v) == 1: return v[0]
+        else: return np.array(v)
 
     def _integrate(self,xlo,xhi,pset):
 
-        xlo = np.array(xlo,ndmin=1,copy=True)
-        xhi = np.array(xhi,ndmin=1,copy=True)
-
-        xlo.shape += (1,)
-        xhi.shape += (1,)
+        xlo = np.array(xlo,ndmin=1,dtype=float)[:,np.newaxis]
+        xhi = np.array(xhi,ndmin=1,dtype=float)[:,np.newaxis]
 
         nbin = 3
 
         xedge = np.linspace(0,1,nbin+1)
         x = 0.5*(xedge[1:]+xedge[:-1])
-        x.shape = (1,) + x.shape
-
-        xp = np.zeros(shape=xlo.shape + (nbin,))
 
         xp = xlo + x*(xhi-xlo)
         dx = (xhi-xlo)/float(nbin)
-        dx.shape = (1,) + dx.shape
 
-        v = self.eval(xp.flat,pset)
-        v = v.reshape((v.shape[0],) + xp.shape)
+        v = self._eval_pdf(np.ravel(xp),pset)
+        v = v.reshape(v.shape[:-1] + xp.shape)
         v *= 2*dx*xp*np.pi
 
-        return np.sum(v,axis=2)
+        return np.sum(v,axis=-1)
 
     def convolve(self,fn,r,sig,rmax,nstep=200):
         r = np.array(r,ndmin=1,copy=True)
         sig = np.array(sig,ndmin=1,copy=True)
 
+        if self._method == 'hankel':
+            s = convolve2d_gauss(fn,r,sig,rmax,method='hankel')
+            return s.reshape((sig.shape[0],r.shape[0]))
+
         rp = np.ones(shape=(1,1,nstep))
         rp *= np.linspace(0,rmax,nstep)
              
@@ -111,11 +121,14 @@ class KingFn(PDF):
     def __init__(self,psigma,pgamma,pnorm=None):
 
         pset = ParameterSet([psigma,pgamma])
-        self._pid = [psigma.pid(),pgamma.pid()]
+        self._pid = [psigma.pid,pgamma.pid]
         if not pnorm is None: 
             pset.addParameter(pnorm)
-            self._pid += [pnorm.pid()]
-        PDF.__init__(self,pset,cname='dtheta')      
+            self._pid += [pnorm.pid]
+        PDF.__init__(self,pset)
+
+        pids = pset.pids()
+        self._idx = [pids.index(pid) for pid in self._pid]
 
     @staticmethod
     def create(sigma,gamma,norm=1.0,offset=0):
@@ -133,33 +146,50 @@ class KingFn(PDF):
     def norm(self):
         return self._param.getParByID(self._pid[2])
 
-    def _eval(self,x,pset):
+    def _unpack(self,pset):
+        """Return the sigma, gamma, and normalization arrays and a
+        mask of the values where gamma is clamped to 1.1."""
+
+        a = param_array(pset)
+        sig = a[self._idx[0]]
+        g = a[self._idx[1]]
+        if len(self._pid) == 3: norm = a[self._idx[2]]
+        else: norm = np.ones_like(sig)
 
-        sig = pset[self._pid[0]]
-        g = pset[self._pid[1]]        
-        if len(self._pid) == 3: norm = pset[self._pid[2]]
-        else: norm = 1.0
+        msk = g <= 1.1
+        g = np.where(msk,1.1,g)
+        return sig, g, norm, msk
 
-#        if len(norm) > 1:
-#            norm = norm.reshape(norm.shape + (1,)*dtheta.ndim)
-#            sig = sig.reshape(sig.shape + (1,)*dtheta.ndim)
-#            g = g.reshape(g.shape + (1,)*dtheta.ndim)
+    def has_grad(self):
+        return True
 
-        g[g<=1.1] = 1.1
+    def _eval_pdf(self,x,pset):
+
+        sig, g, norm, msk = self._unpack(pset)
 
         n = 2*np.pi*sig*sig            
         u = np.power(x,2)/(2*sig*sig)
         
         return norm*(1-1/g)*np.power(1+u/g,-g)/n
-    
-    def integrate(self,dlo,dhi,pset):
 
-        sig = pset[self._pid[0]]
-        g = pset[self._pid[1]]        
-        if len(self._pid) == 3: norm = pset[self._pid[2]]
-        else: norm = 1.0
+    def _grad(self,x,pset):
+
+        sig, g, norm, msk = self._unpack(pset)
+
+        u = np.power(x,2)/(2*sig*sig)
+        f = self._eval_pdf(x,pset)
+
+        ds = f*((2*u/sig)/(1+u/g) - 2/sig)
+        dg = f*(1/(g*(g-1)) - np.log(1+u/g) + (u/g)/(1+u/g))
+        dg *= ~msk
 
-        g[g<=1.1] = 1.1
+        v = [ds,dg]
+        if len(self._pid) == 3: v += [f/norm]
+        return self._rows(v)
+
+    def _integrate(self,dlo,dhi,pset):
+
+        sig, g, norm, msk = self._unpack(pset)
 
         um = dlo*dlo/(2.*sig*sig)
         ua = dhi*dhi/(2.*sig*sig)
@@ -167,6 +197,35 @@ class KingFn(PDF):
         f1 = (1+ua/g)**(-g+1)
         return norm*(f0-f1)
 
+    def _integrate_grad(self,dlo,dhi,pset):
+
+        sig, g, norm, msk = self._unpack(pset)
+
+        um = dlo*dlo/(2.*sig*sig)
+        ua = dhi*dhi/(2.*sig*sig)
+        f0 = (1+um/g)**(-g+1)
+        f1 = (1+ua/g)**(-g+1)
+
+        def dfds(u):
+            return 2*u*(g-1)/(g*sig)*(1+u/g)**(-g)
+
+        def dfdg(u,f):
+            return f*(-np.log(1+u/g) + (g-1)*u/(g*g*(1+u/g)))
+        
+        ds = norm*(dfds(um)-dfds(ua))
+        dg = norm*(dfdg(um,f0)-dfdg(ua,f1))*~msk
+
+        v = [ds,dg]
+        if len(self._pid) == 3: v += [f0-f1]
+        return self._rows(v)
+
+    def _rows(self,v):
+        """Reorder a list of derivatives given in the order of
+        self._pid to the order of the parameter set."""
+        g = np.zeros((len(v),) + np.broadcast(*v).shape)
+        for i, vi in zip(self._idx,v): g[i] = vi
+        return g
+
     def cdf(self,dtheta,p=None):
     
         return self.integrate(0,dtheta,p)
@@ -222,28 +281,57 @@ class PowerlawFn(PDF):
 
     def __init__(self,pnorm,pgamma):
         pset = ParameterSet([pnorm,pgamma])
-        self._pid = [pnorm.pid(),pgamma.pid()]
+        self._pid = [pnorm.pid,pgamma.pid]
         self._enorm = 3.0
-        PDF.__init__(self,pset,cname='energy')      
+        PDF.__init__(self,pset)
 
-    def _eval(self,x,p):
+        pids = pset.pids()
+        self._idx = [pids.index(pid) for pid in self._pid]
+
+    def _unpack(self,pset):
+        a = param_array(pset)
+        return a[self._idx[0]], a[self._idx[1]]
 
-        norm = p[self._pid[0]]
-        gamma = p[self._pid[1]]        
+    def has_grad(self):
+        return True
 
+    def _eval_pdf(self,x,p):
+
+        norm, gamma = self._unpack(p)
         return norm*10**(-gamma*(x-self._enorm))
 
-    def _integrate(self,xlo,xhi,p):
+    def _grad(self,x,p):
 
-        x = 0.5*(xhi+xlo)
-        dx = xhi-xlo
+        norm, gamma = self._unpack(p)
+        f = 10**(-gamma*(x-self._enorm))
 
-        norm = p[self._pid[0]]
-        gamma = p[self._pid[1]]  
+        v = np.zeros((2,) + f.shape)
+        v[self._idx[0]] = f
+        v[self._idx[1]] = -norm*f*(x-self._enorm)*np.log(10.)
+        return v
+
+    def _integrate(self,xlo,xhi,p):
+
+        norm, gamma = self._unpack(p)
 
         g1 = -gamma+1
         return norm/g1*10**(gamma*self._enorm)*(10**(xhi*g1) - 10**(xlo*g1))
 
+    def _integrate_grad(self,xlo,xhi,p):
+
+        norm, gamma = self._unpack(p)
+
+        g1 = -gamma+1
+        c = 10**(gamma*self._enorm)/g1
+        v = c*(10**(xhi*g1) - 10**(xlo*g1))
+        dv = c*(xhi*10**(xhi*g1) - xlo*10**(xlo*g1))
+        ln10 = np.log(10.)
+
+        g = np.zeros((2,) + v.shape)
+        g[self._idx[0]] = v
+        g[self._idx[1]] = norm*((self._enorm*ln10 + 1./g1)*v - ln10*dv)
+        return g
+
 class BinnedLnL(ParamFnBase):
 
     def __init__(self,non,xedge,model):
@@ -258,16 +346,15 @@ class BinnedLnL(ParamFnBase):
 
     def eval(self,p):
 
-        pset = self._model.param(True).update(p)
+        pset = self._model.param().overlay(p)
 
         nbin = len(self._xedge)-1
         xlo = self._xedge[:-1]
         xhi = self._xedge[1:]
 
 
-        non = (np.ones(shape=(pset.size(),nbin))*self._non)
-
         mus = self._model.integrate(xlo,xhi,pset)
+        non = (np.ones(shape=mus.shape)*self._non)
         msk_on = non > 0
 
         lnl = (-mus)
@@ -276,6 +363,25 @@ class BinnedLnL(ParamFnBase):
         if pset.size() > 1: return -np.sum(lnl,axis=1)
         else: return -np.sum(lnl)
 
+    def has_grad(self):
+        return self._model.has_grad()
+
+    def grad(self,p=None):
+
+        pset = self._model.param().overlay(p)
+
+        xlo = self._xedge[:-1]
+        xhi = self._xedge[1:]
+
+        mus = self._model.integrate(xlo,xhi,pset)
+        dmus = self._model.integrate_grad(xlo,xhi,pset)
+
+        w = -np.ones(mus.shape)
+        msk_on = self._non > 0
+        w[msk_on] += self._non[msk_on]/mus[msk_on]
+
+        return -np.sum(w*dmus,axis=-1)
+
 class Binned2DLnL(ParamFnBase):
 
     def __init__(self,non,xedge,yedge,model):
@@ -300,7 +406,7 @@ class Binned2DLnL(ParamFnBase):
 
     def eval(self,p):
 
-        pset = self._model.param(True).update(p)
+        pset = self._model.param().overlay(p)
 
         nbinx = len(self._xedge)-1
         nbiny = len(self._yedge)-1
@@ -339,8 +445,7 @@ class OnOffBinnedLnL(ParamFnBase):
 
     def eval(self,p):
 
-        pset = self._model.param(True)
-        pset.update(p)
+        pset = self._model.param().overlay(p)
 
         alpha = self._alpha
 
@@ -356,14 +461,14 @@ class OnOffBinnedLnL(ParamFnBase):
 #        noff.shape = (1,) + noff.shape
 
 #        if pset.size() > 1:
-        non = (np.ones(shape=(pset.size(),nbin))*self._non)
-        noff = (np.ones(shape=(pset.size(),nbin))*self._noff)
+        mus = self._model.integrate(xlo,xhi,pset)
+
+        non = (np.ones(shape=mus.shape)*self._non)
+        noff = (np.ones(shape=mus.shape)*self._noff)
 #        else:            
 #            non = self._non
 #            noff = self._noff
 
-        mus = self._model.integrate(xlo,xhi,pset)
-
         mub = ((self._mub0/2. - mus/(2.*alpha) + 
                np.sqrt(noff*mus/(alpha*(1+alpha)) + 
                        (self._mub0/2.-mus/(2.*alpha))**2)))
@@ -385,6 +490,34 @@ class OnOffBinnedLnL(ParamFnBase):
         else:
             return -np.sum(lnl)
 
+    def has_grad(self):
+        return self._model.has_grad()
+
+    def grad(self,p=None):
+        """Evaluate the gradient of the profile likelihood.  Since
+        mub maximizes the likelihood at fixed mus, only the explicit
+        dependence on mus contributes."""
+
+        pset = self._model.param().overlay(p)
+
+        alpha = self._alpha
+
+        xlo = self._xedge[:-1]
+        xhi = self._xedge[1:]
+
+        mus = self._model.integrate(xlo,xhi,pset)
+        dmus = self._model.integrate_grad(xlo,xhi,pset)
+
+        mub = ((self._mub0/2. - mus/(2.*alpha) + 
+               np.sqrt(self._noff*mus/(alpha*(1+alpha)) + 
+                       (self._mub0/2.-mus/(2.*alpha))**2)))
+
+        w = -np.ones(mus.shape)
+        msk_on = self._non > 0
+        w[msk_on] += self._non[msk_on]/(alpha*mub[msk_on]+mus[msk_on])
+
+        return -np.sum(w*dmus,axis=-1)
+
 
 
         
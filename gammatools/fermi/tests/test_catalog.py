@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from gammatools.core.util import separation_angle
+from gammatools.fermi.catalog import *
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+
+        self._cat = Catalog.get('2fgl')
+        srcs = self._cat.sources()
+        self._src_ra = np.radians([s['RAJ2000'] for s in srcs])
+        self._src_dec = np.radians([s['DEJ2000'] for s in srcs])
+
+        rs = np.random.RandomState(1)
+        self._ra = rs.uniform(0.,360.,200)
+        self._dec = np.degrees(np.arcsin(rs.uniform(-1.,1.,200)))
+
+    def sep(self,ra,dec):
+        return np.degrees(separation_angle(np.radians(ra),np.radians(dec),
+                                           self._src_ra,self._src_dec))
+
+    def test_query_radius(self):
+
+        ipos, isrc, sep = self._cat.query_radius(self._ra,self._dec,5.0,
+                                                 min_radius=1.0)
+
+        for i in range(len(self._ra)):
+
+            s = self.sep(self._ra[i],self._dec[i])
+            idx = np.where((s < 5.0) & (s > 1.0))[0]
+
+            assert_allclose(isrc[ipos==i],idx)
+            assert_allclose(sep[ipos==i],s[idx],atol=1E-8)
+
+        srcs = self._cat.get_source_by_position(83.6,22.0,3.0)
+        self.assertEqual([s.name for s in srcs],
+                         ['2FGL J0526.6+2248','2FGL J0534.5+2201'])
+
+    def test_nearest(self):
+
+        isrc, sep = self._cat.nearest(self._ra,self._dec,k=3)
+
+        for i in range(len(self._ra)):
+
+            s = self.sep(self._ra[i],self._dec[i])
+            idx = np.argsort(s)[:3]
+
+            assert_allclose(isrc[i],idx)
+            assert_allclose(sep[i],s[idx],atol=1E-8)
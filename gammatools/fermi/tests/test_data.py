@@ -0,0 +1,264 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+from gammatools.core.util import expand_aliases
+from gammatools.fermi.data import *
+
+def get_mask_ref(data,selections=None,conversion_type=None,
+                 event_class=None,event_class_id=None,event_type_id=None,
+                 phases=None,cuts=None,src_index=None,cuts_file=None):
+    """Reference selection evaluated as a chain of OR and AND
+    operations on each criterion."""
+
+    mask = data['energy'] > 0
+
+    if not selections is None:
+        for k, v in selections.iteritems():
+            mask &= (data[k] >= v[0]) & (data[k] <= v[1])
+
+    if not conversion_type is None:
+        if conversion_type == 'front':
+            mask &= (data['conversion_type'] == 0)
+        else:
+            mask &= (data['conversion_type'] == 1)
+
+    if not cuts is None and not cuts_file is None:
+        cut_defs = yaml.load(open(cuts_file,'r'))
+        cut_defs['CTBBestLogEnergy'] = 'data[\'energy\']'
+        cut_defs['CTBCORE'] = 'data[\'psfcore\']'
+        cut_defs['pow'] = 'np.power'
+
+        for c in cuts.split(','):
+            cv = c.split('/')
+            if len(cv) == 1:
+                mask &= eval(expand_aliases(cut_defs,cv[0]))
+            elif cv[0] in data:
+                mask &= (data[cv[0]] >= float(cv[1]))
+                mask &= (data[cv[0]] <= float(cv[2]))
+
+    bits = { 'source' : 2, 'clean' : 3, 'ultraclean' : 4 }
+    if not event_class_id is None:
+        mask &= (data['event_class'].astype('int')&(1<<event_class_id)>0)
+    elif event_class in bits:
+        mask &= (data['event_class'].astype('int')&(1<<bits[event_class])>0)
+
+    if not event_type_id is None:
+        mask &= (data['event_type'].astype('int')&(1<<event_type_id)>0)
+
+    if src_index is not None:
+        src_mask = data['src_index'].astype('int') < 0
+        for isrc in src_index:
+            src_mask |= (data['src_index'].astype('int') == int(isrc))
+        mask &= src_mask
+
+    if phases is not None:
+        phase_mask = data['phase'] < 0
+        for p in phases:
+            phase_mask |= ((data['phase'] > p[0]) & (data['phase'] < p[1]))
+        mask &= phase_mask
+
+    return mask
+
+def create_photon_data(nevent,seed=1,nsrc=6):
+
+    rs = np.random.RandomState(seed)
+
+    d = PhotonData()
+    d['ra'] = rs.uniform(0.,360.,nevent)
+    d['dec'] = rs.uniform(-90.,90.,nevent)
+    d['energy'] = rs.uniform(1.,5.,nevent)
+    d['energy'][rs.uniform(size=nevent) < 0.05] = 0.0
+    d['cth'] = rs.uniform(0.2,1.0,nevent)
+    d['psfcore'] = rs.uniform(0.,1.,nevent)
+    d['time'] = rs.uniform(0.,1E3,nevent)
+    d['phase'] = rs.uniform(-0.2,1.0,nevent)
+    d['conversion_type'] = rs.randint(0,2,nevent)
+    d['event_class'] = rs.randint(0,32,nevent)
+    d['event_type'] = rs.randint(0,8,nevent)
+    d['src_index'] = rs.randint(-1,nsrc,nevent)
+
+    for k in ['delta_ra','delta_dec','delta_phi','delta_theta','dtheta']:
+        d[k] = rs.uniform(-1.,1.,nevent)
+
+    return d
+
+class TestPhotonSelection(unittest.TestCase):
+
+    def setUp(self):
+
+        self._dir = tempfile.mkdtemp()
+        self._cuts_file = os.path.join(self._dir,'cuts.yaml')
+        with open(self._cuts_file,'w') as f:
+            f.write('HighEnergy : CTBBestLogEnergy > 2.5\n')
+            f.write('Core : CTBCORE > 0.1\n')
+
+        rs = np.random.RandomState(3)
+        many_phases = np.sort(rs.uniform(0.,1.,(20,2)),axis=1)
+
+        self._selections = [
+            { 'selections' : {'energy' : [2.0,4.0], 'cth' : [0.3,0.8]} },
+            { 'conversion_type' : 'front' },
+            { 'conversion_type' : 'back' },
+            { 'event_class' : 'clean' },
+            { 'event_class' : 'source', 'event_class_id' : 1 },
+            { 'event_type_id' : 2, 'event_class' : 'ultraclean' },
+            { 'phases' : [[0.1,0.3],[0.2,0.5],[0.7,0.8]] },
+            { 'phases' : [[0.6,0.9],[0.0,0.1],[0.65,0.7]] },
+            { 'phases' : many_phases },
+            { 'src_index' : [0,3] },
+            { 'src_index' : [4,-1,10,4] },
+            { 'src_index' : [] },
+            { 'cuts' : 'HighEnergy&Core,psfcore/0.2/0.8,missing/0/1',
+              'cuts_file' : self._cuts_file },
+            { 'selections' : {'energy' : [1.5,4.5]},
+              'conversion_type' : 'back', 'event_class_id' : 3,
+              'phases' : [[0.2,0.6]], 'src_index' : [1,2,5] } ]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def check_masks(self,data):
+
+        for kwargs in self._selections:
+
+            msk = PhotonData.get_mask(data,**kwargs)
+            msk_ref = get_mask_ref(data,**kwargs)
+
+            self.assertEqual(msk.dtype,bool)
+            assert_array_equal(msk,msk_ref)
+
+    def test_mask(self):
+
+        d = create_photon_data(5000)
+        self.check_masks(d)
+
+        # Dictionary of columns
+        self.check_masks(dict([(k,d[k]) for k in d.columns()]))
+
+    def test_index_sources(self):
+
+        d = create_photon_data(5000)
+        d.index_sources()
+
+        src = d['src_index']
+        self.assertTrue(np.all(src[1:] >= src[:-1]))
+        for isrc in range(-1,8):
+            assert_array_equal(np.arange(len(src))[d.src_slice(isrc)],
+                               np.where(src==isrc)[0])
+
+        # Sorted path
+        self.check_masks(d)
+
+        # Offsets are recomputed after a mask is applied
+        d.apply_mask(d['energy'] > 2.0)
+        self.assertTrue(d._src_offsets is not None)
+        src = d['src_index']
+        for isrc in range(-1,8):
+            assert_array_equal(np.arange(len(src))[d.src_slice(isrc)],
+                               np.where(src==isrc)[0])
+        self.check_masks(d)
+
+        # Appending rows invalidates the offsets
+        d.merge(create_photon_data(1000,seed=2))
+        self.assertTrue(d._src_offsets is None)
+        self.check_masks(d)
+
+        d.index_sources()
+        src = d['src_index']
+        self.assertEqual(len(src),d.nrow())
+        self.assertTrue(np.all(src[1:] >= src[:-1]))
+        self.check_masks(d)
+
+        # Setting the source index invalidates the offsets
+        d['src_index'] = d['src_index'][::-1]
+        self.assertTrue(d._src_offsets is None)
+        self.check_masks(d)
+
+class TestPhotonData(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._data = [create_photon_data(500+100*i,seed=i) for i in range(4)]
+        for i, d in enumerate(self._data): d._srcs = [{'name' : 'src%i'%i}]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def check_data(self,d,columns=None):
+
+        if columns is None: columns = self._data[0].columns()
+
+        self.assertEqual(sorted(d.columns()),sorted(columns))
+        for k in columns:
+            v = np.concatenate([d0[k] for d0 in self._data])
+            assert_array_equal(d[k],v)
+            self.assertEqual(d[k].dtype,v.dtype)
+
+    def test_merge(self):
+
+        d = PhotonData()
+        for d0 in self._data: d.merge(d0)
+
+        # Rows are buffered until a column is accessed
+        self.assertEqual(len(d._chunks['energy']),4)
+        self.assertEqual(d.nrow(),np.sum([d0.nrow() for d0 in self._data]))
+        self.assertFalse('energy' in d._chunks)
+        self.assertTrue('ra' in d._chunks)
+        self.check_data(d)
+        self.assertEqual(d._srcs,self._data[-1]._srcs)
+
+        # Pickling consolidates the buffered rows
+        d = PhotonData()
+        for d0 in self._data: d.merge(d0)
+
+        outfile = os.path.join(self._dir,'photons.P')
+        d.save(outfile)
+        self.assertEqual(d._chunks,{})
+
+        d2 = PhotonData.load(outfile)
+        self.assertEqual(d2._chunks,{})
+        self.assertTrue(d2._src_offsets is None)
+        self.check_data(d2)
+
+        # Rows can be merged into an unpickled object
+        d2.merge(create_photon_data(10,seed=10))
+        self.assertEqual(d2.nrow(),d.nrow()+10)
+
+        # Restricted set of columns
+        d3 = PhotonData.load(outfile,columns=['energy','src_index'])
+        self.check_data(d3,['energy','src_index'])
+
+    def test_save_columns(self):
+
+        path = os.path.join(self._dir,'photons')
+        for i, d0 in enumerate(self._data):
+            d0.save_columns(path,append=(i>0))
+
+        d = PhotonData.load_columns(path)
+        self.check_data(d)
+        self.assertEqual(d._srcs,self._data[-1]._srcs)
+        self.assertTrue(os.path.isfile(os.path.join(path,'srcs.P')))
+
+        # Columns are memory-mapped
+        self.assertTrue(isinstance(d['energy'].base,np.memmap) or
+                        isinstance(d['energy'],np.memmap))
+
+        d = PhotonData.load(path,columns=['energy','phase'])
+        self.check_data(d,['energy','phase'])
+
+        # Overwrite without append
+        self._data[0].save_columns(path)
+        d = PhotonData.load(path)
+        self.assertEqual(d.nrow(),self._data[0].nrow())
+
+        # Selections on a memory-mapped object
+        d = PhotonData.load(path)
+        msk = PhotonData.get_mask(d,{'energy' : [2.0,4.0]},src_index=[1])
+        assert_array_equal(msk,get_mask_ref(self._data[0],
+                                            {'energy' : [2.0,4.0]},
+                                            src_index=[1]))
+        d.apply_mask(msk)
+        self.assertEqual(d.nrow(),np.sum(msk))
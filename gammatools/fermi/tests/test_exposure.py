@@ -0,0 +1,255 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import healpy
+from numpy.testing import assert_allclose
+from gammatools.core.astropy_helper import pyfits, pywcs
+from gammatools.core.util import gal2eq
+from gammatools.fermi.irf_util import IRF, IRFManager, AeffIRF
+from gammatools.fermi.exposure import *
+from test_irf_util import write_aeff
+
+def write_ltcube(fname,nside=16,ncth=40,seed=1,tstart=0.0,nest=True):
+    """Write a livetime cube with random livetimes.  The livetimes
+    are generated in NESTED ordering and reordered for a RING cube."""
+
+    rs = np.random.RandomState(seed)
+    npix = healpy.nside2npix(nside)
+    lt = rs.uniform(0.,1E3,(npix,ncth))
+    if not nest: lt = lt[healpy.ring2nest(nside,np.arange(npix))]
+    cth_min = 1.0 - np.arange(1,ncth+1)/float(ncth)
+
+    hdu0 = pyfits.PrimaryHDU()
+    hdu0.header['TSTART'] = tstart
+    hdu0.header['TSTOP'] = tstart + 1E6
+
+    hdu_lt = pyfits.BinTableHDU.from_columns([
+            pyfits.Column(name='COSBINS',format='%iE'%ncth,array=lt)])
+    hdu_lt.name = 'EXPOSURE'
+    hdu_lt.header['NSIDE'] = nside
+    if nest: hdu_lt.header['ORDERING'] = 'NESTED'
+    else: hdu_lt.header['ORDERING'] = 'RING'
+    hdu_wlt = pyfits.BinTableHDU.from_columns([
+            pyfits.Column(name='COSBINS',format='%iE'%ncth,array=lt)])
+    hdu_wlt.name = 'WEIGHTED_EXPOSURE'
+    hdu_cth = pyfits.BinTableHDU.from_columns([
+            pyfits.Column(name='CTHETA_MIN',format='E',array=cth_min)])
+    hdu_cth.name = 'CTHETABOUNDS'
+
+    pyfits.HDUList([hdu0,hdu_lt,hdu_wlt,hdu_cth]).writeto(fname)
+
+class TestLTCube(unittest.TestCase):
+
+    def setUp(self):
+
+        self._dir = tempfile.mkdtemp()
+        self._files = [os.path.join(self._dir,'ltcube_%02i.fits'%i)
+                       for i in range(5)]
+        for i, f in enumerate(self._files):
+            write_ltcube(f,nside=8,seed=i,tstart=i*1E6)
+
+        self._ltmap = 0
+        for f in self._files:
+            lt = pyfits.open(f)[1].data.field(0)
+            self._ltmap += np.array(lt,dtype=float)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_sum(self):
+
+        for workers in [1,3]:
+            ltc = LTCube(self._files,workers=workers)
+            assert_allclose(ltc._ltmap,self._ltmap,rtol=1E-10)
+            self.assertEqual(ltc.nside,8)
+            self.assertEqual(ltc._tstart,0.0)
+            self.assertEqual(ltc._tstop,5E6)
+
+        # List of files
+        txtfile = os.path.join(self._dir,'ltcubes.txt')
+        np.savetxt(txtfile,self._files,fmt='%s')
+        assert_allclose(LTCube(txtfile)._ltmap,self._ltmap,rtol=1E-10)
+
+    def test_cache(self):
+
+        cache_dir = os.path.join(self._dir,'cache')
+        ltc = LTCube(self._files,cache_dir=cache_dir)
+        cache_file = os.path.join(cache_dir,'ltcube_%s.npz'%
+                                  LTCube.cache_key(self._files))
+        self.assertTrue(os.path.isfile(cache_file))
+
+        # Cached cube is used for the same set of inputs
+        np.savez(cache_file,ltmap=ltc._ltmap*2,cth_edges=ltc._cth_edges,
+                 tstart=ltc._tstart,tstop=ltc._tstop,nside=8,nest=True)
+        ltc2 = LTCube(self._files[::-1],cache_dir=cache_dir)
+        assert_allclose(ltc2._ltmap,2*self._ltmap,rtol=1E-10)
+        assert_allclose(ltc2._cth_edges,ltc._cth_edges)
+        self.assertEqual(ltc2.nside,8)
+
+        # A different set of inputs has a different key
+        ltc3 = LTCube(self._files[:3],cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)),2)
+
+    def test_get_src_lthist(self):
+
+        ltc = LTCube(self._files)
+
+        ra = np.array([10.,120.,250.])
+        dec = np.array([-45.,0.,80.])
+        h = ltc.get_src_lthist(ra,dec)
+        self.assertEqual(h.counts.shape,(3,40))
+
+        for i in range(3):
+            ipix = healpy.ang2pix(8,np.radians(90.-dec[i]),np.radians(ra[i]),
+                                  nest=True)
+            h1 = ltc.get_src_lthist(ra[i],dec[i])
+            assert_allclose(h1.counts,self._ltmap[ipix,::-1],rtol=1E-10)
+            assert_allclose(h.counts[i],h1.counts)
+
+class TestExposureCalc(unittest.TestCase):
+
+    def setUp(self):
+
+        self._dir = tempfile.mkdtemp()
+        ltfile = os.path.join(self._dir,'ltcube.fits')
+        aeff_file = os.path.join(self._dir,'aeff.fits')
+        write_ltcube(ltfile)
+        write_aeff(aeff_file)
+
+        self._irfm = IRFManager([IRF(None,AeffIRF(aeff_file),None)])
+        self._ltc = LTCube(ltfile)
+        self._expcalc = ExposureCalc(self._irfm,self._ltc,chunk_size=1000)
+        self._egy = np.linspace(1.5,5.0,8)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def exposure(self,ra,dec):
+        """Direct evaluation of the exposure at one direction."""
+
+        lthist = self._ltc.get_src_lthist(ra,dec)
+        cth = self._ltc.cth_axis.center
+        exp = np.zeros(len(self._egy))
+        for i, egy in enumerate(self._egy):
+            aeff = self._irfm.aeff(egy*np.ones(len(cth)),cth)
+            exp[i] = np.sum(aeff*lthist.counts)
+        return exp
+
+    def test_exposure(self):
+
+        rs = np.random.RandomState(2)
+        ra = rs.uniform(0.,360.,20)
+        dec = np.degrees(np.arcsin(rs.uniform(-1.,1.,20)))
+
+        exp = self._expcalc.exposure(ra,dec,self._egy)
+        self.assertEqual(exp.shape,(8,20))
+
+        for i in range(len(ra)):
+            assert_allclose(exp[:,i],self.exposure(ra[i],dec[i]),rtol=1E-10)
+
+        egy_edges = np.linspace(1.25,5.25,9)
+        exp = self._expcalc.eval(ra[0],dec[0],egy_edges)
+        self.assertEqual(exp.shape,(8,))
+        assert_allclose(exp,self.exposure(ra[0],dec[0]),rtol=1E-10)
+
+        exp = self._expcalc.eval(ra,dec,egy_edges)
+        self.assertEqual(exp.shape,(20,8))
+        assert_allclose(exp[5],self.exposure(ra[5],dec[5]),rtol=1E-10)
+
+    def test_healpix_exposure(self):
+
+        exp = self._expcalc.healpix_exposure(self._egy)
+        self.assertEqual(exp.shape,(8,healpy.nside2npix(16)))
+
+        for coordsys in ['cel','gal']:
+
+            exp = self._expcalc.healpix_exposure(self._egy,nside=64,
+                                                 coordsys=coordsys)
+            self.assertEqual(exp.shape,(8,healpy.nside2npix(64)))
+
+            pix = np.arange(0,healpy.nside2npix(64),997)
+            theta, phi = healpy.pix2ang(64,pix,nest=True)
+            lon, lat = np.degrees(phi), 90.-np.degrees(theta)
+            if coordsys == 'gal': lon, lat = gal2eq(lon,lat)
+
+            assert_allclose(exp[:,pix],
+                            self._expcalc.exposure(lon,lat,self._egy),
+                            rtol=1E-10)
+
+        # Round trip through a FITS file
+        fname = os.path.join(self._dir,'exp_hpx.fits')
+        write_healpix_cube(fname,exp,self._egy,coordsys='gal')
+        hdulist = pyfits.open(fname)
+        self.assertEqual(hdulist['SKYMAP'].header['NSIDE'],64)
+        self.assertEqual(hdulist['SKYMAP'].header['ORDERING'],'NESTED')
+        assert_allclose(hdulist['SKYMAP'].data.field('ENERGY3'),exp[2]*1E4,
+                        rtol=1E-6)
+        assert_allclose(hdulist['ENERGIES'].data.field('Energy'),
+                        10**self._egy)
+
+    def test_ring_ltcube(self):
+
+        ltfile = os.path.join(self._dir,'ltcube_ring.fits')
+        write_ltcube(ltfile,nest=False)
+        ltc = LTCube(ltfile)
+        self.assertFalse(ltc.nest)
+
+        expcalc = ExposureCalc(self._irfm,ltc,chunk_size=1000)
+
+        # Output is in NESTED ordering for any input ordering
+        for nside in [16,32]:
+            assert_allclose(expcalc.healpix_exposure(self._egy,nside),
+                            self._expcalc.healpix_exposure(self._egy,nside),
+                            rtol=1E-10)
+
+        ra = np.array([10.,120.,250.])
+        dec = np.array([-45.,0.,80.])
+        assert_allclose(expcalc.exposure(ra,dec,self._egy),
+                        self._expcalc.exposure(ra,dec,self._egy),rtol=1E-10)
+
+    def test_wcs_exposure(self):
+
+        wcs = pywcs.WCS(naxis=2)
+        wcs.wcs.crpix = [90.5,45.5]
+        wcs.wcs.cdelt = [-2.0,2.0]
+        wcs.wcs.crval = [0.0,0.0]
+        wcs.wcs.ctype = ['GLON-AIT','GLAT-AIT']
+
+        exp = self._expcalc.wcs_exposure(self._egy,wcs,(180,90))
+        self.assertEqual(exp.shape,(8,90,180))
+
+        ix, iy = np.meshgrid(np.arange(180),np.arange(90))
+        lon, lat = wcs.wcs_pix2world(np.ravel(ix),np.ravel(iy),0)
+        msk = np.isfinite(lon) & np.isfinite(lat)
+        ra, dec = gal2eq(lon[msk],lat[msk])
+
+        # Pixels outside of the projection have no exposure
+        self.assertTrue(np.any(~msk))
+        self.assertTrue(np.all(exp.reshape((8,-1))[:,~msk] == 0))
+        assert_allclose(exp.reshape((8,-1))[:,msk],
+                        self._expcalc.exposure(ra,dec,self._egy),rtol=1E-10)
+
+        fname = os.path.join(self._dir,'exp_wcs.fits')
+        write_wcs_cube(fname,exp,self._egy,wcs)
+        hdulist = pyfits.open(fname)
+        assert_allclose(hdulist[0].data,exp*1E4,rtol=1E-6)
+        self.assertEqual(hdulist[0].header['CTYPE1'],'GLON-AIT')
+
+        # Energy of each plane from the header
+        header = hdulist[0].header
+        self.assertEqual(header['CTYPE3'],'log_Energy')
+        egy = header['CRVAL3'] + \
+            (np.arange(8)+1-header['CRPIX3'])*header['CDELT3']
+        assert_allclose(egy,self._egy)
+        assert_allclose(hdulist['ENERGIES'].data.field('Energy'),
+                        10**self._egy)
+
+        # Planes that are not equally spaced in log energy
+        egy = np.array([2.0,2.5,3.5])
+        write_wcs_cube(fname,exp[:3],egy,wcs)
+        hdulist = pyfits.open(fname)
+        self.assertFalse('CTYPE3' in hdulist[0].header)
+        self.assertFalse('CDELT3' in hdulist[0].header)
+        assert_allclose(hdulist['ENERGIES'].data.field('Energy'),10**egy)
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from gammatools.core.astropy_helper import pyfits
+from gammatools.core.util import separation_angle
+from gammatools.fermi.data import PhotonData
+from gammatools.fermi.ft1_loader import *
+
+def write_ft1(fname,nevent,seed):
+
+    rs = np.random.RandomState(seed)
+    cols = [pyfits.Column(name='RA',format='E',
+                          array=rs.uniform(0.,360.,nevent)),
+            pyfits.Column(name='DEC',format='E',
+                          array=np.degrees(np.arcsin(rs.uniform(-1,1,nevent)))),
+            pyfits.Column(name='ENERGY',format='E',
+                          array=10**rs.uniform(2.,5.,nevent)),
+            pyfits.Column(name='TIME',format='D',
+                          array=np.sort(rs.uniform(0.,1000.,nevent))),
+            pyfits.Column(name='ZENITH_ANGLE',format='E',
+                          array=rs.uniform(0.,180.,nevent)),
+            pyfits.Column(name='EVENT_CLASS',format='J',
+                          array=rs.randint(0,32,nevent)),
+            pyfits.Column(name='CONVERSION_TYPE',format='I',
+                          array=rs.randint(0,2,nevent)),
+            pyfits.Column(name='PtRaz',format='E',
+                          array=rs.uniform(0.,360.,nevent)),
+            pyfits.Column(name='PtDecz',format='E',
+                          array=rs.uniform(-60.,60.,nevent))]
+
+    hdu = pyfits.BinTableHDU.from_columns(cols)
+    hdu.name = 'EVENTS'
+    pyfits.HDUList([pyfits.PrimaryHDU(),hdu]).writeto(fname)
+
+def write_ft2(fname):
+
+    time = np.linspace(0.,1000.,101)
+    cols = [pyfits.Column(name='START',format='D',array=time),
+            pyfits.Column(name='STOP',format='D',array=time+10.),
+            pyfits.Column(name='RA_SCZ',format='D',array=time*0.3),
+            pyfits.Column(name='DEC_SCZ',format='D',
+                          array=30.*np.sin(time/100.))]
+
+    hdu = pyfits.BinTableHDU.from_columns(cols)
+    hdu.name = 'SC_DATA'
+    pyfits.HDUList([pyfits.PrimaryHDU(),hdu]).writeto(fname)
+
+class TestFT1Loader(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._srcs = [{'RAJ2000' : 83.6, 'DEJ2000' : 22.0},
+                      {'RAJ2000' : 85.0, 'DEJ2000' : 20.0},
+                      {'RAJ2000' : 300.0, 'DEJ2000' : -70.0}]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_match_sources(self):
+
+        rs = np.random.RandomState(1)
+        ra = rs.uniform(0.,360.,2000)
+        dec = np.degrees(np.arcsin(rs.uniform(-1,1,2000)))
+        src_ra = np.array([s['RAJ2000'] for s in self._srcs])
+        src_dec = np.array([s['DEJ2000'] for s in self._srcs])
+
+        ievt, isrc, dth = match_sources(ra,dec,src_ra,src_dec,25.0)
+
+        for i in range(len(self._srcs)):
+
+            sep = separation_angle(np.radians(src_ra[i]),
+                                   np.radians(src_dec[i]),
+                                   np.radians(ra),np.radians(dec))
+            idx = np.where(sep < np.radians(25.0))[0]
+
+            assert_allclose(ievt[isrc==i],idx)
+            assert_allclose(dth[isrc==i],sep[idx],atol=1E-8)
+
+    def test_load(self):
+
+        ft1files = [os.path.join(self._dir,'ft1_%i.fits'%i) for i in range(3)]
+        for i, f in enumerate(ft1files): write_ft1(f,3000,i)
+        ft2file = os.path.join(self._dir,'ft2.fits')
+        write_ft2(ft2file)
+
+        loader = FT1Loader(self._srcs,max_dist_deg=10.0,zenith_cut=100.,
+                           event_class_id=2,erange=[2.5,4.5],
+                           ft2file=ft2file)
+
+        pd = loader.load(ft1files)
+
+        # Check against a direct evaluation for each source
+        nevent = 0
+        for i, s in enumerate(self._srcs):
+
+            msk = pd['src_index'] == i
+            nevent += np.sum(msk)
+            sep = separation_angle(np.radians(s['RAJ2000']),
+                                   np.radians(s['DEJ2000']),
+                                   np.radians(pd['ra'][msk]),
+                                   np.radians(pd['dec'][msk]))
+            assert_allclose(pd['dtheta'][msk],sep,atol=1E-8)
+            assert_allclose(np.sqrt(pd['delta_ra'][msk]**2+
+                                    pd['delta_dec'][msk]**2),
+                            np.degrees(sep),atol=1E-6)
+            assert_allclose(np.sqrt(pd['delta_phi'][msk]**2+
+                                    pd['delta_theta'][msk]**2),
+                            np.degrees(sep),atol=1E-6)
+
+            t = pd['time'][msk]
+            zra = np.interp(t,np.linspace(0.,1000.,101),
+                            np.linspace(0.,300.,101))
+            zdec = 30.*np.sin(t/100.)
+            cth = np.cos(separation_angle(np.radians(s['RAJ2000']),
+                                          np.radians(s['DEJ2000']),
+                                          np.radians(zra),np.radians(zdec)))
+            assert_allclose(pd['cth'][msk],cth,atol=2E-3)
+
+        self.assertEqual(nevent,pd.nrow())
+        self.assertTrue(nevent > 0)
+        self.assertTrue(np.all(pd['event_class']&(1<<2)))
+        self.assertTrue(np.all((pd['energy']>=2.5)&(pd['energy']<=4.5)))
+
+        # Write to a column store with a pool of workers
+        output = os.path.join(self._dir,'photons')
+        loader.load(ft1files,output,workers=2)
+        pd2 = PhotonData.load(output)
+
+        self.assertEqual(pd2.nrow(),pd.nrow())
+        for k in pd.columns():
+            assert_allclose(pd2[k],pd[k])
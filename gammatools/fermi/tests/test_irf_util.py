@@ -0,0 +1,393 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from gammatools.core.astropy_helper import pyfits
+from gammatools.fermi.irf_util import *
+
+def write_psf(fname):
+    """Write a PSF table with smoothly varying parameters."""
+
+    elo = np.logspace(1.0,5.5,19)[:-1]
+    ehi = np.logspace(1.0,5.5,19)[1:]
+    cthlo = np.linspace(0.2,1.0,9)[:-1]
+    cthhi = np.linspace(0.2,1.0,9)[1:]
+
+    le, ct = np.meshgrid(np.log10(np.sqrt(elo*ehi)),0.5*(cthlo+cthhi))
+
+    pars = { 'NCORE' : 0.1 + 0.05*le, 'NTAIL' : 0.02 + 0.01*ct,
+             'SCORE' : 0.4 + 0.05*le - 0.1*ct, 'STAIL' : 1.0 + 0.1*le,
+             'GCORE' : 2.0 + 0.3*ct, 'GTAIL' : 1.8 + 0.1*le }
+
+    cols = []
+    for k, v in [('ENERG_LO',elo),('ENERG_HI',ehi),
+                 ('CTHETA_LO',cthlo),('CTHETA_HI',cthhi)]:
+        cols.append(pyfits.Column(name=k,format='%iE'%len(v),
+                                  array=v[np.newaxis]))
+
+    for k in ['NCORE','NTAIL','SCORE','STAIL','GCORE','GTAIL']:
+        v = np.ravel(pars[k])
+        cols.append(pyfits.Column(name=k,format='%iE'%len(v),
+                                  array=v[np.newaxis]))
+
+    hdu_psf = pyfits.BinTableHDU.from_columns(cols)
+    hdu_psf.name = 'RPSF'
+
+    scale = np.array([[0.0058,0.000377,0.0096,0.0013,-0.8]])
+    hdu_scale = pyfits.BinTableHDU.from_columns([
+            pyfits.Column(name='PSFSCALE',format='5E',array=scale)])
+    hdu_scale.name = 'PSF_SCALING_PARAMS'
+
+    pyfits.HDUList([pyfits.PrimaryHDU(),hdu_psf,hdu_scale]).writeto(fname)
+
+def write_aeff(fname):
+    """Write an effective area table."""
+
+    elo = np.logspace(1.0,5.5,19)[:-1]
+    ehi = np.logspace(1.0,5.5,19)[1:]
+    cthlo = np.linspace(0.2,1.0,9)[:-1]
+    cthhi = np.linspace(0.2,1.0,9)[1:]
+
+    le, ct = np.meshgrid(np.log10(np.sqrt(elo*ehi)),0.5*(cthlo+cthhi))
+    aeff = 0.9*(1-np.exp(-(le-1.0)))*ct
+
+    cols = []
+    for k, v in [('ENERG_LO',elo),('ENERG_HI',ehi),
+                 ('CTHETA_LO',cthlo),('CTHETA_HI',cthhi),
+                 ('EFFAREA',np.ravel(aeff))]:
+        cols.append(pyfits.Column(name=k,format='%iE'%len(v),
+                                  array=v[np.newaxis]))
+
+    hdu = pyfits.BinTableHDU.from_columns(cols)
+    hdu.name = 'EFFECTIVE AREA'
+    pyfits.HDUList([pyfits.PrimaryHDU(),hdu]).writeto(fname)
+
+def write_edisp(fname):
+    """Write the axes of an energy dispersion table."""
+
+    elo = np.logspace(1.0,5.5,19)[:-1]
+    ehi = np.logspace(1.0,5.5,19)[1:]
+    cthlo = np.linspace(0.2,1.0,9)[:-1]
+    cthhi = np.linspace(0.2,1.0,9)[1:]
+
+    cols = []
+    for k, v in [('ENERG_LO',elo),('ENERG_HI',ehi),
+                 ('CTHETA_LO',cthlo),('CTHETA_HI',cthhi)]:
+        cols.append(pyfits.Column(name=k,format='%iE'%len(v),
+                                  array=v[np.newaxis]))
+
+    hdu = pyfits.BinTableHDU.from_columns(cols)
+    hdu.name = 'ENERGY DISPERSION'
+    pyfits.HDUList([pyfits.PrimaryHDU(),hdu]).writeto(fname)
+
+def king(dtheta,sig,g):
+    n = 1./(2*np.pi*sig*sig)
+    u = np.power(dtheta,2)/(2*sig*sig)
+    return n*(1-1/g)*np.power(1+u/g,-g)
+
+class TestPSFIRF(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._file = os.path.join(self._dir,'psf_test_front.fits')
+        write_psf(self._file)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_psf_table(self):
+
+        psf = PSFIRF(self._file)
+        th = 10**psf._theta_axis.center
+
+        for i, cth in enumerate(psf._cth_axis.center[::3]):
+            for j, egy in enumerate(psf._energy_axis.center[::5]):
+
+                spx = np.degrees(psf.psf_scale(egy))
+                x = th/spx
+                ip, jp = i*3, j*5
+                score = psf._score_hist.counts[ip,jp]
+                stail = psf._stail_hist.counts[ip,jp]
+                gcore = psf._gcore_hist.counts[ip,jp]
+                gtail = psf._gtail_hist.counts[ip,jp]
+                fcore = psf._fcore_hist.counts[ip,jp]
+
+                v = (fcore*king(x,score,gcore) +
+                     (1-fcore)*king(x,stail,gtail))/spx**2
+
+                assert_allclose(psf._psf_hist.counts[ip,jp],v,rtol=1E-10)
+
+    def test_eval_batch(self):
+
+        psf = PSFIRF(self._file)
+
+        dtheta = np.logspace(-2.,1.,50)
+        egy = np.linspace(1.5,5.0,7)
+        cth = np.linspace(0.3,0.95,4)
+
+        for density in [True,False]:
+
+            psf._interpolate_density = density
+
+            v = psf.eval_batch(dtheta[:,np.newaxis,np.newaxis],
+                               egy[np.newaxis,:,np.newaxis],
+                               cth[np.newaxis,np.newaxis,:])
+
+            self.assertEqual(v.shape,(50,7,4))
+
+            for j in range(len(egy)):
+                for k in range(len(cth)):
+                    assert_allclose(v[:,j,k],psf(dtheta,egy[j],cth[k]),
+                                    rtol=1E-10)
+
+            # Elementwise evaluation
+            v = psf.eval_batch(dtheta[:7],egy,egy*0.1+0.4)
+            for i in range(7):
+                assert_allclose(v[i],psf(dtheta[i],egy[i],egy[i]*0.1+0.4),
+                                rtol=1E-10)
+
+        # Interpolation of the density agrees with direct evaluation
+        psf._interpolate_density = True
+        v0 = psf.eval_batch(dtheta,3.0,0.7)
+        v1 = psf.eval(dtheta,3.0,0.7)
+        assert_allclose(v0,v1,rtol=0.25)
+
+    def test_quantile(self):
+
+        from gammatools.core.util import percentile
+
+        psf = PSFIRF(self._file)
+        irfm = IRFManager([IRF(psf,None,None)])
+
+        x = np.logspace(-3.0,np.log10(90.0),2000)
+        x = np.concatenate(([0],x))
+        xc = 0.5*(x[:-1]+x[1:])
+        deltax = np.radians(x[1:] - x[:-1])
+
+        egy = np.array([1.7,2.55,3.3,4.85])
+        cth = np.array([0.33,0.5,0.77,0.9])
+
+        for frac in [0.34,0.68,0.95]:
+
+            r = irfm.psf_quantile(egy,cth,frac)
+            self.assertEqual(r.shape,(4,))
+
+            for i in range(len(egy)):
+                y = psf(xc,egy[i],cth[i])
+                cdf = np.cumsum(2*np.pi*np.sin(np.radians(xc))*y*deltax)
+                cdf /= cdf[-1]
+                assert_allclose(r[i],percentile(x[1:],cdf,frac),rtol=0.02)
+                assert_allclose(psf.quantile(egy[i],cth[i],frac),r[i],
+                                rtol=1E-10)
+
+        # Broadcast over fractions
+        r = irfm.psf_quantile(egy[:,np.newaxis],cth[:,np.newaxis],
+                              [0.68,0.95])
+        self.assertEqual(r.shape,(4,2))
+        assert_allclose(r[:,1],irfm.psf_quantile(egy,cth,0.95))
+
+        # Table is persisted next to the FITS file
+        psf.quantile_table(persist=True)
+        qfile = os.path.join(self._dir,'psf_test_front_quantiles.npz')
+        self.assertTrue(os.path.isfile(qfile))
+        table = PSFQuantileTable.load(qfile)
+        assert_allclose(table(egy,cth),psf.quantile(egy,cth))
+
+    def test_quantile_cache(self):
+
+        egy = np.array([1.7,2.55,3.3,4.85])
+        cth = np.array([0.33,0.5,0.77,0.9])
+        cache_file = os.path.join(self._dir,'quantiles.npz')
+
+        irfm = IRFManager([IRF(PSFIRF(self._file),None,None)])
+        r = irfm.psf_quantile(egy,cth)
+
+        # Memoized table is written on a later call with a cache file
+        irfm.psf_quantile_table(cache_file)
+        self.assertTrue(os.path.isfile(cache_file))
+        self.assertEqual(PSFQuantileTable.load_key(cache_file),
+                         irfm.psf_cache_key())
+
+        # Table with a matching key is read from the cache
+        table = PSFQuantileTable.load(cache_file)
+        table = PSFQuantileTable(table._loge,table._cth,table._frac,
+                                 2*table._radius,table.key)
+        table.save(cache_file)
+
+        irfm = IRFManager([IRF(PSFIRF(self._file),None,None)])
+        irfm.psf_quantile_table(cache_file)
+        assert_allclose(irfm.psf_quantile(egy,cth),2*r)
+
+        # Table is rebuilt for a different set of IRFs
+        irfm = IRFManager([IRF(PSFIRF(self._file),None,None),
+                           IRF(PSFIRF(self._file),None,None)])
+        irfm.psf_quantile_table(cache_file)
+        assert_allclose(irfm.psf_quantile(egy,cth),r,rtol=1E-6)
+        self.assertEqual(len(PSFQuantileTable.load_key(cache_file)),2)
+
+        # Table is rebuilt when the PSF file is modified
+        table.save(cache_file)
+        mtime = os.path.getmtime(self._file)
+        os.utime(self._file,(mtime+10,mtime+10))
+
+        irfm = IRFManager([IRF(PSFIRF(self._file),None,None)])
+        irfm.psf_quantile_table(cache_file)
+        assert_allclose(irfm.psf_quantile(egy,cth),r,rtol=1E-6)
+        assert_allclose(PSFQuantileTable.load(cache_file)(egy,cth),r,
+                        rtol=1E-6)
+
+class PyIRFTable(object):
+    """Object with the interface of a Science Tools IRF that is
+    evaluated from a function of log10(energy) and cos(theta)."""
+
+    def __init__(self,fn):
+        self._fn = fn
+
+    def setPhiDependence(self,phi_dependence):
+        pass
+
+    def value(self,*args):
+        args = list(args[:-1])
+        args[-2] = np.log10(args[-2])
+        args[-1] = np.cos(np.radians(args[-1]))
+        return float(self._fn(*args))
+
+class TestCALDB(unittest.TestCase):
+
+    irf_name = 'TEST_V1::FRONT'
+
+    # Regression values of the PSF (deg^-2) and effective area (m^2)
+    # of the synthetic test tables.  These were computed with this
+    # implementation and only guard against changes to it.  Agreement
+    # with the Science Tools is tested by TestPyIRF.
+    dtheta = np.array([0.01,0.1,0.5,1.0,3.0,10.0])
+    egy = np.array([1.0,2.13,3.0,3.77,4.6,5.9])
+    cth = np.array([0.1,0.35,0.52,0.8,0.97,1.0])
+    psf_ref = np.array([0.14185547236710314, 3.5907900473607426,
+                        0.022701676438678188, 0.0001780231455467955,
+                        7.349795966564438e-07, 2.178267818162685e-09])
+    aeff_ref = np.array([0.0017909372111024335, 0.21318688221918733,
+                         0.40416762160184255, 0.6745348132471043,
+                         0.8490745616022982, 0.8954281865188158])
+
+    def setUp(self):
+
+        self._dir = tempfile.mkdtemp()
+        bcf_dir = os.path.join(self._dir,'data','glast','lat','bcf')
+        for d in ['psf','ea','edisp']: os.makedirs(os.path.join(bcf_dir,d))
+
+        write_psf(os.path.join(bcf_dir,'psf','psf_TEST_V1_front.fits'))
+        write_aeff(os.path.join(bcf_dir,'ea','aeff_TEST_V1_front.fits'))
+        write_edisp(os.path.join(bcf_dir,'edisp','edisp_TEST_V1_front.fits'))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_reference(self):
+
+        irfm = IRFManager.createFromCALDB(self.irf_name,self._dir)
+        irf = irfm._irfs[0]
+
+        assert_allclose(irf.psf(self.dtheta,self.egy,self.cth),
+                        self.psf_ref,rtol=1E-6)
+        assert_allclose(irfm.aeff(self.egy,self.cth),self.aeff_ref,
+                        rtol=1E-6)
+
+        # Broadcast evaluation
+        v = irf.psf(self.dtheta[:,np.newaxis],self.egy[np.newaxis,:],
+                    self.cth[np.newaxis,:])
+        self.assertEqual(v.shape,(6,6))
+        assert_allclose(np.diag(v),self.psf_ref,rtol=1E-6)
+
+        v = irfm.aeff(self.egy[:,np.newaxis],self.cth[np.newaxis,:])
+        self.assertEqual(v.shape,(6,6))
+        assert_allclose(np.diag(v),self.aeff_ref,rtol=1E-6)
+
+    def test_pyirf_wrapper(self):
+
+        irf = IRF.createFromCALDB(self.irf_name,self._dir)
+
+        # Science Tools IRFs return the PSF in sr^-1 and the effective
+        # area in cm^2
+        psf = PSFPyIRF(PyIRFTable(lambda *args: irf.psf(*args)*
+                                  (180./np.pi)**2))
+        aeff = AeffPyIRF(PyIRFTable(lambda *args: irf.aeff(*args)*1E4))
+        psf_scale = (np.pi/180.)**2
+
+        assert_allclose(psf(self.dtheta,self.egy,self.cth)*psf_scale,
+                        self.psf_ref,rtol=1E-6)
+        assert_allclose(aeff(self.egy,self.cth),self.aeff_ref,rtol=1E-6)
+
+        # Scalar arguments
+        for i in range(len(self.egy)):
+            assert_allclose(psf(self.dtheta[i],self.egy[i],self.cth[i])*
+                            psf_scale,self.psf_ref[i],rtol=1E-6)
+            assert_allclose(psf(self.dtheta,self.egy[i],self.cth[i])*
+                            psf_scale,
+                            irf.psf(self.dtheta,self.egy[i],self.cth[i]),
+                            rtol=1E-6)
+            assert_allclose(aeff(self.egy[i],self.cth[i]),self.aeff_ref[i],
+                            rtol=1E-6)
+
+        # Broadcast arguments
+        v = psf(self.dtheta[:,np.newaxis],self.egy[np.newaxis,:],
+                self.cth[np.newaxis,:])
+        self.assertEqual(v.shape,(6,6))
+        assert_allclose(np.diag(v)*psf_scale,self.psf_ref,rtol=1E-6)
+
+        v = aeff(self.egy[:,np.newaxis],self.cth[np.newaxis,:])
+        self.assertEqual(v.shape,(6,6))
+        assert_allclose(np.diag(v),self.aeff_ref,rtol=1E-6)
+
+    def test_psf_nodes(self):
+
+        psf = IRF.createFromCALDB(self.irf_name,self._dir)._psf
+        
+        dtheta = np.logspace(-2.,1.,20)
+        for i in [0,3,7]:
+            for j in [0,8,17]:
+
+                cth = psf._cth_axis.center[i]
+                egy = psf._energy_axis.center[j]
+                
+                # Bilinear interpolation is exact at the table nodes
+                assert_allclose(psf.eval3(dtheta,egy,cth),
+                                psf.eval(dtheta,egy,cth),rtol=1E-6)
+
+try:
+    import pyIrfLoader
+except ImportError:
+    has_pyirf = False
+else:
+    has_pyirf = True
+
+@unittest.skipIf(not has_pyirf or not 'CALDB' in os.environ,
+                 'Requires the Science Tools and a CALDB installation.')
+class TestPyIRF(unittest.TestCase):
+    """Compare the IRFs evaluated from CALDB tables with the Science
+    Tools implementation."""
+
+    irf_names = ['P7REP_SOURCE_V15::FRONT','P7REP_SOURCE_V15::BACK']
+
+    def test_pyirf(self):
+
+        dtheta = np.array([0.01,0.1,0.5,1.0,3.0,10.0])
+        egy = np.array([1.75,2.13,3.0,3.77,4.6,5.2])
+        cth = np.array([0.3,0.45,0.62,0.8,0.91,0.99])
+
+        for name in self.irf_names:
+
+            irf0 = IRF.createFromCALDB(name)
+            irf1 = IRF.createFromPyIRF(name)
+
+            for i in range(len(egy)):
+
+                # PyIRF returns the PSF in sr^-1
+                psf0 = irf0.psf(dtheta,egy[i],cth[i])
+                psf1 = irf1.psf(dtheta,egy[i],cth[i])*(np.pi/180.)**2
+                assert_allclose(psf0,psf1,rtol=1E-3)
+
+                assert_allclose(irf0.aeff(egy[i],cth[i]),
+                                irf1.aeff(egy[i],cth[i]),rtol=1E-3)
@@ -3,52 +3,78 @@ import numpy as np
 from gammatools.core.model_fn import GaussFn
 from gammatools.fermi.psf_likelihood import *
 from gammatools.core.histogram import *
+from gammatools.core.tests.grad_util import num_grad
 
 class TestFermiLikelihood(unittest.TestCase):
 
+    def test_king_grad(self):
 
-    def test_convolved_gauss(self):
-
-        return
-
-        pset = ParameterSet()
+        from numpy.testing import assert_almost_equal
         
-        sigma = 0.1
-        ksigma = 0.2
+        x = np.linspace(0.0,1.0,9)
+        kfn = KingFn(Parameter(2,0.2,'sigma'),Parameter(0,2.5,'gamma'),
+                     Parameter(1,3.0,'norm'))
+        pfn = PowerlawFn(Parameter(0,2.0,'norm'),Parameter(1,2.4,'gamma'))
 
-        gpfn = Gauss2DProjFn.create(1.0,sigma,pset=pset)
-        gfn = Gauss2DFn.create(1.0,0.0,0.0,sigma)
-        gfn2 = Gauss2DFn.create(1.0,0.0,0.0,ksigma)
+        for fn in [kfn,pfn]:
 
-        print gpfn.param()
-
-        cgfn = ConvolvedGaussFn.create(1.0,ksigma,gpfn,pset=pset,prefix='test')
-        
+            p = fn.param().array()[:,0]
+            fv = lambda t: fn.eval(x,t)
+            fi = lambda t: fn.integrate(x[:-1],x[1:],t)
 
+            assert_almost_equal(fn.grad(x,p)/fv(p),num_grad(fv,p)/fv(p),5)
+            assert_almost_equal(fn.integrate_grad(x[:-1],x[1:],p)/fi(p),
+                                num_grad(fi,p)/fi(p),5)
 
-        print cgfn.param()
+        assert_almost_equal(kfn.cdf(1E3),3.0,4)
 
-        delta = np.array([0.2,0.1]).reshape((2,1))
+    def test_binned_lnl_grad(self):
 
-        xaxis = Axis.create(-1.0,1.0,1000)
-        yaxis = Axis.create(-1.0,1.0,1000)
-        x, y = np.meshgrid(xaxis.center(),yaxis.center())
-        x = np.ravel(x)
-        y = np.ravel(y)
+        from numpy.testing import assert_almost_equal
 
-        print x.shape
-        xy = np.vstack((x,y))
-        print xy.shape
+        edges = np.linspace(0.0,1.0,11)
+        kfn = KingFn.create(0.2,2.5,100.)
+        non = np.round(kfn.integrate(edges[:-1],edges[1:])*1.2)
+        noff = np.round(np.linspace(20.,5.,10))
+        non[3] = 0
+        noff[4] = 0
 
-        r = np.sqrt(x**2+y**2)
+        for objfn in [BinnedLnL(non,edges,kfn),
+                      OnOffBinnedLnL(non,noff,edges,0.5,kfn)]:
 
-        s = np.sum(gfn.eval(xy+delta)*gfn2(xy))*(2.0/1000.)**2
-
-
-        r0 = np.sqrt(delta[0][0]**2+delta[1][0]**2)
+            p = objfn.param().array()[:,0]
+            g = num_grad(objfn.eval,p)
+            assert_almost_equal(objfn.grad(p)/np.abs(g).max(),
+                                g/np.abs(g).max(),5)
+        
 
-        x = np.array([0.1,0.2])
+    def test_convolved_gauss(self):
 
-        print r0
-        print cgfn.eval(r0)
-        print s
+        from numpy.testing import assert_allclose
+        from gammatools.core.util import convolve2d_gauss
+
+        kfn = KingFn.create(0.1,3.0)
+        x = np.linspace(0.0,1.0,21)
+
+        fn0 = ConvolvedGaussFn.create(2.0,0.2,kfn)
+        fn1 = ConvolvedGaussFn.create(2.0,0.2,kfn,method='hankel')
+
+        vref = 2.0*convolve2d_gauss(lambda t: kfn.eval(t),x,0.2,3.0,
+                                    nstep=4000)
+        assert_allclose(fn1.eval(x),vref,rtol=1E-3)
+        assert_allclose(fn0.eval(x),fn1.eval(x),rtol=1E-2)
+
+        # Evaluation at several parameter values
+        p = np.vstack((fn0.param().array()[:,0],
+                       fn0.param().array()[:,0]))
+        p[1] *= np.linspace(0.8,1.2,p.shape[1])
+        for fn in [fn0,fn1]:
+            v = fn.eval_batch(p,x)
+            self.assertEqual(v.shape,(2,len(x)))
+            for i in range(2):
+                assert_allclose(v[i],fn.eval(x,p[i]),rtol=1E-10)
+
+        # Integral over the plane
+        edges = np.linspace(0.0,3.0,301)
+        assert_allclose(np.sum(fn1.integrate(edges[:-1],edges[1:])),2.0,
+                        rtol=1E-3)
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+import argparse
+import numpy as np
+from numpy.testing import assert_array_equal
+from test_irf_util import write_psf, write_aeff, write_edisp
+from test_data import create_photon_data
+
+try:
+    import pyfits
+    import pywcsgrid2
+    from gammatools.fermi.validate import *
+except ImportError:
+    has_validate = False
+else:
+    has_validate = True
+
+@unittest.skipIf(not has_validate, 'Requires pyfits and pywcsgrid2.')
+class TestPSFValidate(unittest.TestCase):
+
+    def setUp(self):
+
+        self._dir = tempfile.mkdtemp()
+        write_psf(os.path.join(self._dir,'psf_TEST_V1_front.fits'))
+        write_aeff(os.path.join(self._dir,'aeff_TEST_V1_front.fits'))
+        write_edisp(os.path.join(self._dir,'edisp_TEST_V1_front.fits'))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def create_data(self,nsig=4000,nbkg=4000):
+        """Create photons from a point source with a gaussian PSF on
+        top of an isotropic background."""
+
+        rs = np.random.RandomState(2)
+        n = nsig + nbkg
+
+        d = create_photon_data(n)
+        d['energy'] = rs.uniform(3.0,4.0,n)
+        d['cth'] = rs.uniform(0.2,1.0,n)
+        d['conversion_type'] = np.zeros(n,dtype=int)
+        d['dtheta'] = np.concatenate((rs.rayleigh(0.3,nsig),
+                                      3.5*np.sqrt(rs.uniform(0.,1.,nbkg))))
+        return d
+
+    def create(self):
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('files', nargs='+')
+        PSFValidate.add_arguments(parser)
+
+        opts = parser.parse_args([os.path.join(self._dir,'photons.P'),
+                                  '--irf=TEST_V1','--irf_dir=%s'%self._dir,
+                                  '--conversion_type=front','--src=iso',
+                                  '--psf_scaling_fn=front',
+                                  '--egy_bin_edge=3.0,3.5,4.0',
+                                  '--cth_bin_edge=0.2,0.6,1.0',
+                                  '--output_dir=%s'%self._dir])
+
+        psfv = PSFValidate({'spectrum' : 'powerlaw',
+                            'spectrum_pars' : '2.0'},opts)
+        psfv.fill(self.create_data())
+        return psfv
+
+    def assert_bin_equal(self,o0,o1):
+
+        self.assertEqual(sorted(o0.keys()),sorted(o1.keys()))
+
+        for v0, v1 in zip(o0['hists'],o1['hists']):
+            assert_array_equal(v0,v1)
+
+        for k, h0 in o0.get('objects',{}).iteritems():
+            h1 = o1['objects'][k]
+            if h0 is None:
+                self.assertTrue(h1 is None)
+                continue
+
+            assert_array_equal(h0.counts,h1.counts)
+            assert_array_equal(h0.var,h1.var)
+
+    def assert_fit_equal(self,psfv0,psfv1):
+
+        for iegy, icth in psfv0.bins():
+
+            o0 = psfv0.get_bin(iegy,icth)
+            o1 = psfv1.get_bin(iegy,icth)
+
+            self.assert_bin_equal(o0['psf_data'],o1['psf_data'])
+            self.assert_bin_equal(
+                psfv0.psf_data.get_bin(iegy,icth),
+                psfv1.psf_data.get_bin(iegy,icth))
+
+            self.assertEqual(sorted(o0['irf_data'].keys()),
+                             sorted(o1['irf_data'].keys()))
+            for ml, v in o0['irf_data'].iteritems():
+                self.assert_bin_equal(v,o1['irf_data'][ml])
+
+    def test_get_set_bin(self):
+
+        psfv0 = self.create()
+        psfv0.fit(workers=1)
+
+        psf_data = PSFData(psfv0.egy_bin_edge,psfv0.cth_bin_edge,'data')
+        psfv1 = self.create()
+
+        for iegy, icth in psfv0.bins():
+
+            o = psfv0.psf_data.get_bin(iegy,icth)
+            psf_data.set_bin(iegy,icth,o)
+            self.assert_bin_equal(psf_data.get_bin(iegy,icth),o)
+
+            psfv1.set_bin(iegy,icth,psfv0.get_bin(iegy,icth))
+
+        self.assert_fit_equal(psfv0,psfv1)
+
+    def test_fit_workers(self):
+
+        psfv0 = self.create()
+        np.random.seed(1)
+        psfv0.fit(workers=1)
+
+        psfv1 = self.create()
+        np.random.seed(1)
+        psfv1.fit(workers=2)
+
+        self.assertEqual(psfv0.fit_errors,{})
+        self.assertEqual(psfv1.fit_errors,{})
+
+        # Quantiles are computed in every bin
+        for q in psfv0.psf_data.qdata:
+            self.assertTrue(np.all(q.counts > 0))
+            self.assertTrue(np.all(q.var > 0))
+
+        self.assert_fit_equal(psfv0,psfv1)
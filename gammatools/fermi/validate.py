@@ -9,6 +9,9 @@ import copy
 import re
 import pickle
 import argparse
+import itertools
+import logging
+import traceback
 
 import math
 import numpy as np
@@ -34,6 +37,8 @@ from gammatools.core.mpl_util import SqrtScale, PowerNormalize
 from matplotlib import scale as mscale
 mscale.register_scale(SqrtScale)
 
+logger = logging.getLogger(__name__)
+
 
     
 
@@ -113,6 +118,40 @@ class PSFData(Data):
         for i in range(len(self.quantiles)):
             self.qdata.append(Histogram2D(egy_bin_edge,cth_bin_edge))
 
+    _bin_objects = ['sig_density_hist','tot_density_hist',
+                    'bkg_density_hist','sig_hist','off_hist','tot_hist',
+                    'bkg_hist','sky_image','sky_image_off',
+                    'lat_image','lat_image_off']
+
+    def _bin_hists(self):
+        return [self.chi2,self.rchi2,self.ndf,self.excess,
+                self.bkg,self.bkg_density] + self.qdata
+
+    def get_bin(self,iegy,icth,objects=True):
+        """Return a dictionary with the contents of a single
+        energy/cos-theta bin.  If objects is False only the summary
+        quantities (excess, quantiles, etc.) are returned and the
+        per-bin histograms and images are omitted."""
+
+        o = {'hists' : [(h._counts[iegy,icth],h._var[iegy,icth])
+                        for h in self._bin_hists()] }
+
+        if objects:
+            o['objects'] = dict((k,getattr(self,k)[iegy,icth])
+                                for k in self._bin_objects)
+        return o
+
+    def set_bin(self,iegy,icth,o):
+        """Update a single energy/cos-theta bin from a dictionary
+        returned by get_bin."""
+        
+        for h, v in zip(self._bin_hists(),o['hists']):
+            h._counts[iegy,icth] = v[0]
+            h._var[iegy,icth] = v[1]
+
+        for k, v in o.get('objects',{}).iteritems():
+            getattr(self,k)[iegy,icth] = v
+        
     def init_hist(self,fn,theta_max):
 
         for i in range(self.egy_nbin):
@@ -174,6 +213,13 @@ class PSFData(Data):
 
 
 
+def _fit_bin_init(psfv):
+    global _fit_bin_psfv
+    _fit_bin_psfv = psfv
+
+def _fit_bin_worker(args):
+    return _fit_bin_psfv.fit_bin(*args)
+
 class PSFValidate(Configurable):
 
     default_config = { 'egy_bin' : '2.0/4.0/0.25',
@@ -195,7 +241,13 @@ class PSFValidate(Configurable):
                        'theta_max'      : 30.0,
                        'psf_scaling_fn' : None,
                        'irf'            : None,
-                       'src'            : 'iso' }
+                       'src'            : 'iso',
+                       'workers'        : None }
+
+    # Photon data columns used by the analysis
+    data_columns = ['energy','cth','conversion_type','event_class',
+                    'event_type','src_index','phase','psfcore','dtheta',
+                    'delta_ra','delta_dec','delta_phi','delta_theta']
     
     def __init__(self, config, opts,**kwargs):
         """
@@ -390,6 +442,11 @@ class PSFValidate(Configurable):
         parser.add_argument('--mask_srcs', default=None,
                             help='Define a list of sources to exclude.')
 
+        parser.add_argument('--workers', default=None, type=int,
+                            help='Number of worker processes used to fit '
+                            'the energy/cos-theta bins.  Defaults to the '
+                            'number of CPUs.')
+
     def build_models(self):
 
         self.psf_models = {}
@@ -423,7 +480,7 @@ class PSFValidate(Configurable):
 
         for f in opts.files:
             print 'Loading ', f
-            d = load_object(f)
+            d = PhotonData.load(f,columns=self.data_columns)
             d.mask(event_class_id=self.config['event_class_id'],
                    event_type_id=self.config['event_type_id'],
                    conversion_type=self.config['conversion_type'])
@@ -445,7 +502,7 @@ class PSFValidate(Configurable):
 
         for f in self.opts.files:
             print 'Loading ', f
-            d = load_object(f)
+            d = PhotonData.load(f,columns=self.data_columns)
 
 
             print self.config['event_class_id']
@@ -457,16 +514,8 @@ class PSFValidate(Configurable):
 
             self.fill(d)
             
-        for iegy in range(self.psf_data.egy_axis.nbins):
-            for icth in range(self.psf_data.cth_axis.nbins):
-                self.fill_models(iegy,icth)
-
-        for iegy in range(self.psf_data.egy_axis.nbins):
-            for icth in range(self.psf_data.cth_axis.nbins):
-                if self.data_type == 'pulsar':
-                    self.fit_pulsar(iegy, icth)
-                else:
-                    self.fit_agn(iegy, icth)
+        self.fit(workers=self.config['workers'])
+        self.plot()
 
         fname = os.path.join(self.output_dir,
                              self.output_prefix + 'psfdata')
@@ -482,8 +531,136 @@ class PSFValidate(Configurable):
             fname = self.output_prefix + 'psfdata_' + ml
             self.irf_data[ml].save(fname + '.P')
 
+    def bins(self):
+        """Return a list of the (energy, cos-theta) bin indices."""
+        return [(iegy,icth) 
+                for iegy in range(self.psf_data.egy_axis.nbins)
+                for icth in range(self.psf_data.cth_axis.nbins)]
+
+    def fit(self,workers=None):
+        """Fill the model distributions and compute the data
+        quantiles in every energy/cos-theta bin.  Bins are
+        independent once the data histograms are filled and are
+        distributed over a pool of worker processes.  The results of
+        each bin are collected in bin order.  If workers is 1 the
+        bins are processed serially in this process.  The seed of
+        the bootstrap of each bin is drawn from the global RNG so
+        that the result does not depend on the number of workers.
+
+        Bins in which the quantile computation fails are logged and
+        recorded in the fit_errors dictionary with the traceback of
+        the error.
+
+        @param workers: Number of worker processes.  Defaults to the
+        number of CPUs.
+        """
+
+        import multiprocessing
+
+        if workers is None: workers = multiprocessing.cpu_count()
+
+        bins = self.bins()
+        seeds = np.random.randint(2**31-1,size=len(bins))
+        args = [b + (int(s),) for b, s in zip(bins,seeds)]
+
+        self.fit_errors = {}
+        
+        if workers <= 1 or len(bins) <= 1:
+            pool = None
+            results = itertools.imap(lambda a: self.fit_bin(*a),args)
+        else:
+            pool = multiprocessing.Pool(min(workers,len(bins)),
+                                        initializer=_fit_bin_init,
+                                        initargs=(self,))
+            results = pool.imap(_fit_bin_worker,args)
+
+        try:
+            for b, o in itertools.izip(bins,results):
+                if pool is not None: self.set_bin(b[0],b[1],o)
+                if o['error'] is None: continue
+                
+                self.fit_errors[b] = o['error']
+                logger.error('Quantile computation failed in bin %i %i:\n%s',
+                             b[0],b[1],o['error'])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def fit_bin(self, iegy, icth, seed=None):
+        """Fill the model distributions and compute the data
+        quantiles for a single energy/cos-theta bin.  Returns the
+        updated contents of the bin (see get_bin) and the traceback
+        of the error raised by the quantile computation (or None) in
+        the 'error' field."""
+        
+        self.fill_models(iegy, icth)
+
+        psf_data = self.psf_data
+        ecenter = psf_data.egy_axis.center[iegy]
+        theta_max = min(self.config['theta_max'], self.thetamax_fn(ecenter))
+        excess_sum = psf_data.excess._counts[iegy, icth]
+
+        error = None
+        if excess_sum > 25:
+            logger.info('Computing quantiles in bin %i %i', iegy, icth)
+            try:
+                self.compute_quantiles(self.create_quantile_fn(iegy, icth),
+                                       psf_data, iegy, icth, theta_max,
+                                       seed=seed)
+            except Exception:
+                error = traceback.format_exc()
+
+        o = self.get_bin(iegy, icth)
+        o['error'] = error
+        return o
+
+    def get_bin(self, iegy, icth):
+        """Return the fit results of a single energy/cos-theta
+        bin."""
+        
+        o = { 'psf_data' : self.psf_data.get_bin(iegy,icth,False),
+              'irf_data' : {} }
+        for ml, d in self.irf_data.iteritems():
+            o['irf_data'][ml] = d.get_bin(iegy,icth)
+        return o
+
+    def set_bin(self, iegy, icth, o):
+        """Update the fit results of a single energy/cos-theta bin
+        from the output of get_bin."""
+        
+        self.psf_data.set_bin(iegy,icth,o['psf_data'])
+        for ml, v in o['irf_data'].iteritems():
+            self.irf_data[ml].set_bin(iegy,icth,v)
+
+    def create_quantile_fn(self, iegy, icth):
+        """Create the quantile estimator for the data in a single
+        energy/cos-theta bin."""
+        
+        psf_data = self.psf_data
+
+        if self.data_type == 'pulsar':
+            return HistQuantileOnOff(psf_data.tot_hist[iegy, icth], 
+                                     psf_data.off_hist[iegy, icth],
+                                     self.alpha)
+        
+        bkg_density = psf_data.bkg_density._counts[iegy,icth]
+        bkg_counts = psf_data.bkg._counts[iegy,icth]
+        bkg_domega = bkg_counts/bkg_density
+
+        return HistQuantileBkgFn(psf_data.tot_hist[iegy, icth], 
+                                 lambda x: x**2 * np.pi / bkg_domega,
+                                 bkg_counts)
+        
     def plot(self):
-        return
+        """Generate the plots for every energy/cos-theta bin.  This
+        should be called after fit."""
+
+        for iegy, icth in self.bins():
+            if self.data_type == 'pulsar':
+                self.plot_pulsar(iegy, icth)
+            else:
+                self.plot_agn(iegy, icth)
 
     def get_counts(self, data, theta_edges, mask):
 
@@ -741,7 +918,7 @@ class PSFValidate(Configurable):
 
 
 
-    def fit_agn(self, iegy, icth):
+    def plot_agn(self, iegy, icth):
 
         models = self.psf_models
         irf_data = self.irf_data
@@ -762,20 +939,8 @@ class PSFValidate(Configurable):
         excess_sum = psf_data.excess._counts[iegy, icth]
 
         bkg_density = psf_data.bkg_density._counts[iegy,icth]
-        bkg_counts = psf_data.bkg._counts[iegy,icth]
-        bkg_domega = bkg_counts/bkg_density
 
-        print 'Computing Quantiles'
-        bkg_fn = lambda x: x**2 * np.pi * bkg_density
-        hq = HistQuantileBkgFn(on_hist, 
-                               lambda x: x**2 * np.pi / bkg_domega,
-                               bkg_counts)
-        
-        if excess_sum > 25:
-            try:
-                self.compute_quantiles(hq, psf_data, iegy, icth, theta_max)
-            except Exception, e:
-                print e
+        hq = self.create_quantile_fn(iegy, icth)
                 
         hmodel_density = []
         hmodel_counts = []
@@ -1021,7 +1186,7 @@ class PSFValidate(Configurable):
         for i, ml in enumerate(self.model_labels):
             m = models[ml]
 
-            print 'Fitting model ', ml
+            logger.info('Fitting model %s in bin %i %i', ml, iegy, icth)
             hmodel_sig = m.histogram(emin, emax,cth_range[0],cth_range[1],
                                      on_hist.axis().edges).normalize()
             model_norm = excess_sum
@@ -1044,7 +1209,7 @@ class PSFValidate(Configurable):
                 ql = psf_data.quantile_labels[j]
                 qm = m.quantile(emin, emax, cth_range[0],cth_range[1], q)
                 self.irf_data[ml].qdata[j].set(iegy, icth, qm)
-                print ml, ql, qm
+                logger.debug('%s %s %s', ml, ql, qm)
 
 #            ndf = hexcess.nbins
 
@@ -1057,7 +1222,7 @@ class PSFValidate(Configurable):
 #                                                   ndf,
 #                                                   qmodel[ml].rchi2[iegy,icth])
 
-    def fit_pulsar(self, iegy, icth):
+    def plot_pulsar(self, iegy, icth):
         
         models = self.psf_models
         irf_data = self.irf_data
@@ -1084,17 +1249,7 @@ class PSFValidate(Configurable):
         text += 'Signal = %.3f\n' % (psf_data.excess._counts[iegy, icth])
         text += 'Background = %.3f' % (bkg_hist.sum()[0])
 
-        print 'Computing Quantiles'
-        hq = HistQuantileOnOff(on_hist, off_hist, self.alpha)
-
-
-        
-        if excess_sum > 25:
-
-            try:
-                self.compute_quantiles(hq, psf_data, iegy, icth, theta_max)
-            except Exception, e:
-                print e
+        hq = self.create_quantile_fn(iegy, icth)
                 
         hmodel_density = []
         hmodel_counts = []
@@ -1346,20 +1501,23 @@ class PSFValidate(Configurable):
         fig.plot()
         
     def compute_quantiles(self, hq, qdata, iegy, icth,
-                          theta_max=None):
+                          theta_max=None, seed=None):
 
         emin = 10 ** qdata.egy_axis.edges[iegy]
         emax = 10 ** qdata.egy_axis.edges[iegy+1]
 
+        qdist_mean, qdist_err = hq.bootstrap(np.array(qdata.quantiles),
+                                             niter=200, xmax=theta_max,
+                                             seed=seed)
+
         for i, q in enumerate(qdata.quantiles):
             
             ql = qdata.quantile_labels[i]
             qmean = hq.quantile(fraction=q)
-            qdist_mean, qdist_err = hq.bootstrap(q, niter=200, xmax=theta_max)
-            qdata.qdata[i].set(iegy, icth, qmean, qdist_err ** 2)
+            qdata.qdata[i].set(iegy, icth, qmean, qdist_err[i] ** 2)
 
-            print ql, ' %10.4f +/- %10.4f %10.4f' % (qmean, qdist_err, 
-                                                     qdist_mean)
+            logger.info('%s %10.4f +/- %10.4f %10.4f', ql, qmean,
+                        qdist_err[i], qdist_mean[i])
 
 if __name__ == '__main__':
     usage = "%(prog)s [options] [pickle file ...]"
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import time
+import argparse
+import numpy as np
+from gammatools.core.util import convolve2d_king, KingKernelCache
+
+usage = "%(prog)s [options]"
+description = """Benchmark the wall time per call of convolve2d_king
+with and without the kernel cache.  The convolved function is a
+gaussian halo with a width that changes on every call as in a
+parameter scan."""
+parser = argparse.ArgumentParser(usage=usage, description=description)
+
+parser.add_argument('--nr', default = 200, type=int,
+                    help = 'Number of evaluation radii.')
+
+parser.add_argument('--nstep', default = 200, type=int,
+                    help = 'Number of integration steps.')
+
+parser.add_argument('--ncall', default = 20, type=int,
+                    help = 'Number of calls per benchmark.')
+
+parser.add_argument('--sig', default = 0.2, type=float,
+                    help = 'Width parameter of the King function.')
+
+parser.add_argument('--gam', default = 3.0, type=float,
+                    help = 'Gamma parameter of the King function.')
+
+parser.add_argument('--rmax', default = 3.0, type=float,
+                    help = 'Upper integration radius.')
+
+args = parser.parse_args()
+
+r = np.linspace(0,2.0,args.nr)
+halo_sigma = np.linspace(0.1,0.5,args.ncall)
+
+def halo_fn(sigma):
+    return lambda t: np.exp(-t**2/(2*sigma**2))/(2*np.pi*sigma**2)
+
+def run(cache,clear=False):
+
+    t0 = time.time()
+    for s in halo_sigma:
+        if clear: cache.clear()
+        v = convolve2d_king(halo_fn(s),r,args.sig,args.gam,args.rmax,
+                            nstep=args.nstep,cache=cache)
+    return (time.time()-t0)/float(args.ncall), v
+
+cache = KingKernelCache()
+
+t0 = time.time()
+cache.log_hyp2f1(args.gam,1.0)
+t_init = time.time()-t0
+
+t_direct, v_direct = run(None)
+t_table, v_table = run(cache,clear=True)
+t_cache, v_cache = run(cache)
+
+print 'nr = %i nstep = %i ncall = %i'%(args.nr,args.nstep,args.ncall)
+print '%-32s %10.3f ms'%('Table initialization:',t_init*1E3)
+print '%-32s %10.3f ms/call'%('Direct hyp2f1:',t_direct*1E3)
+print '%-32s %10.3f ms/call'%('Tabulated kernel (cache miss):',t_table*1E3)
+print '%-32s %10.3f ms/call'%('Cached kernel:',t_cache*1E3)
+print '%-32s %10.3e'%('Max fractional deviation:',
+                      np.max(np.abs(v_cache-v_direct))/np.max(v_direct))
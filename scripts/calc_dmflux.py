@@ -37,7 +37,7 @@ def make_halo_plots(halo_models,cat):
 
         psi = 0.5*(psi_edge[1:] + psi_edge[:-1])
 
-        jval = jp(psi)
+        jval = jtable_cache.tabulate(jp,psi)[0]
 
         domega = 2*np.pi*(np.cos(psi_edge[1:]) - psi_edge[:-1])
         jcum = np.cumsum(domega*jval)
@@ -131,7 +131,7 @@ jp = LoSIntegralFn.create(halo_model)
 
 psi_edge = np.radians(10**np.linspace(np.log10(0.01),np.log10(45.),200))
 psi = 0.5*(psi_edge[1:] + psi_edge[:-1])
-jval = jp(psi)
+jval = jtable_cache.tabulate(jp,psi)[0]
 
 for m in massv:
 
@@ -74,9 +74,9 @@ f = LoSIntegralFn(dp,8.5*Units.kpc,
 log_psi = np.linspace(np.log10(np.radians(0.01)),
                       np.log10(np.radians(179.9)),400)
 psi = np.power(10,log_psi)
-jpsi = f(psi)
+jpsi, jcum = jtable_cache.tabulate(f,psi)
 jspline = UnivariateSpline(psi,jpsi,s=0,k=1)
-jint = JIntegrator(jspline,opts.lat_cut,opts.lon_cut,opts.source_list)
+jint = ROIIntegrator(jspline,opts.lat_cut,opts.lon_cut,opts.source_list)
 #jint.print_profile(opts.decay)
 
 if not opts.rgc_cut is None: